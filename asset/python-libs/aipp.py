@@ -0,0 +1,715 @@
+"""
+AIPP: AppData Instrumentation Protocol for Pybricks
+Shared tunnel module used by dap_aipp_full.py and hubmonitor.py.
+
+Frames messages into AppData chunks: 0xFE (first) / 0xFF (continuation)
+marker, payload bytes, 0xFF (more follows) / 0x00 (last) terminator.
+The 8-bit sum checksum is appended to the payload stream.
+Once negotiated (CAP_CRC), frames start with 0xFC instead and carry a u16
+message length and a table-driven CRC-8; receivers accept both framings.
+Optionally (CAP_SEQ, negotiated in the debug START handshake) messages are
+wrapped in sequenced frames that are acknowledged and retransmitted.
+Compact values (CAP_COMPACT) send integers as zigzag varints and decimal
+floats as scaled varints.
+Coalescing (CAP_COALESCE) packs several short messages into one frame.
+With credit flow control (CAP_CREDITS) chunks are written against credits
+granted by the host instead of with a fixed wait after each.
+"""
+from pybricks.tools import wait
+from ustruct import unpack_from
+from micropython import const
+
+# NOTE: keep docstrings multi-line, this file is also pasted to the REPL,
+# pruned to the top-level definitions the script imports and these use
+
+# ------------------------------
+# region AIPP Frame Check
+
+# CRC framing: 0xFC first marker, u16 length, message, CRC-8 over both
+CAP_CRC = const(0x0040)
+CRC_FIRST = const(0xFC)
+
+
+def _crc8_table():
+    # CRC-8 polynomial x^8 + x^2 + x + 1 (0x07), most significant bit first
+    table = bytearray(256)
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ 0x07 if c & 0x80 else c << 1) & 0xFF
+        table[i] = c
+    return bytes(table)
+
+
+# one lookup per byte: crc = CRC8_TABLE[crc ^ b], initial value 0
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, crc=0):
+    """
+    Returns the CRC-8 of data continuing from crc.
+    A message followed by its CRC-8 has a CRC-8 of 0.
+    """
+    table = CRC8_TABLE
+    for b in data:
+        crc = table[crc ^ b]
+    return crc
+
+# endregion AIPP Frame Check
+# ------------------------------
+
+# ------------------------------
+# region AIPP Tunnel Writer
+
+# max bytes per AppData chunk including the two framing bytes
+MTU = const(19)
+_PAYLOAD = const(17)  # MTU - 2 framing bytes
+
+
+class TunnelWriter:
+    """
+    Writes AIPP tunnel frames from one preallocated chunk buffer.
+    Payload bytes are copied into the chunk while the checksum is summed,
+    so sending a message does not allocate, neither per chunk nor per message.
+    Set crc once CAP_CRC is agreed to send CRC frames instead, and credits
+    to a CreditGate once CAP_CREDITS is, which then paces the chunks.
+    """
+
+    def __init__(self, appdata, pace_ms=0):
+        self.appdata = appdata
+        self.pace_ms = pace_ms  # wait after each chunk, 0 = no pacing
+        self.credits = None  # CreditGate (CAP_CREDITS), replaces pace_ms
+        self.buf = bytearray(MTU)
+        mv = memoryview(self.buf)
+        # prefix views for every chunk length, the last chunk is usually shorter
+        self.views = [mv[:n] for n in range(MTU + 1)]
+        self.crc = False  # CRC framing (CAP_CRC)
+
+    def send(self, data, length=-1):
+        """
+        Frame and write data (bytes, bytearray or memoryview).
+        length limits the message to the first length bytes of data,
+        so a caller can reuse an oversized buffer without slicing it.
+        """
+        n = len(data) if length < 0 else length
+        if self.crc:
+            self._send_crc(data, n)
+            return
+        buf = self.buf
+        csum = 0
+        pos = 0
+        buf[0] = 0xFE
+        while pos <= n:  # position n is the checksum byte
+            k = 1
+            while k <= _PAYLOAD and pos < n:
+                b = data[pos]
+                buf[k] = b
+                csum += b
+                k += 1
+                pos += 1
+            if pos == n and k <= _PAYLOAD:
+                buf[k] = csum & 0xFF
+                k += 1
+                pos += 1
+            buf[k] = 0x00 if pos > n else 0xFF
+            self._write(self.views[k + 1])
+            buf[0] = 0xFF
+
+    def _write(self, chunk):
+        # writes one chunk once a credit allows, or paced by a fixed wait
+        credits = self.credits
+        if credits is not None:
+            credits.acquire()
+        try:
+            self.appdata.write_bytes(chunk)
+        except:
+            pass
+        if credits is None and self.pace_ms:
+            wait(self.pace_ms)
+
+    def _send_crc(self, data, n):
+        # as send, with the length in front and the CRC-8 instead of the sum
+        buf = self.buf
+        table = CRC8_TABLE
+        buf[0] = CRC_FIRST
+        buf[1] = n & 0xFF
+        buf[2] = n >> 8
+        crc = table[table[buf[1]] ^ buf[2]]
+        k = 3
+        pos = 0
+        while pos <= n:  # position n is the CRC byte
+            while k <= _PAYLOAD and pos < n:
+                b = data[pos]
+                buf[k] = b
+                crc = table[crc ^ b]
+                k += 1
+                pos += 1
+            if pos == n and k <= _PAYLOAD:
+                buf[k] = crc
+                k += 1
+                pos += 1
+            buf[k] = 0x00 if pos > n else 0xFF
+            self._write(self.views[k + 1])
+            buf[0] = 0xFF
+            k = 1
+
+# endregion AIPP Tunnel Writer
+# ------------------------------
+
+# ------------------------------
+# region AIPP Poll Scheduler
+
+
+class PollScheduler:
+    """
+    Adaptive receive polling interval for the AppData buffer, which cannot
+    signal new data. Polls fast right after activity (a send or a received
+    chunk), then doubles the interval per idle poll up to the ceiling.
+    counts maps each chosen interval (ms) to the number of polls that used it.
+    """
+
+    def __init__(self, fast=5, ceiling=100):
+        self.fast = fast
+        self.ceiling = ceiling  # may be changed at runtime
+        self.interval = fast
+        self.counts = {}
+
+    def activity(self):
+        self.interval = self.fast
+
+    def next(self, hold=False):
+        """
+        Returns the interval to wait now and backs off for the next poll.
+        hold keeps polling fast, e.g. while a frame is incomplete.
+        """
+        interval = self.fast if hold else min(self.interval, self.ceiling)
+        self.interval = interval << 1
+        self.counts[interval] = self.counts.get(interval, 0) + 1
+        return interval
+
+# endregion AIPP Poll Scheduler
+# ------------------------------
+
+# ------------------------------
+# region AIPP Tunnel Reassembler
+
+
+class Reassembler:
+    """
+    Reassembles AIPP tunnel chunks one at a time into a fixed capacity buffer.
+    The checksum is summed while copying, a wrong marker drops the partial
+    frame at once, and reset() reuses the buffer without reallocating.
+    Continuation chunks may be marked 0xFF or 0xFD, a host using sequenced
+    frames alternates both so consecutive chunks never compare equal.
+    CRC frames (first marker 0xFC) are told apart per frame and checked by
+    their length and CRC-8, the message may be followed by padding.
+    """
+
+    def __init__(self, capacity=256):
+        self.buf = bytearray(capacity)
+        self.mv = memoryview(self.buf)
+        self.n = 0
+        self.csum = 0
+        self.active = False  # a frame is started, continuation chunks expected
+        self.crc = False  # the current frame uses CRC framing
+        self.errors = 0  # rejected chunks and checksum mismatches
+
+    def reset(self):
+        self.n = 0
+        self.csum = 0
+        self.active = False
+
+    def feed(self, chunk):
+        """
+        Consume one AppData chunk.
+        Returns the message (without checksum) as a memoryview into the
+        internal buffer once the last chunk arrived - valid until the next
+        feed() - otherwise None.
+        """
+        last = len(chunk) - 1
+        if last < 1:
+            return None
+        marker = chunk[0]
+        if marker == 0xFE or marker == CRC_FIRST:
+            self.reset()  # a new frame always restarts, even over a partial one
+            self.active = True
+            self.crc = marker == CRC_FIRST
+        elif (marker != 0xFF and marker != 0xFD) or not self.active:
+            return self._reject()
+        end = chunk[last]
+        if (end != 0x00 and end != 0xFF) or self.n + last - 1 > len(self.buf):
+            return self._reject()
+
+        buf = self.buf
+        n = self.n
+        csum = self.csum
+        i = 1
+        if self.crc:
+            table = CRC8_TABLE
+            while i < last:
+                b = chunk[i]
+                buf[n] = b
+                csum = table[csum ^ b]
+                n += 1
+                i += 1
+        else:
+            while i < last:
+                b = chunk[i]
+                buf[n] = b
+                csum += b
+                n += 1
+                i += 1
+        self.n = n
+        self.csum = csum
+        if end == 0xFF:
+            return None
+
+        if self.crc:
+            # the CRC-8 over length, message, padding and CRC byte leaves 0
+            self.active = False
+            length = buf[0] | buf[1] << 8 if n >= 3 else n
+            if csum or length > n - 3:
+                self.errors += 1
+                return None
+            return self.mv[2:2 + length]
+
+        # checksum is the last payload byte, aligned to the end of the frame
+        self.active = False
+        if n < 1 or (csum - buf[n - 1]) & 0xFF != buf[n - 1]:
+            self.errors += 1
+            return None
+        return self.mv[:n - 1]
+
+    def _reject(self):
+        self.errors += 1
+        self.reset()
+        return None
+
+# endregion AIPP Tunnel Reassembler
+# ------------------------------
+
+# ------------------------------
+# region AIPP Credit Flow Control
+
+# chunks written against credits granted by the host, negotiated in the START
+# handshake; CREDIT_GRANT: 0x70 0x13, u16 chunks received, u8 window
+CAP_CREDITS = const(0x0400)
+CREDIT_GRANT = const(0x13)
+_CREDITS_INITIAL = const(4)  # window until the first grant
+_CREDIT_STALL = const(250)   # ms without a grant until the chunks are lost
+_CREDIT_HELD = const(4)      # host messages kept while waiting
+
+
+class CreditGate:
+    """
+    Paces the chunks of a TunnelWriter against credits granted by the host.
+    The host counts the chunks it received and grants credits in a
+    CREDIT_GRANT with that count and a window: the hub writes while fewer
+    than window chunks are in flight, written but neither counted nor lost.
+    Grants are cumulative, so a lost one is made good by the next.
+    Out of credits, acquire() polls the host through read, the script's
+    own receive function: it reads the AppData receive buffer once and
+    returns a reassembled message or None, so the script's reassembler sees
+    every chunk. Grants are applied, other messages are held for the script,
+    which takes them with receive() instead of calling read itself; the
+    grants it receives itself it passes to grant(). A grant not coming
+    within stall_ms writes off the chunks in flight as lost; a grant
+    counting more chunks than assumed takes the surplus back.
+    """
+
+    def __init__(self, read, watch, stall_ms=_CREDIT_STALL):
+        self.read = read
+        self.watch = watch
+        self.stall_ms = stall_ms
+        self.held = []  # host messages received while waiting, oldest first
+        self.sent = 0  # chunks written, u16
+        self.received = 0  # chunks the host received, u16, of the last grant
+        self.lost = 0  # chunks written off, u16
+        self.window = _CREDITS_INITIAL
+        # counters
+        self.waits = 0  # chunks that waited for a credit
+        self.stalls = 0  # waits ended by stall_ms
+
+    def in_flight(self):
+        return (self.sent - self.received - self.lost) & 0xFFFF
+
+    def grant(self, received, window):
+        self.received = received
+        self.window = window
+        if self.in_flight() & 0x8000:
+            # chunks written off arrived after all, or were written before
+            # the gate was set up
+            self.lost = (self.sent - received) & 0xFFFF
+
+    def acquire(self):
+        """
+        Returns once a chunk may be written, counting it as written.
+        """
+        if self.in_flight() >= self.window:
+            self.waits += 1
+            start = self.watch.time()
+            while self.in_flight() >= self.window:
+                if self.watch.time() - start >= self.stall_ms:
+                    self.stalls += 1
+                    self.lost = (self.sent - self.received) & 0xFFFF
+                    break
+                self.poll()
+                wait(1)
+        self.sent = (self.sent + 1) & 0xFFFF
+
+    def poll(self):
+        # one read while waiting: a grant is applied, other messages are
+        # copied for the script, a full queue drops the oldest
+        try:
+            msg = self.read()
+        except:
+            return
+        if msg is None:
+            return
+        if len(msg) >= 5 and msg[0] == 0x70 and msg[1] == CREDIT_GRANT:
+            received, window = unpack_from('<HB', msg, 2)
+            self.grant(received, window)
+            return
+        if len(self.held) >= _CREDIT_HELD:
+            self.held.pop(0)
+        self.held.append(bytes(msg))
+
+    def receive(self):
+        """
+        The script's receive: a message held while waiting, oldest first,
+        otherwise one read.
+        """
+        if self.held:
+            return self.held.pop(0)
+        return self.read()
+
+# endregion AIPP Credit Flow Control
+# ------------------------------
+
+# ------------------------------
+# region AIPP Sequenced Link
+
+# capability bits exchanged in the debug START handshake
+CAP_SEQ = const(0x0001)
+
+# sequenced frame: 0x76, seq, ack (next expected seq), base (oldest seq the
+# sender still retransmits), u16 length, message
+# a frame with length 0 is a pure acknowledge and consumes no sequence number
+# length bit 15 (NAK): the sender received a frame beyond ack and dropped it
+SEQ_FRAME = const(0x76)
+_SEQ_HEADER = const(6)
+_SEQ_NAK = const(0x80)  # in the length high byte
+_SEQ_WINDOW = const(4)     # unacknowledged frames kept for retransmission
+_RTO_INIT = const(1000)    # ms, until the first round trip was measured
+_RTO_MIN = const(50)
+_RTO_MAX = const(3000)     # ms, the former fixed resend period
+
+
+class SeqLink:
+    """
+    Sequenced, acknowledged framing on top of a TunnelWriter.
+    Every message gets a sequence number and is kept until the peer
+    acknowledges it (cumulative ack, piggybacked on the peer's frames or sent
+    as a pure ack). The oldest unacknowledged frame is retransmitted after an
+    adaptive timeout (smoothed round trip + 4 x variance, doubled per
+    retransmission); later frames follow one by one as acks come in, since
+    the hub AppData buffer only keeps the last chunk written to it.
+    The receiver accepts frames in order only, duplicates are acknowledged
+    again and dropped, so two equal messages are never mistaken for a repeat.
+    A frame arriving early (one before it was lost) is dropped and answered
+    with a NAK, so the sender retransmits the missing frame at once instead
+    of waiting for the timeout.
+    A full window evicts its oldest frame; the base field lets the receiver
+    skip evicted frames instead of waiting for them forever.
+    """
+
+    def __init__(self, writer, clock):
+        self.writer = writer
+        self.clock = clock  # ms time source, e.g. a StopWatch
+        self.next_seq = 0
+        self.expected = 0  # next in-order sequence number to receive
+        self.frames = []  # unacknowledged [seq, frame, sent_at, retries]
+        self.srtt = 0  # smoothed round trip x8, 0 = no sample yet
+        self.rttvar = 0  # round trip variance x4
+        self.rto = _RTO_INIT
+        self.ack_pending = False
+        self.nak_pending = False
+        self.ack_frame = bytearray(_SEQ_HEADER)
+        self.ack_frame[0] = SEQ_FRAME
+        # counters
+        self.retransmits = 0
+        self.duplicates = 0  # received frames dropped as repeated or early
+        self.dropped = 0  # unacknowledged frames evicted from a full window
+        self.skipped = 0  # frames the peer evicted before we received them
+        self.fast_retransmits = 0  # go-back on a NAK, part of retransmits
+
+    def send(self, data):
+        """
+        Send data as the next sequenced frame.
+        A full window evicts the oldest frame, the user program never blocks.
+        """
+        if len(self.frames) >= _SEQ_WINDOW:
+            self.frames.pop(0)
+            self.dropped += 1
+        n = len(data)
+        frame = bytearray(_SEQ_HEADER + n)
+        frame[0] = SEQ_FRAME
+        frame[1] = self.next_seq
+        frame[4] = n & 0xFF
+        frame[5] = n >> 8
+        frame[_SEQ_HEADER:] = data
+        entry = [self.next_seq, frame, 0, 0]
+        self.frames.append(entry)
+        self.next_seq = (self.next_seq + 1) & 0xFF
+        self._transmit(entry)
+
+    def _transmit(self, entry):
+        frame = entry[1]
+        frame[2] = self.expected  # piggyback the latest ack
+        frame[3] = self.frames[0][0]
+        frame[5] = frame[5] & ~_SEQ_NAK | (_SEQ_NAK if self.nak_pending else 0)
+        self.ack_pending = self.nak_pending = False
+        entry[2] = self.clock.time()
+        self.writer.send(frame)
+
+    def receive(self, msg):
+        """
+        Handle one reassembled tunnel message.
+        Returns the message of a new in-order frame (a view into msg),
+        msg itself when it is not a sequenced frame, otherwise None.
+        """
+        if len(msg) < _SEQ_HEADER or msg[0] != SEQ_FRAME:
+            return msg
+        self._acknowledged(msg[2])
+        skip = (msg[3] - self.expected) & 0xFF
+        if 0 < skip < 0x80:
+            self.skipped += skip
+            self.expected = msg[3]
+        if msg[5] & _SEQ_NAK:
+            self._go_back()
+        n = msg[4] | (msg[5] & ~_SEQ_NAK) << 8
+        if n == 0 or _SEQ_HEADER + n > len(msg):
+            return None
+        self.ack_pending = True
+        if msg[1] != self.expected:
+            self.duplicates += 1
+            if (msg[1] - self.expected) & 0xFF < 0x80:
+                self.nak_pending = True  # early: an earlier frame was lost
+            return None
+        self.expected = (self.expected + 1) & 0xFF
+        return msg[_SEQ_HEADER:_SEQ_HEADER + n]
+
+    def _acknowledged(self, ack):
+        now = self.clock.time()
+        frames = self.frames
+        while frames and 0 < (ack - frames[0][0]) & 0xFF <= _SEQ_WINDOW:
+            entry = frames.pop(0)
+            rtt = now - entry[2]
+            # Karn: no samples from retransmitted frames, nor from frames
+            # that waited while the hub was not polling (user program ran)
+            if entry[3] == 0 and rtt < _RTO_MAX:
+                self._sample(rtt)
+
+    def _go_back(self):
+        # retransmit the missing frame, at most once per half round trip
+        if self.frames and self.clock.time() - self.frames[0][2] >= self.srtt >> 4:
+            self.fast_retransmits += 1
+            self._retransmit(self.frames[0])
+
+    def _retransmit(self, entry):
+        entry[3] += 1
+        self.retransmits += 1
+        self._transmit(entry)
+
+    def _sample(self, rtt):
+        if not self.srtt:
+            self.srtt = rtt << 3
+            self.rttvar = rtt << 1
+        else:
+            delta = rtt - (self.srtt >> 3)
+            self.srtt += delta
+            if delta < 0:
+                delta = -delta
+            self.rttvar += delta - (self.rttvar >> 2)
+        self.rto = min(max((self.srtt >> 3) + self.rttvar, _RTO_MIN), _RTO_MAX)
+
+    def poll(self):
+        """
+        Retransmit timed out frames and flush a pending pure acknowledge.
+        Call regularly while waiting for the peer.
+        """
+        if self.frames and self.clock.time() - self.frames[0][2] >= self.rto:
+            self._retransmit(self.frames[0])
+            self.rto = min(self.rto << 1, _RTO_MAX)
+        if self.ack_pending:
+            self.ack_pending = False
+            ack = self.ack_frame
+            ack[2] = self.expected
+            ack[3] = self.frames[0][0] if self.frames else self.next_seq
+            ack[5] = _SEQ_NAK if self.nak_pending else 0
+            self.nak_pending = False
+            self.writer.send(ack)
+
+# endregion AIPP Sequenced Link
+# ------------------------------
+
+# ------------------------------
+# region AIPP Compact Values
+
+# compact value encoding, negotiated in the START handshake
+CAP_COMPACT = const(0x0010)
+# START sent by a monitor program instead of a debuggee, the host only acks caps
+CAP_MONITOR = const(0x0020)
+# monitor sends only the sources that changed between keyframes (0x75)
+CAP_DELTA_NOTIF = const(0x0100)
+# monitor samples each source on its own period, set by the host and reported
+CAP_SCHEDULE = const(0x0200)
+
+_DECIMAL_MAX = const(0x100000)  # scaled mantissa limit, 3 varint bytes at most
+
+
+def put_varint(buf, n):
+    """
+    Appends n to the bytearray buf as a zigzag LEB128 varint:
+    7 bits per byte, low group first, bit 7 set while more bytes follow.
+    Small magnitudes of either sign take one byte (-64..63).
+    """
+    n = n << 1 if n >= 0 else (-n << 1) - 1
+    while n > 0x7F:
+        buf.append(n & 0x7F | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def put_varint_into(buf, offset, n):
+    """
+    Writes n as put_varint does into buf at offset, which must have room for
+    it (5 bytes for 32 bits); returns the offset after it.
+    """
+    n = n << 1 if n >= 0 else (-n << 1) - 1
+    while n > 0x7F:
+        buf[offset] = n & 0x7F | 0x80
+        offset += 1
+        n >>= 7
+    buf[offset] = n
+    return offset + 1
+
+
+def get_varint(buf, offset):
+    """
+    Reads a zigzag LEB128 varint, returns the value and the next offset.
+    """
+    n = 0
+    shift = 0
+    while True:
+        b = buf[offset]
+        offset += 1
+        n |= (b & 0x7F) << shift
+        shift += 7
+        if b < 0x80:
+            break
+    return (n >> 1) ^ -(n & 1), offset
+
+
+def scaled(f):
+    """
+    Returns the float f as a scaled decimal m * 4 + d for the smallest d (0..3)
+    with m / 10 ** d == f, or None if f has more decimals or is too large.
+    Decoded by the host as m / 10 ** d, exact where a float32 is not (1.2).
+    """
+    try:
+        scale = 1
+        for d in range(4):
+            m = round(f * scale)
+            if -_DECIMAL_MAX < m < _DECIMAL_MAX and m / scale == f:
+                return m * 4 + d
+            scale *= 10
+    except (OverflowError, ValueError):
+        pass
+    return None
+
+# endregion AIPP Compact Values
+# ------------------------------
+
+# ------------------------------
+# region AIPP Coalescing
+
+# several messages in one frame, negotiated in the START handshake
+CAP_COALESCE = const(0x0080)
+# COALESCED message: 0x77, then per message u8 length, message
+COALESCED = const(0x77)
+COALESCE_MAX = const(240)  # frame size, longer messages are sent alone
+
+
+class Coalescer:
+    """
+    Packs messages into one preallocated COALESCED message, sent with
+    send(data) once the next message does not fit, on flush, or on poll
+    deadline_ms after the first one queued. A lone message is sent as is.
+    Until enabled (CAP_COALESCE agreed) every message is sent at once.
+    With sized, send takes a length as TunnelWriter.send does, so frames are
+    sent from the buffer without slicing it.
+    """
+
+    def __init__(self, send, watch, deadline_ms=50, capacity=COALESCE_MAX,
+                 sized=False):
+        self.send = send
+        self.sized = sized
+        self.watch = watch
+        self.deadline_ms = deadline_ms
+        self.buf = bytearray(capacity)
+        self.buf[0] = COALESCED
+        self.mv = memoryview(self.buf)
+        self.tail = self.mv[2:]  # a lone message, after its type and length
+        self.n = 1  # bytes used
+        self.count = 0  # messages queued
+        self.first_at = 0  # watch time of the first message queued
+        self.enabled = False
+
+    def add(self, data, length=-1):
+        """
+        Queues a message (bytes, bytearray or memoryview), copied at once.
+        length limits it to the first length bytes of data, as in
+        TunnelWriter.send; a message sent alone then needs a sized send.
+        """
+        n = len(data) if length < 0 else length
+        if not self.enabled or n > 255 or n + 2 > len(self.buf):
+            self.flush()
+            if length < 0:
+                self.send(data)
+            else:
+                self.send(data, length)
+            return
+        if self.n + 1 + n > len(self.buf):
+            self.flush()
+        if not self.count:
+            self.first_at = self.watch.time()
+        buf = self.buf
+        k = self.n
+        buf[k] = n
+        if length < 0:
+            buf[k + 1:k + 1 + n] = data
+        else:
+            for j in range(n):  # a slice of data would allocate
+                buf[k + 1 + j] = data[j]
+        self.n = k + 1 + n
+        self.count += 1
+
+    def poll(self):
+        if self.count and self.watch.time() - self.first_at >= self.deadline_ms:
+            self.flush()
+
+    def flush(self):
+        if self.sized and self.count == 1:
+            self.send(self.tail, self.n - 2)
+        elif self.sized and self.count:
+            self.send(self.mv, self.n)
+        elif self.count == 1:
+            self.send(self.mv[2:self.n])
+        elif self.count:
+            self.send(self.mv[:self.n])
+        self.n = 1
+        self.count = 0
+
+# endregion AIPP Coalescing
+# ------------------------------
@@ -5,16 +5,20 @@ A minimal implementation for MicroPython on Pybricks hubs.
 """
 from pybricks.parameters import Button
 from pybricks.hubs import ThisHub
-from pybricks.tools import AppData, wait
-from ustruct import pack, unpack
+from pybricks.tools import AppData, StopWatch, wait
+from ustruct import pack, pack_into, unpack_from
+from array import array
 from micropython import const
+from aipp import TunnelWriter, Reassembler, SeqLink, PollScheduler, Coalescer, \
+    CreditGate, CAP_SEQ, CAP_COMPACT, CAP_CRC, CAP_COALESCE, CAP_CREDITS, CREDIT_GRANT, \
+    put_varint, scaled
 
 # https://docs.micropython.org/en/latest/develop/optimizations.html
 # optimized version: 2946 bytes
 
 # ------------------------------
 # region AIPP Tunnel Handling
-# max bytes per packet including header (receive MTU, send MTU is )
+# max bytes per packet including header (same as aipp.MTU)
 _APPDATA_MTU = const(19)
 _MAX_COUNT_VALUES = const(255)
 
@@ -24,85 +28,28 @@ def _format_bytes(data: bytes, hex: bool = True) -> str:  # !!
     return ''.join(fmt.format(b) for b in data)
 
 
-# def simple_sum_checksum(data: bytes) -> int:
-#     """
-#     Computes a simple 8-bit checksum by summing all bytes.
-#     The result is modulo 256.
-
-#     :param data: The bytes-like object to checksum.
-#     :return: The 8-bit checksum (0-255).
-#     """
-#     return sum(data) & 0xFF
+def send_tunnel_frame(data: bytes):
+    # frame with start byte, data, checksum, end byte - see aipp.TunnelWriter
+    # once negotiated, wrapped in a sequenced frame - see aipp.SeqLink
+    # print("sending data", _format_bytes(data)) # !!
+    if seq_link:
+        seq_link.send(data)
+    else:
+        tunnel_writer.send(data)
 
 
 def send_tunnel_aipp(data: bytes):
-    # frame with start byte, data, checksum, end byte
-    # split into chunks of MTU size with continuation bytes
-    # start byte: 0xFE
-    # continuation byte: 0xFF
-    # end byte: 0x00
-    # checksum: sum of all data bytes modulo 256
+    # sent at once, in one frame with the messages queued before
+    coalescer.add(data)
+    coalescer.flush()
 
-    # inlined simple_sum_checksum
-    # data += bytes([simple_sum_checksum(data)])
-    data += bytes([sum(data) & 0xFF])
 
-    # print("sending data", _format_bytes(data)) # !!
-    offset = 0
-    while offset < len(data):
-        n = min(_APPDATA_MTU-2, len(data)-offset)
-        isfirst = offset == 0
-        islast = offset+n >= len(data)
-        chunk = (b'\xfe' if isfirst else b'\xff') + \
-            data[offset:offset+n] + \
-            (b'\x00' if islast else b'\xff')
-        try:
-            appdata.write_bytes(chunk)
-        except:
-            # raise e # !!
-            pass
-        offset += n
-
-
-def decode_tunnel(chunks: list[bytes]) -> bytes:
-    """Assembles a list of byte chunks into a single bytes object.
-    If a chunk ends with 0xFF, it indicates more chunks follow.
-    Chunk starts with 0xFE for first, then 0xFF.
-    The last chunk ends with checksum byte and 0x00.
-    """
-    # Accept both bytes and list-of-bytes, but avoid wrapping unnecessarily
-    if isinstance(chunks, bytes):
-        # single chunk, treat as list of one
-        chunks = (chunks,)  # comma is important as it will enforce the tuple
-    message = bytearray()
-    for index, chunk in enumerate(chunks):
-        # print(_format_bytes(chunk), " | ", len(chunk))  # !!
-        # or chunk[-1] not in (0x00, 0xFF):
-        if chunk[0] != (0xFE if index == 0 else 0xFF):
-            # print("error", 1, chunk[0], index) # !!
-            return b''  # ignore invalid array of chunks
-        # if chunk[0] != (0xFE if i == 0 else 0xFF) or chunk[-1] not in (0x00, 0xFF):
-        #     raise ValueError()
-        is_last = chunk[-1] == 0x00
-        # Remove leading 0xFE/0xFF if present (continuation marker)
-        # Remove trailing 0xFF or 0x00 (continuation or end marker)
-        chunk = chunk[1:-1]
-        message.extend(chunk)
-        if is_last:
-            break
-    if len(message) < 1:
-        # print("error", 2) # !!
-        return b''
-    data = message[:-1]
-    checksum = message[-1]
-    # checksum decoding is problematic; either align to the end (-1 for continuation) or rework checksum
-    # inlined simple_sum_checksum
-    # if simple_sum_checksum(data) != checksum:
-    #     raise ValueError()
-    if sum(data) & 0xFF != checksum:
-        # print("error", 3, hex(sum(data) & 0xFF), hex(checksum)) # !!
-        raise b''
-    return bytes(data)
+def queue_tunnel_aipp(data: bytes):
+    # once negotiated, shares a frame with the messages following within
+    # _DAP_COALESCE ms - see aipp.Coalescer
+    coalescer.add(data)
+    coalescer.poll()
+
 
 # endregion AIPP Tunnel Handling
 # ------------------------------
@@ -129,24 +76,121 @@ _DEBUG_SETVAR_REQ = const(0x08)
 _DEBUG_SETVAR_RESP = const(0x09)
 _DEBUG_TERM_REQ = const(0x0a)
 _DEBUG_TERM_RESP = const(0x0b)
+_DEBUG_BREAKPOINTS_REQ = const(0x0c)
+_DEBUG_CONDITION_REQ = const(0x0d)
+_DEBUG_LOGPOINTS_REQ = const(0x0e)
+_DEBUG_LOG_NOTIF = const(0x0f)
+_DEBUG_TRAP_DELTA_NOTIF = const(0x10)
+_DEBUG_BREAKPOINTS_DONE = const(0x14)  # after CREDIT_GRANT (0x13) of aipp
 
 _PLOT_ACK = const(0x00)
 _PLOT_DEFINE = const(0x01)
 _PLOT_UPDATE_CELLS = const(0x02)
 _PLOT_UPDATE_ROW = const(0x03)
+# rows u8, count u8, u16 ms from the first to the last row, rows x count float
+_PLOT_UPDATE_ROWS = const(0x04)
+# array typecode u8, count u8, rows u8, u16 span ms, rows x count values
+_PLOT_CAPTURE = const(0x05)
+# u32 samples, u32 overruns, u32 ms from the first to the last sample
+_PLOT_CAPTURE_STATS = const(0x06)
+# host to hub: bucket u8, count u8, count x policy u8 (_PLOT_KEEP: unchanged)
+_PLOT_DOWNSAMPLE_REQ = const(0x07)
+
+# downsampling policy of a plot column, a row is sent per bucket of rows:
+PLOT_EVERY = const(0x00)    # the first value of the bucket
+PLOT_MEAN = const(0x01)     # the mean of the bucket
+PLOT_MIN_MAX = const(0x02)  # the minimum and the maximum, in the order seen
+_PLOT_KEEP = const(0xFF)
 
 _VAR_NONE = const(0x00)
 _VAR_INT = const(0x01)
 _VAR_FLOAT = const(0x02)
 _VAR_STRING = const(0x03)
 _VAR_BOOL = const(0x04)
-
-_DAP_TUNNEL_WAIT = const(100)                      # wait time per loop (ms)
-# active wait time per loop for continuation (ms)
-_DAP_TUNNEL_CONTINUATION_WAIT = const(10)
-_DAP_TIMEOUT = const(100)                          # full (100ms) cycles
+# containers: u16 length, u16 start, u8 count, count x element (dict: key, value)
+_VAR_LIST = const(0x05)
+_VAR_TUPLE = const(0x06)
+_VAR_DICT = const(0x07)
+# compact values (CAP_COMPACT): zigzag varint, scaled decimal varint m * 4 + d
+_VAR_VARINT = const(0x08)
+_VAR_DECIMAL = const(0x09)
+# TRAP_DELTA_NOTIF type flag: value unchanged since the last acknowledged trap
+_VAR_UNCHANGED = const(0x80)
+# trap type flag: value deferred, u16 size follows instead, fetched with GETVAR_REQ
+_VAR_DEFERRED = const(0x40)
+# GETVAR_RESP flags
+_GETVAR_TRUNCATED = const(0x01)  # string value cut to the requested size
+_GETVAR_UNKNOWN = const(0x02)    # variable not exposed at this trap
+
+# START_ACK success byte flag: u16 host capabilities follow
+_START_ACK_CAPS = const(0x80)
+# delta trap snapshots with a session string table (TRAP_DELTA_NOTIF)
+_CAP_TRAP_DELTA = const(0x0002)
+# traps defer larger values, the host fetches them on demand (GETVAR_REQ)
+_CAP_LAZY_VALUES = const(0x0004)
+# lists, tuples and dicts are sent paged, the host fetches further pages (GETVAR_REQ)
+_CAP_CONTAINERS = const(0x0008)
+# capabilities offered by this hub in START_NOTIF
+_DAP_CAPS = const(CAP_SEQ | _CAP_TRAP_DELTA | _CAP_LAZY_VALUES | _CAP_CONTAINERS |
+                  CAP_COMPACT | CAP_CRC | CAP_COALESCE | CAP_CREDITS)
+# string table size, filenames and variable names beyond are sent as TRAP_NOTIF
+_DAP_STRINGS = const(255)
+# BREAKPOINTS_REQ flags: stop at the next trap regardless of the bitmap
+_BREAKPOINTS_STEP = const(0x01)
+
+# CONDITION_REQ hit count operators, hits count the calls passing the comparison
+_HIT_ANY = const(0x00)
+_HIT_GE = const(0x01)   # hits >= n, ignore count n - 1
+_HIT_EQ = const(0x02)   # hits == n
+_HIT_MOD = const(0x03)  # every n-th hit
+# CONDITION_REQ comparison of an exposed variable with a value
+_CMP_EQ = const(0x00)
+_CMP_NE = const(0x01)
+_CMP_LT = const(0x02)
+_CMP_LE = const(0x03)
+_CMP_GT = const(0x04)
+_CMP_GE = const(0x05)
+
+_DAP_TUNNEL_WAIT = const(100)                      # idle poll interval ceiling (ms)
+# poll interval right after a send or a received chunk, doubled per idle poll
+_DAP_POLL_FAST = const(5)
+# wait after each chunk written unless the host grants credits (CAP_CREDITS)
+_DAP_PACE_MS = const(5)
+_DAP_TIMEOUT = const(100)                          # x * _DAP_TUNNEL_WAIT ms
 # resend every n loops # to be checked/validated
 _DAP_REPEAT_COUNT = const(30)                      # x * _DAP_TUNNEL_WAIT ms
+# total time traps may wait for a pending START handshake (ms), once
+_DAP_HANDSHAKE_GRACE = const(1000)
+# disabled traps poll the host for breakpoint updates every n calls
+_DAP_BREAKPOINT_POLL = const(64)
+# logpoint snapshots queued at most, the oldest are dropped beyond
+_DAP_LOG_QUEUE = const(16)
+# LOG_NOTIF batch size (bytes), a single larger snapshot is sent alone
+_DAP_LOG_BATCH = const(160)
+# link capacity for a batch: unacknowledged sequenced frames at most,
+# without sequenced frames the minimum time between batches (ms)
+_DAP_LOG_FRAMES = const(2)
+_DAP_LOG_INTERVAL = const(50)
+# longest string sent inline in a trap once values are deferred (characters)
+_DAP_INLINE_STRING = const(16)
+# longest string sent in a GETVAR_RESP (characters), longer ones are truncated
+_DAP_GETVAR_MAX = const(512)
+# container levels sent with elements, deeper ones with their length only
+_DAP_DEPTH = const(2)
+# elements of a container sent in a trap, the first page
+_DAP_PAGE = const(8)
+# elements sent for one trap value, all levels together
+_DAP_VALUE_ELEMENTS = const(32)
+# elements sent in a GETVAR_RESP page, all levels together
+_DAP_SLICE_MAX = const(64)
+# UPDATE_ROWS batch size (bytes), the rows are sent once no further row fits
+_PLOT_BATCH = const(208)
+# longest time a row waits in the batch (ms)
+_PLOT_LATENCY = const(100)
+_PLOT_ROWS_HEADER = const(6)
+_PLOT_CAPTURE_HEADER = const(7)
+# longest time a log batch or plot rows wait to share a frame (ms)
+_DAP_COALESCE = const(50)
 
 
 def encode_zstring(s: str) -> bytes:
@@ -154,85 +198,198 @@ def encode_zstring(s: str) -> bytes:
     return bytes(s, 'utf-8') + b'\x00' if isinstance(s, str) else b'\x00'
 
 
-def decode_zstring(data: bytes, start_idx: int) -> tuple:  # tuple(str, int)
-    """Decodes a zero-terminated byte string from data starting at start_idx."""
-    s = []
-    idx = start_idx
-    while idx < len(data) and data[idx] != 0:
-        s.append(chr(data[idx]))
-        idx += 1
-    idx += 1  # skip zero terminator
-    return ''.join(s), idx
-
-
-# def receive_tunnel():
-#     global appdata_last_data
-#     try:
-#         data = appdata.get_bytes()
-#         if len(data) == 0 or data[0] == 0 or \
-#                 data[:APPDATA_MTU] == appdata_last_data[:APPDATA_MTU]:
-#             return None, None
-#         appdata_last_data = data
-#         decoded = decode_tunnel(data)
-#         # TODO: only react on full frames!
-#         msgtype, message = decode_message_raw(decoded)
-#         # should somehow reset the buffer - appdata.reset()
-#         return msgtype, message
-#     except Exception as e:
-#         # print(e)
-#         # raise e
-#         return type(None), None
+def decode_zstring(buf, offset: int) -> tuple:  # tuple(str, int)
+    """
+    Decodes a zero-terminated UTF-8 string from buf starting at offset.
+    Searches the terminator, then decodes the bytes at once without copying.
+    Returns the string and the offset after the terminator.
+    """
+    end = offset
+    n = len(buf)
+    while end < n and buf[end] != 0:
+        end += 1
+    return str(buf[offset:end], 'utf-8'), end + 1
 
 
-def decode_message_raw(data: list[bytes]):
-    if len(data) < 2:
+def encode_value(v, deferred: bool = False) -> tuple:  # tuple(number, bytes)
+    """
+    Encodes a variable value, returns vartype and data, None for other types.
+    deferred: strings longer than _DAP_INLINE_STRING are sent as their size only.
+    Lists, tuples and dicts are sent as their first page once negotiated.
+    Compact values send ints and floats with few decimals as varints.
+    """
+    if isinstance(v, bool):
+        return _VAR_BOOL, b'\x01' if v else b'\x00'
+    elif isinstance(v, int):
+        if compact_values:
+            data = bytearray()
+            put_varint(data, v)
+            return _VAR_VARINT, data
+        return _VAR_INT, pack('<i', v)
+    elif isinstance(v, float):
+        n = scaled(v) if compact_values else None
+        if n is not None:
+            data = bytearray()
+            put_varint(data, n)
+            return _VAR_DECIMAL, data
+        return _VAR_FLOAT, pack('<f', v)
+    elif isinstance(v, str):
+        if deferred and len(v) > _DAP_INLINE_STRING:
+            return _VAR_STRING | _VAR_DEFERRED, pack('<H', min(len(v), 0xFFFF))
+        return _VAR_STRING, encode_zstring(v)
+    elif v is None:
+        return _VAR_NONE, b''
+    elif containers:
+        vartype = container_type(v)
+        if vartype is not None:
+            parts = bytearray()
+            encode_page(parts, v, 0, _DAP_PAGE, _DAP_DEPTH - 1, deferred,
+                        [_DAP_VALUE_ELEMENTS])
+            return vartype, parts
+    return None, None
+
+
+def container_type(v):
+    # vartype of a list, tuple or dict, None for other values
+    if isinstance(v, list):
+        return _VAR_LIST
+    elif isinstance(v, tuple):
+        return _VAR_TUPLE
+    elif isinstance(v, dict):
+        return _VAR_DICT
+    return None
+
+
+def container_item(v, i: int):
+    # i-th element of a list or tuple, value of the i-th item of a dict
+    if isinstance(v, dict):
+        for k in v:
+            if i == 0:
+                return v[k]
+            i -= 1
+        raise IndexError()
+    return v[i]
+
+
+def encode_page(parts, v, start: int, count: int, depth: int, deferred: bool, budget: list):
+    """
+    Appends a page of the list, tuple or dict v to parts: u16 length, u16 start,
+    u8 count, then count elements as vartype and value, dict items as key and
+    value. Nested containers get their first page while depth and the element
+    budget (budget[0], shared by all levels) last, otherwise count 0.
+    """
+    n = len(v)
+    count = max(0, min(count, n - start, budget[0], _MAX_COUNT_VALUES))
+    budget[0] -= count
+    parts += pack('<HHB', min(n, 0xFFFF), start, count)
+    if isinstance(v, dict):
+        i = 0
+        for k in v:
+            if i >= start + count:
+                break
+            if i >= start:
+                encode_element(parts, k, depth, deferred, budget)
+                encode_element(parts, v[k], depth, deferred, budget)
+            i += 1
+    else:
+        for i in range(start, start + count):
+            encode_element(parts, v[i], depth, deferred, budget)
+
+
+def encode_element(parts, v, depth: int, deferred: bool, budget: list):
+    # appends vartype and value of a container element, other types as their type name
+    vartype = container_type(v)
+    if vartype is not None:
+        parts.append(vartype)
+        encode_page(parts, v, 0, _DAP_PAGE if depth > 0 else 0, depth - 1, deferred, budget)
+        return
+    vartype, data = encode_value(v, deferred)
+    if vartype is None:
+        vartype, data = encode_value(str(type(v)), deferred)
+    parts.append(vartype)
+    parts += data
+
+
+def decode_value(buf, offset: int, vartype: int) -> tuple:  # tuple(value, int)
+    """Decodes a variable value of vartype from buf, returns value and new offset."""
+    if vartype == _VAR_INT:
+        return unpack_from('<i', buf, offset)[0], offset + 4
+    elif vartype == _VAR_FLOAT:
+        return unpack_from('<f', buf, offset)[0], offset + 4
+    elif vartype == _VAR_BOOL:
+        return buf[offset] != 0, offset + 1
+    elif vartype == _VAR_STRING:
+        return decode_zstring(buf, offset)
+    return None, offset
+
+
+def decode_message_raw(buf, offset: int = 0) -> tuple:  # tuple(number, tuple, int)
+    """
+    Decodes a message from host/pc to hub/me starting at offset of buf.
+    Returns message type, decoded message and the offset after the message.
+    """
+    if len(buf) - offset < 2:
         raise ValueError()  # "Data too short to decode"
-    msg_type = data[0]
-    # print("decode_message_raw", msg_type, data, _DEBUG_ACKNOWLEDGE) # !!
+    msg_type = buf[offset]
+    # print("decode_message_raw", msg_type, _format_bytes(buf)) # !!
     if msg_type == _DEBUG_ACKNOWLEDGE:
-        return (msg_type, decode_debug_message_raw(data))
-    # elif msg_type == PLOT_ACKNOWLEDGE:
-    #     return (msg_type, True)
-    return (None, None)
-
-
-# plot_columns = []
-
-
-# def encode_plot_message_raw(message) -> bytes:
-#     subcode = message[0]
-#     parts = bytearray()
-#     parts.append(PLOT_NOTIFICATION)
-#     parts.append(subcode)
-
-#     if subcode == PLOT_UPDATE_CELLS:
-#         # [name, value]
-#         plotdata = message[1][:MAX_COUNT_VALUES]  # max 255 columns
-#         parts.append(len(plotdata))  # count
-#         for name, value in plotdata:
-#             parts += encode_zstring(name)  # name
-#             parts += pack('<f', value)  # always float
-#             if not name in plot_columns:
-#                 plot_columns.append(name)
-
-#     elif subcode == PLOT_UPDATE_ROW:
-#         # [value]
-#         values = message[1][:MAX_COUNT_VALUES]  # max 255 columns
-#         values = values[0:len(plot_columns)]  # truncate to known columns
-#         parts.append(len(values))
-#         for value in values:
-#             parts += pack('<f', value)
-
-#     elif subcode == PLOT_DEFINE:
-#         # [name]
-#         names = message[1][:MAX_COUNT_VALUES]  # max 255 columns
-#         parts.append(len(names))
-#         for name in names:
-#             parts += encode_zstring(name)
-#             if not name in plot_columns:
-#                 plot_columns.append(name)
-
-#     return bytes(parts)
+        message, offset = decode_debug_message_raw(buf, offset)
+        return msg_type, message, offset
+    elif msg_type == _PLOT_ACKNOWLEDGE:
+        message, offset = decode_plot_message_raw(buf, offset)
+        return msg_type, message, offset
+    return None, None, offset
+
+
+def decode_plot_message_raw(buf, offset: int) -> tuple:  # tuple(tuple, int)
+    """
+    Decodes a plot message from host/pc to hub/me at offset of buf.
+    Returns a tuple (subcode, ...) and the offset after the message.
+    """
+    subcode = buf[offset + 1]
+    if subcode == _PLOT_DOWNSAMPLE_REQ:
+        bucket, count = buf[offset + 2], buf[offset + 3]
+        offset += 4
+        return (subcode, bucket, bytes(buf[offset:offset + count])), offset + count
+    # if subcode == _PLOT_ACK: # nothing to add
+    return (subcode,), offset + 2
+
+
+def encode_plot_message_raw(message) -> bytes:
+    """
+    Encodes a plot message from hub/me to host/pc.
+    message: [subcode, data], data depends on subcode:
+    DEFINE: column names, UPDATE_CELLS: (name, value) pairs,
+    UPDATE_ROW: values in column order. Batched rows, see plot_row.
+    """
+    subcode = message[0]
+    parts = bytearray()
+    parts.append(_PLOT_NOTIFICATION)
+    parts.append(subcode)
+
+    if subcode == _PLOT_UPDATE_CELLS:
+        # [name, value]
+        plotdata = message[1][:_MAX_COUNT_VALUES]  # max 255 columns
+        parts.append(len(plotdata))  # count
+        for name, value in plotdata:
+            parts += encode_zstring(name)  # name
+            parts += pack('<f', value)  # always float
+
+    elif subcode == _PLOT_UPDATE_ROW:
+        # [value]
+        values = message[1][:_MAX_COUNT_VALUES]  # max 255 columns
+        parts.append(len(values))
+        for value in values:
+            parts += pack('<f', value)
+
+    elif subcode == _PLOT_DEFINE:
+        # [name]
+        names = message[1][:_MAX_COUNT_VALUES]  # max 255 columns
+        parts.append(len(names))
+        for name in names:
+            parts += encode_zstring(name)
+
+    return bytes(parts)
 
 
 def encode_debug_message_raw(message) -> bytes:
@@ -245,36 +402,23 @@ def encode_debug_message_raw(message) -> bytes:
     subcode = message[0]
     rest = message[1:]
     parts.append(subcode)
-    # if subcode == DEBUG_START_NOTIF: # nothing to add
+    if subcode == _DEBUG_START_NOTIF:
+        # capabilities: u16, ignored by hosts without negotiation
+        parts += pack('<H', _DAP_CAPS)
     # if subcode == DEBUG_CONTINUE_RESP: # nothing to add
     # if subcode == DEBUG_TERM_RESP: # nothing to add
     if subcode == _DEBUG_TRAP_NOTIF:
-        # trap: filename, line, variables
-        filename, line, exposed_keys, exposed_values = rest
+        # trap: filename, line, variables, deferred (optional, see encode_value)
+        filename, line, exposed_keys, exposed_values = rest[:4]
+        deferred = len(rest) > 4 and rest[4]
         parts += encode_zstring(filename)
         parts += pack('<H', line)
         counter_position = len(parts)
         parts.append(0)  # remember counter
         for i in range(len(exposed_keys)):
             exposed_var = exposed_keys[i]
-            v = exposed_values[i]
-            # parts.append(vartype)
-            if isinstance(v, int):
-                vartype = _VAR_INT
-                data = pack('<i', v)
-            elif isinstance(v, float):
-                vartype = _VAR_FLOAT
-                data = pack('<f', v)
-            elif isinstance(v, str):
-                vartype = _VAR_STRING
-                data = encode_zstring(v)
-            elif isinstance(v, bool):
-                vartype = _VAR_BOOL
-                data = bytes([1 if v else 0])
-            elif v is None:
-                vartype = _VAR_NONE
-                data = b''
-            else:  # v is some format we do not want to handle
+            vartype, data = encode_value(exposed_values[i], deferred)
+            if vartype is None:  # v is some format we do not want to handle
                 continue
             parts[counter_position] += 1
             parts += encode_zstring(exposed_var)
@@ -283,14 +427,29 @@ def encode_debug_message_raw(message) -> bytes:
             if parts[counter_position] >= _MAX_COUNT_VALUES:  # max 256 variables
                 break
 
-    # elif subcode == DEBUG_GETVAR_RESP:
-    #     # get variable response: name, varvalue
-    #     name, varvalue = rest
-    #     pytype = type(varvalue)
-    #     vartype, encoder = VARIABLE_TYPE_MAP[pytype]
-    #     parts += encode_zstring(name)
-    #     parts.append(vartype)
-    #     parts += encoder(varvalue)
+    elif subcode == _DEBUG_GETVAR_RESP:
+        # get variable response: name, flags, vartype, value (containers: the page)
+        name, found, varvalue, limit, start, count = rest
+        flags = 0 if found else _GETVAR_UNKNOWN
+        vartype = container_type(varvalue)
+        if vartype is not None:
+            parts += encode_zstring(name)
+            parts.append(flags)
+            parts.append(vartype)
+            encode_page(parts, varvalue, start, min(count, _DAP_SLICE_MAX), _DAP_DEPTH - 1,
+                        True, [_DAP_SLICE_MAX])
+            return bytes(parts)
+        if isinstance(varvalue, str) and len(varvalue) > limit:
+            varvalue = varvalue[:limit]
+            flags |= _GETVAR_TRUNCATED
+        vartype, data = encode_value(varvalue)
+        if vartype is None:
+            vartype, data = _VAR_NONE, b''
+            flags |= _GETVAR_UNKNOWN
+        parts += encode_zstring(name)
+        parts.append(flags)
+        parts.append(vartype)
+        parts += data
 
     elif subcode == _DEBUG_SETVAR_RESP:
         # set variable response: error message
@@ -300,53 +459,151 @@ def encode_debug_message_raw(message) -> bytes:
     return bytes(parts)
 
 
-def decode_debug_message_raw(data: list[bytes]):
+def decode_debug_message_raw(buf, offset: int) -> tuple:  # tuple(tuple, int)
     """
-    Decodes a debug message from hub/me to pc.
-    Returns a list or tuple, format depends on subcode
+    Decodes a debug message from host/pc to hub/me at offset of buf.
+    Returns a tuple (subcode, ...) and the offset after the message.
     """
-    # If data is a list of bytes chunks, assemble into a single bytes object
-    if len(data) < 3:
+    if len(buf) - offset < 2:  # TERM_REQ and BREAKPOINTS_DONE have no payload
         raise ValueError()
-    subcode = data[1]
-    rest = data[2:]
-    # print("Appdata complete message received:", _format_bytes(data))  # !!
+    subcode = buf[offset + 1]
+    offset += 2
+    # print("Appdata complete message received:", _format_bytes(buf))  # !!
     if subcode == _DEBUG_START_ACK:
-        # start ack: success in connect to debugger
-        success = rest[0] != 0
-        return (subcode, success)
+        # start ack: success in connect to debugger, capabilities (optional)
+        flags = buf[offset]
+        if flags & _START_ACK_CAPS:
+            return (subcode, True, unpack_from('<H', buf, offset + 1)[0]), offset + 3
+        return (subcode, flags != 0, 0), offset + 1
     elif subcode == _DEBUG_TRAP_ACK:
         # trap ack: success
-        success = rest[0] != 0
-        return (subcode, success)
+        return (subcode, buf[offset] != 0), offset + 1
     elif subcode == _DEBUG_CONTINUE_REQ:
         # trap ack: continue/exit_debug
-        step = rest[0] != 0
-        return (subcode, step)
-    # elif subcode == DEBUG_GETVAR_REQ:
-    #     # get variable request: name
-    #     name, _ = decode_zstring(rest, 0)
-    #     return (subcode, name)
+        return (subcode, buf[offset] != 0), offset + 1
+    elif subcode == _DEBUG_GETVAR_REQ:
+        # get variable request: name, u16 size limit of strings,
+        # container page: u16 start, u8 count, u8 depth, depth x u16 element index
+        name, offset = decode_zstring(buf, offset)
+        limit, start, count, depth = unpack_from('<HHBB', buf, offset)
+        offset += 6
+        path = [unpack_from('<H', buf, offset + 2 * i)[0] for i in range(depth)]
+        return (subcode, name, limit, start, count, path), offset + 2 * depth
     elif subcode == _DEBUG_SETVAR_REQ:
         # set variable request: name, vartype, varvalue
-        name, index = decode_zstring(rest, 0)
-        vartype = rest[index]
-        varvalue_data = rest[index + 1:]
-        varvalue = None
-        if vartype == _VAR_INT and len(varvalue_data) >= 4:
-            varvalue = unpack('<i', varvalue_data[:4])[0]
-        elif vartype == _VAR_FLOAT and len(varvalue_data) >= 4:
-            varvalue = unpack('<f', varvalue_data[:4])[0]
-        elif vartype == _VAR_BOOL:
-            varvalue = varvalue_data[0] != 0
-        elif vartype == _VAR_STRING:
-            varvalue, index = decode_zstring(varvalue_data, 0)
-        # elif vartype == VAR_NONE:
-        #     varvalue = None
-        # index increments - not needed as we only set one variable here
-        return (subcode, name, vartype, varvalue)
-    elif subcode == _DEBUG_TERM_REQ:
-        return (subcode)
+        name, offset = decode_zstring(buf, offset)
+        vartype = buf[offset]
+        varvalue, offset = decode_value(buf, offset + 1, vartype)
+        return (subcode, name, vartype, varvalue), offset
+    elif subcode == _DEBUG_TERM_REQ or subcode == _DEBUG_BREAKPOINTS_DONE:
+        return (subcode,), offset
+    elif subcode == CREDIT_GRANT:
+        # credit grant: u16 chunks received, u8 window - see aipp.CreditGate
+        received, window = unpack_from('<HB', buf, offset)
+        return (subcode, received, window), offset + 3
+    elif subcode == _DEBUG_BREAKPOINTS_REQ or subcode == _DEBUG_LOGPOINTS_REQ:
+        # breakpoints/logpoints: flags, filename, u16 bitmap length, bitmap (bit n: line n)
+        flags = buf[offset]
+        filename, offset = decode_zstring(buf, offset + 1)
+        n = unpack_from('<H', buf, offset)[0]
+        offset += 2
+        # copied, buf is the reassembly buffer
+        return (subcode, flags, filename, bytes(buf[offset:offset + n])), offset + n
+    elif subcode == _DEBUG_CONDITION_REQ:
+        # condition: filename, u16 line, hit op, u16 hit count,
+        # variable name ('' = none), compare op, vartype, value
+        filename, offset = decode_zstring(buf, offset)
+        line, hit_op, hit_value = unpack_from('<HBH', buf, offset)
+        varname, offset = decode_zstring(buf, offset + 5)
+        cmp_op = buf[offset]
+        value, offset = decode_value(buf, offset + 2, buf[offset + 1])
+        return (subcode, filename, line, hit_op, hit_value, varname, cmp_op, value), offset
+    return None, offset
+
+
+# session string table: ids of filenames and variable names, in id order
+string_ids = {}
+string_list = []
+strings_known = 0  # ids the host acknowledged a definition of
+# variable id -> value of the last acknowledged trap
+sent_values = {}
+delta_pending = None  # (string count, ids, values) of the trap awaiting its ack
+
+
+def string_id(s: str):
+    # returns the id of s in the string table, None once the table is full
+    i = string_ids.get(s)
+    if i is None and len(string_list) < _DAP_STRINGS:
+        i = len(string_list)
+        string_ids[s] = i
+        string_list.append(s)
+    return i
+
+
+def encode_trap_delta(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
+    """
+    Encodes a TRAP_DELTA_NOTIF: new string table entries, then the filename
+    and variable names as one byte ids; values equal to the last
+    acknowledged trap are flagged unchanged instead of sent.
+    Returns None when the string table is full.
+    """
+    global delta_pending
+    fid = string_id(file)
+    if fid is None:
+        return None
+    ids = []
+    for k in exposed_keys:
+        i = string_id(k)
+        if i is None:
+            return None
+        ids.append(i)
+    parts = bytearray()
+    parts.append(_DEBUG_NOTIFICATION)
+    parts.append(_DEBUG_TRAP_DELTA_NOTIF)
+    parts.append(len(string_list) - strings_known)  # definitions: id, zstring
+    for i in range(strings_known, len(string_list)):
+        parts.append(i)
+        parts += encode_zstring(string_list[i])
+    parts.append(fid)
+    parts += pack('<H', lineno)
+    counter_position = len(parts)
+    parts.append(0)
+    for n in range(len(ids)):
+        v = exposed_values[n]
+        vartype, data = encode_value(v, lazy_values)
+        if vartype is None:
+            continue
+        i = ids[n]
+        old = sent_values.get(i, sent_values)  # sent_values: never sent
+        parts.append(i)
+        # containers may have changed in place, they are sent every time
+        if type(old) is type(v) and old == v and container_type(v) is None:
+            parts.append(vartype | _VAR_UNCHANGED)
+        else:
+            parts.append(vartype)
+            parts += data
+        parts[counter_position] += 1
+        if parts[counter_position] >= _MAX_COUNT_VALUES:
+            break
+    delta_pending = (len(string_list), ids, exposed_values)
+    return bytes(parts)
+
+
+def trap_delta_commit(acknowledged: bool):
+    # the host decoded the pending trap: it knows its strings and values now;
+    # without an acknowledge it may have decoded it anyway, so start over
+    global strings_known, delta_pending
+    if delta_pending is None:
+        return
+    if acknowledged:
+        known, ids, values = delta_pending
+        strings_known = known
+        for n in range(len(ids)):
+            sent_values[ids[n]] = values[n]
+    else:
+        strings_known = 0
+        sent_values.clear()
+    delta_pending = None
 
 
 # endregion AIPP Protocol handling
@@ -356,60 +613,238 @@ def decode_debug_message_raw(data: list[bytes]):
 # region AIPP Debugger Tunnel Waiting
 
 appdata = AppData('<BBBBBBBBBBBBBBBBBBB')  # 19*B
+tunnel_writer = TunnelWriter(appdata)
+# log batches and plot rows share frames once CAP_COALESCE is negotiated
+coalescer = Coalescer(send_tunnel_frame, StopWatch(), _DAP_COALESCE)
+reassembler = Reassembler()
+poll = PollScheduler(_DAP_POLL_FAST, _DAP_TUNNEL_WAIT)  # poll.counts: intervals used
+seq_link = None  # aipp.SeqLink once CAP_SEQ is negotiated, legacy framing otherwise
+# last chunk polled; AppData keeps returning it until the host writes again.
+# With sequenced frames equal chunks are always the same transmission.
 appdata_last_data = b''
 # todo add init appdata, for now - ignore user created AppData
 
+# filename -> breakpoint bitmap sent by the host, files without one trap nowhere
+breakpoints = {}
+breakpoints_done = False  # host sent the bitmaps of all files (BREAKPOINTS_DONE)
+# filename -> {line: [hit op, hit count, hits, variable name, compare op, value]}
+conditions = {}
+# filename -> bitmap of the enabled lines that log instead of stopping
+logpoints = {}
+log_queue = []  # encoded TRAP_NOTIF snapshots of logpoints, oldest first
+log_dropped = 0  # snapshots dropped from the full queue, sent in every LOG_NOTIF
+log_watch = StopWatch()
+log_sent_at = -_DAP_LOG_INTERVAL
+stepping = False  # host asked to stop at the next trap
+trap_countdown = _DAP_BREAKPOINT_POLL  # disabled traps until the next poll
+
 hub = ThisHub()
 
 
+def read_tunnel():
+    """
+    Reads a new chunk from AppData once without waiting.
+    Returns the reassembled message once its last chunk (0x00) arrived,
+    otherwise None. Also polled by the CreditGate while a send waits.
+    """
+    global appdata_last_data
+    data = appdata.get_bytes()
+    # if data[:_APPDATA_MTU] != appdata_last_data[:_APPDATA_MTU]:
+    #     print("received data", _format_bytes(data))  # !!
+    if len(data) > 0 and \
+            data[:_APPDATA_MTU] != appdata_last_data[:_APPDATA_MTU]:
+        appdata_last_data = data
+        poll.activity()
+        return reassembler.feed(data)
+    return None
+
+
+def receive_tunnel() -> tuple:  # tuple(number, tuple)
+    """
+    Polls AppData once without waiting.
+    Returns message type and message once a new message is complete,
+    otherwise None, None.
+    """
+    global breakpoints_done
+    try:
+        # messages received while a send waited for credits come first
+        credits = tunnel_writer.credits
+        decoded = credits.receive() if credits else read_tunnel()
+        if decoded is not None and seq_link:
+            # acks, duplicates and early frames are consumed here
+            decoded = seq_link.receive(decoded)
+        if decoded is not None:
+            # print("decoded", _format_bytes(decoded)) # !!
+            msgtype, message, _ = decode_message_raw(decoded)
+            if msgtype == _DEBUG_ACKNOWLEDGE and \
+                    (message[0] == _DEBUG_BREAKPOINTS_REQ or message[0] == _DEBUG_LOGPOINTS_REQ):
+                # applied whoever polls: a trap waiting, or a disabled trap
+                set_breakpoints(message)
+                return None, None
+            if msgtype == _DEBUG_ACKNOWLEDGE and message[0] == _DEBUG_CONDITION_REQ:
+                set_condition(message)
+                return None, None
+            if msgtype == _DEBUG_ACKNOWLEDGE and message[0] == _DEBUG_BREAKPOINTS_DONE:
+                breakpoints_done = True
+                return None, None
+            if msgtype == _DEBUG_ACKNOWLEDGE and message[0] == CREDIT_GRANT:
+                if tunnel_writer.credits:
+                    tunnel_writer.credits.grant(message[1], message[2])
+                return None, None
+            if msgtype == _PLOT_ACKNOWLEDGE and message[0] == _PLOT_DOWNSAMPLE_REQ:
+                plot_downsample(message[1], message[2])
+                return None, None
+            return msgtype, message
+    except:
+        # raise e # !!
+        pass
+    return None, None
+
+
+def set_breakpoints(message):
+    global stepping
+    subcode, flags, filename, bitmap = message
+    if subcode == _DEBUG_LOGPOINTS_REQ:
+        logpoints[filename] = bitmap
+        return
+    breakpoints[filename] = bitmap
+    # the host sends logpoints and conditions of the file again after its bitmap
+    logpoints.pop(filename, None)
+    conditions.pop(filename, None)
+    if flags & _BREAKPOINTS_STEP:
+        stepping = True
+
+
+def set_condition(message):
+    _subcode, filename, line, hit_op, hit_value, varname, cmp_op, value = message
+    lines = conditions.setdefault(filename, {})
+    if hit_op == _HIT_ANY and not varname:
+        lines.pop(line, None)
+    else:
+        lines[line] = [hit_op, hit_value, 0, varname, cmp_op, value]
+
+
+def condition_fires(cond, exposed_keys: tuple, exposed_values: list) -> bool:
+    """
+    Evaluates a breakpoint condition on the hub, counting its hits.
+    Returns True if the trap should stop. A comparison that can not be
+    evaluated (variable not exposed, incomparable types) fires.
+    """
+    hit_op, n, hits, varname, cmp_op, value = cond
+    if varname:
+        try:
+            v = exposed_values[exposed_keys.index(varname)]
+            if cmp_op == _CMP_EQ:
+                passed = v == value
+            elif cmp_op == _CMP_NE:
+                passed = v != value
+            elif cmp_op == _CMP_LT:
+                passed = v < value
+            elif cmp_op == _CMP_LE:
+                passed = v <= value
+            elif cmp_op == _CMP_GT:
+                passed = v > value
+            else:
+                passed = v >= value
+            if not passed:
+                return False
+        except (ValueError, TypeError):
+            pass
+    hits += 1
+    cond[2] = hits
+    if hit_op == _HIT_GE:
+        return hits >= n
+    elif hit_op == _HIT_EQ:
+        return hits == n
+    elif hit_op == _HIT_MOD:
+        return n == 0 or hits % n == 0
+    return True
+
+
+def log_snapshot(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
+    # queues a logpoint hit without waiting for the host
+    global log_dropped
+    if len(log_queue) >= _DAP_LOG_QUEUE:
+        log_queue.pop(0)
+        log_dropped += 1
+    log_queue.append(encode_debug_message_raw(
+        [_DEBUG_TRAP_NOTIF, file, lineno, exposed_keys, exposed_values]))
+    log_flush()
+
+
+def log_flush():
+    """
+    Sends queued logpoint snapshots batched in one LOG_NOTIF if the link has
+    room: few unacknowledged sequenced frames, or some time since the last
+    batch without them.
+    LOG_NOTIF: u16 dropped, u8 count, count x (u16 length, TRAP_NOTIF message)
+    """
+    global log_sent_at
+    if not log_queue:
+        return
+    if seq_link:
+        if len(seq_link.frames) >= _DAP_LOG_FRAMES:
+            return
+    elif log_watch.time() - log_sent_at < _DAP_LOG_INTERVAL:
+        return
+    batch = bytearray(pack('<BBHB', _DEBUG_NOTIFICATION, _DEBUG_LOG_NOTIF,
+                           log_dropped & 0xFFFF, 0))
+    count = 0
+    while log_queue and count < _MAX_COUNT_VALUES and \
+            (count == 0 or len(batch) + 2 + len(log_queue[0]) <= _DAP_LOG_BATCH):
+        snapshot = log_queue.pop(0)
+        batch += pack('<H', len(snapshot))
+        batch += snapshot
+        count += 1
+    batch[4] = count
+    queue_tunnel_aipp(batch)
+    log_sent_at = log_watch.time()
+
+
+def debug_tunnel_service():
+    # polled from disabled traps: picks up breakpoint updates, sends pending acks
+    # and logpoint snapshots
+    global trap_countdown
+    receive_tunnel()
+    if seq_link:
+        seq_link.poll()
+    log_flush()
+    coalescer.poll()
+    # keep polling on every call while a frame is half received
+    trap_countdown = 1 if reassembler.active else _DAP_BREAKPOINT_POLL
+
+
 def tunnel_wait(expected: list, message_to_send: bytes = None, timeout: int = -1) -> tuple:  # tuple(number, list)
     # print("tunnel_wait", expected, timeout) # !!
 
-    global appdata_last_data
     # target_message_type -> lambda / or subcode
     timer = 0
-    chunks = []
+    elapsed = 0  # ms waited, timeout and resends count in _DAP_TUNNEL_WAIT units
+    resend_at = 0
     while True:
-        # msgtype, message = receive_tunnel()
-        # inlined - receive_tunnel
-        msgtype, message = None, None
-        try:
-            data = appdata.get_bytes()
-            # if len(data) > 0 and data[0] != 0x00 and \
-            #         data[:APPDATA_MTU] != appdata_last_data[:APPDATA_MTU]:
-            # if data[:_APPDATA_MTU] != appdata_last_data[:_APPDATA_MTU]:
-            #     print("received data", _format_bytes(data), chunks)  # !!
-            if len(data) > 0 and \
-                    data[:_APPDATA_MTU] != appdata_last_data[:_APPDATA_MTU] and \
-                    data[0] in (0xFE, 0xFF) and data[-1] in (0x00, 0xFF):
-                appdata_last_data = data
-                # start decoding once we receive a completion (last byte is 0x00)
-                chunks.append(data)
-                if data[-1] == 0x00:
-                    decoded = decode_tunnel(chunks)
-                    # print("decoded", decoded) # !!
-                    # TODO: only react on full frames!
-                    # should somehow reset the buffer - appdata.reset()
-                    msgtype, message = decode_message_raw(decoded)
-                elif data[-1] != 0xFF:
-                    chunks = []
-        except:
-            # raise e # !!
-            # return type(None), None
-            # msgtype, message = type(None), None
-            pass
+        msgtype, message = receive_tunnel()
 
         # matching mesage received, note: this only handles msgtype and subcode - should be ok
         # print("tunnel_wait received", msgtype, message) # !!
         if not message is None:
-            if not isinstance(expected, (list, tuple)) or \
-                    len(expected) <= 1 or message[0] == expected[1] or expected[1] is None:
+            if not isinstance(expected, (list, tuple)) or msgtype == expected[0] and \
+                    (len(expected) <= 1 or expected[1] is None or message[0] == expected[1]):
                 # print("tunnel_wait returning", msgtype, message) # !!
                 return msgtype, message
 
-        if (not message_to_send is None) and (timer % _DAP_REPEAT_COUNT == 0):
+        if (not message_to_send is None) and \
+                (timer == 0 if seq_link else elapsed >= resend_at):
             # print("tunnel_wait sending", _format_bytes(message_to_send)) # !!
+            # sequenced frames are retransmitted by seq_link.poll() instead
             send_tunnel_aipp(message_to_send)
+            resend_at += _DAP_REPEAT_COUNT * _DAP_TUNNEL_WAIT
+            poll.activity()
+        if seq_link:
+            sent = seq_link.retransmits
+            seq_link.poll()
+            if seq_link.retransmits != sent:
+                poll.activity()
+        log_flush()  # logpoint hits before this trap
 
         timer += 1
 
@@ -431,13 +866,15 @@ def tunnel_wait(expected: list, message_to_send: bytes = None, timeout: int = -1
             pass
 
         # timeout handling
-        if timeout >= 0 and timer > timeout:
+        if timeout >= 0 and elapsed > timeout * _DAP_TUNNEL_WAIT:
             # print("tunnel_wait timeout") # !!
             return None, None
 
-        # wait a bit to avoid busy loop
-        wait(_DAP_TUNNEL_WAIT if data[-1] !=
-             0xFF else _DAP_TUNNEL_CONTINUATION_WAIT)
+        # wait to avoid busy loop: fast after activity, backing off while idle,
+        # fast while a frame is incomplete
+        interval = poll.next(reassembler.active)
+        elapsed += interval
+        wait(interval)
 
 
 # endregion AIPP Debugger Tunnel Waiting
@@ -448,6 +885,15 @@ def tunnel_wait(expected: list, message_to_send: bytes = None, timeout: int = -1
 
 initialized = False
 handshaken = False
+trap_delta = False  # TRAP_DELTA_NOTIF negotiated (_CAP_TRAP_DELTA)
+lazy_values = False  # traps defer larger values (_CAP_LAZY_VALUES)
+containers = False  # lists, tuples and dicts are sent paged (_CAP_CONTAINERS)
+compact_values = False  # ints and decimal floats are sent as varints (CAP_COMPACT)
+# the START handshake runs in the background of the user program:
+# handshake_watch is set while it is pending, see debug_tunnel_step
+handshake_watch = None
+handshake_resend_at = 0
+handshake_grace = _DAP_HANDSHAKE_GRACE
 
 
 def debug_tunnel_init():
@@ -461,7 +907,7 @@ def debug_tunnel_init():
             return False
 
         initialized = True
-        handshaken = debug_tunnel_start_handshake()
+        debug_tunnel_start_handshake()
     except:
         # raise e  # !!
         initialized = False
@@ -470,22 +916,73 @@ def debug_tunnel_init():
 
 
 def debug_tunnel_start_handshake():
-    # print("Waiting for debugger start acknowledge") # !!
-    # send_tunnel_aipp(encode_debug_message_raw([DEBUG_START_NOTIF]))
-    response_msgtype, response_msg = debug_tunnel_channel_wait(_DEBUG_START_ACK,
-                                                               encode_debug_message_raw(
-                                                                   [_DEBUG_START_NOTIF]),
-                                                               _DAP_TIMEOUT, True)
-    if response_msg is None or not response_msg[1]:
-        # nack for Init
-        # print("Server negatively acknowledged debugger start") # !!
-        retval = False
-    else:
-        retval = True
-        # print("Server acknowledged debugger start") # !!
+    # sends the start notification and returns at once,
+    # the handshake advances with every debug_tunnel_step call
+    global handshake_watch, handshake_resend_at
+    handshake_watch = StopWatch()
+    handshake_resend_at = 0
+    debug_tunnel_step()
+
+
+def debug_tunnel_step():
+    """
+    Advances a pending START handshake without blocking: polls once for the
+    acknowledge, resends the notification every _DAP_REPEAT_COUNT cycles and
+    gives up after _DAP_TIMEOUT cycles. Returns True once handshaken.
+    """
+    global handshake_watch, handshake_resend_at, handshaken, seq_link, trap_delta, \
+        lazy_values, containers, compact_values
+    if handshake_watch is None:
+        return handshaken
+    msgtype, message = receive_tunnel()
+    if msgtype == _DEBUG_ACKNOWLEDGE and message[0] == _DEBUG_START_ACK:
+        handshake_watch = None
+        # print("Server acknowledged debugger start", message[1]) # !!
+        handshaken = message[1]
+        # switch to sequenced frames if the host supports them
+        if handshaken and message[2] & _DAP_CAPS & CAP_SEQ:
+            seq_link = SeqLink(tunnel_writer, StopWatch())
+        trap_delta = handshaken and message[2] & _CAP_TRAP_DELTA != 0
+        lazy_values = handshaken and message[2] & _CAP_LAZY_VALUES != 0
+        containers = handshaken and message[2] & _CAP_CONTAINERS != 0
+        compact_values = handshaken and message[2] & CAP_COMPACT != 0
+        # length and CRC-8 framing, incoming frames are told apart by marker
+        tunnel_writer.crc = handshaken and message[2] & CAP_CRC != 0
+        coalescer.enabled = handshaken and message[2] & CAP_COALESCE != 0
+        # chunks paced by credits the host grants, by a fixed wait otherwise
+        tunnel_writer.credits = CreditGate(read_tunnel, StopWatch()) \
+            if handshaken and message[2] & CAP_CREDITS else None
+        tunnel_writer.pace_ms = 0 if tunnel_writer.credits else _DAP_PACE_MS
+        return handshaken
 
-    # cls._silent = result[0] != "True"
-    return retval
+    elapsed = handshake_watch.time()
+    if elapsed > _DAP_TIMEOUT * _DAP_TUNNEL_WAIT:
+        # print("No debugger start acknowledge") # !!
+        handshake_watch = None
+    elif elapsed >= handshake_resend_at:
+        send_tunnel_aipp(encode_debug_message_raw([_DEBUG_START_NOTIF]))
+        handshake_resend_at = elapsed + _DAP_REPEAT_COUNT * _DAP_TUNNEL_WAIT
+        poll.activity()
+    return False
+
+
+def debug_tunnel_wait_handshake():
+    # a trap hit while the handshake is pending waits for it and then for the
+    # breakpoints the host sends after it, in total at most _DAP_HANDSHAKE_GRACE
+    # ms, so breakpoints on the first lines stop once a host answered
+    global handshake_grace
+    done = debug_tunnel_step()
+    while handshake_grace > 0 and not breakpoints_done and \
+            (done or handshake_watch is not None):
+        # the bitmaps are multi-chunk messages the next chunk would overwrite
+        interval = min(1 if done else poll.next(), handshake_grace)
+        handshake_grace -= interval
+        wait(interval)
+        if done:
+            debug_tunnel_service()
+        else:
+            done = debug_tunnel_step()
+    return done
 
 
 # @classmethod
@@ -511,7 +1008,7 @@ def debug_tunnel_start_handshake():
 #         pass
 
 
-def debug_tunnel_channel_wait(target_message_subcode=None, message_to_send=None, timeout: int = -1, allow_unhandshaken=False) -> tuple:  # tuple(number, list)
+def debug_tunnel_channel_wait(target_message_subcode=None, message_to_send=None, timeout: int = -1) -> tuple:  # tuple(number, list)
     """
     Wait for a control line.
     Returns:
@@ -519,7 +1016,7 @@ def debug_tunnel_channel_wait(target_message_subcode=None, message_to_send=None,
       False -> exit or failure
     """
     global initialized, handshaken, hub
-    if not (initialized and (handshaken or allow_unhandshaken)):
+    if not (initialized and handshaken):
         return None, None
     # cls._hub_feedback(None)  # prompt
     # TODO: handle TerminateRequest
@@ -532,11 +1029,40 @@ def dt_trap(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
     file, lineno used for host context.
     variables: locals() dict (mutable)
     exposed: whitelist of variable names and values in a tuple allowed to be set.
+    Returns at once if the host disabled the line in the breakpoint bitmap.
     """
-    global handshaken, initialized, hub
-    if not (initialized and handshaken):
+    global handshaken, initialized, hub, stepping, trap_countdown
+    if not (initialized and (handshaken and breakpoints_done or
+                             debug_tunnel_wait_handshake())):
         return exposed_values
 
+    # disabled trap: early return, polling the host only every few calls
+    if not stepping:
+        bits = breakpoints.get(file, b'')
+        i = lineno >> 3
+        if i >= len(bits) or not bits[i] & (1 << (lineno & 7)):
+            trap_countdown -= 1
+            if trap_countdown <= 0:
+                debug_tunnel_service()
+            return exposed_values
+        # conditional breakpoint: only a firing condition reaches the host
+        cond = conditions.get(file)
+        cond = cond.get(lineno) if cond else None
+        if cond is not None and not condition_fires(cond, exposed_keys, exposed_values):
+            trap_countdown -= 1
+            if trap_countdown <= 0:
+                debug_tunnel_service()
+            return exposed_values
+        # logpoint: queue a snapshot and keep running
+        logs = logpoints.get(file)
+        if logs is not None and i < len(logs) and logs[i] & (1 << (lineno & 7)):
+            log_snapshot(file, lineno, exposed_keys, exposed_values)
+            # snapshots held back wait for acks, no other trap may poll for them
+            trap_countdown -= 1
+            if trap_countdown <= 0 or log_queue:
+                debug_tunnel_service()
+            return exposed_values
+
     # Display current line on hub display
     try:
         hub.display.number(lineno)  # show line number on hub display
@@ -547,12 +1073,18 @@ def dt_trap(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
     # print("Waiting for server acknowledg of trap notification") # !!
     # cache = MAX_COUNT_VALUES  # ___ need this for minification
     # zipped = list(exposed.items())
-    msg = encode_debug_message_raw(
-        [_DEBUG_TRAP_NOTIF, file, lineno, exposed_keys, exposed_values])
+    msg = None
+    if trap_delta:
+        msg = encode_trap_delta(file, lineno, exposed_keys, exposed_values)
+    if msg is None:
+        msg = encode_debug_message_raw(
+            [_DEBUG_TRAP_NOTIF, file, lineno, exposed_keys, exposed_values, lazy_values])
     _msgtype, response = debug_tunnel_channel_wait(
         _DEBUG_TRAP_ACK, msg, _DAP_TIMEOUT)
-    if not response:
-        # nack for Trap - continue
+    trap_delta_commit(response is not None)
+    if not response or not response[1]:
+        # no answer or nack for Trap - continue
+        stepping = False
         return exposed_values
     # print("Server acknowledged trap notification") # !!
 
@@ -566,14 +1098,29 @@ def dt_trap(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
 
         if subcode == _DEBUG_CONTINUE_REQ:
             step = response[1] != 0
-            # if not response is None and not response[1]:
-            #     # step = True, continue = False
-            #     # nothing to do with this now...
+            # step: stop at the next trap, continue: at the next enabled one
+            stepping = step
             send_tunnel_aipp(encode_debug_message_raw(
                 [_DEBUG_CONTINUE_RESP, step]))
             # exit the trap loop
             break
 
+        elif subcode == _DEBUG_GETVAR_REQ:
+            # deferred value or container page, the host expanded it
+            varname, limit, start, count, path = response[1:6]
+            found = varname in exposed_keys
+            varvalue = exposed_values[exposed_keys.index(varname)] if found else None
+            try:
+                for i in path:
+                    varvalue = container_item(varvalue, i)
+            except (IndexError, TypeError):
+                found = False
+                varvalue = None
+            send_tunnel_aipp(encode_debug_message_raw(
+                [_DEBUG_GETVAR_RESP, varname, found, varvalue, min(limit, _DAP_GETVAR_MAX),
+                 start, count]))
+            # continue the trap loop
+
         elif subcode == _DEBUG_SETVAR_REQ:
             varname, vartype, varvalue = response[1:4]
 
@@ -596,6 +1143,7 @@ def dt_trap(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
             # this means a manual trigger (e.g. button) was given to continue
             # print("Manual continue from trap") # !!
             step = True
+            stepping = step
             send_tunnel_aipp(encode_debug_message_raw(
                 [_DEBUG_CONTINUE_RESP, step]))
 
@@ -606,13 +1154,385 @@ def dt_trap(file: str, lineno: int, exposed_keys: tuple, exposed_values: list):
     return exposed_values
 
 
-# auto start debug tunnel
+# auto start debug tunnel, does not wait for the host
 # print("Starting debug tunnel on AIPP.") # !!
 debug_tunnel_init()
 
 # endregion AIPP Debugger Class
 # ------------------------------
 
+# ------------------------------
+# region AIPP Plot
+
+_NAN = float('nan')
+plot_columns = {}  # column name -> index, in the order defined to the host
+plot_cells = []  # the row set with plot_set, NaN for cells not set yet
+# UPDATE_ROWS message of the rows not sent yet, sized by plot_define
+plot_batch = bytearray(_PLOT_ROWS_HEADER)
+plot_view = memoryview(plot_batch)
+plot_rows = 0  # rows in plot_batch
+plot_capacity = 0  # rows fitting in plot_batch
+plot_watch = StopWatch()
+plot_first_at = 0  # plot_watch time of the first and the last row batched
+plot_last_at = 0
+# downsampling: rows per bucket and the policy per column, see plot_downsample
+plot_bucket = 1
+plot_modes = []
+plot_taken = 0  # rows taken into the current bucket
+# per column of the current bucket: values taken (NaN skipped), the first value,
+# the sum or the minimum, the maximum, and whether the minimum came last
+plot_taken_n = []
+plot_lo = []
+plot_hi = []
+plot_min_last = []
+plot_out = []  # the rows of a bucket, the second one for min/max columns
+plot_out_late = []
+
+
+def plot_define(names):
+    """
+    Starts a new plot with the given columns, the host clears its plot.
+    Sends the rows batched so far first, the columns are not downsampled.
+    """
+    global plot_bucket
+    plot_flush()
+    plot_columns.clear()
+    plot_modes.clear()
+    plot_bucket = 1
+    for name in names[:_MAX_COUNT_VALUES]:
+        if name not in plot_columns:
+            plot_columns[name] = len(plot_columns)
+    plot_resize()
+    send_tunnel_aipp(encode_plot_message_raw([_PLOT_DEFINE, list(plot_columns)]))
+
+
+def plot_resize():
+    # preallocates the row and the batch for the current columns
+    global plot_cells, plot_batch, plot_view, plot_capacity, plot_taken_n, plot_lo, \
+        plot_hi, plot_min_last, plot_out, plot_out_late
+    count = len(plot_columns)
+    plot_cells = [_NAN] * count
+    while len(plot_modes) < count:
+        plot_modes.append(PLOT_EVERY)
+    plot_taken_n = [0] * count
+    plot_lo = [_NAN] * count
+    plot_hi = [_NAN] * count
+    plot_min_last = [False] * count
+    plot_out = [_NAN] * count
+    plot_out_late = [_NAN] * count
+    plot_capacity = max(1, (_PLOT_BATCH - _PLOT_ROWS_HEADER) // (4 * max(count, 1)))
+    plot_batch = bytearray(_PLOT_ROWS_HEADER + plot_capacity * count * 4)
+    plot_view = memoryview(plot_batch)
+    plot_batch[0] = _PLOT_NOTIFICATION
+    plot_batch[1] = _PLOT_UPDATE_ROWS
+    plot_batch[3] = count
+
+
+def plot_set(name: str, value):
+    """
+    Sets a cell of the current row, sent with the next plot_row call.
+    An unknown name adds a column.
+    """
+    index = plot_columns.get(name)
+    if index is None:
+        if not plot_columns:
+            plot_define([name])
+        elif len(plot_columns) < _MAX_COUNT_VALUES:
+            # the rows batched so far have fewer columns
+            plot_flush()
+            plot_columns[name] = len(plot_columns)
+            plot_resize()
+            # the host adds the column, NaN does not plot a value
+            send_tunnel_aipp(encode_plot_message_raw(
+                [_PLOT_UPDATE_CELLS, [(name, _NAN)]]))
+        else:
+            return
+        index = plot_columns[name]
+    plot_cells[index] = value
+
+
+def plot_row(values=None):
+    """
+    Adds a row to the batch: values in column order, or the cells set with
+    plot_set since the last row. Missing values are sent as NaN.
+    The batch is sent once full or _PLOT_LATENCY ms after its first row.
+    Once downsampled, a row (two with min/max columns) is added per bucket.
+    """
+    count = len(plot_cells)
+    if not count:
+        return
+    row = plot_cells if values is None else values
+    if plot_bucket > 1:
+        plot_take(row)
+    else:
+        plot_queue(row)
+    if values is None:
+        for i in range(count):
+            plot_cells[i] = _NAN
+    coalescer.poll()
+
+
+def plot_downsample(bucket: int, modes=None):
+    """
+    Sends a row per bucket rows, reduced per column by its policy (PLOT_EVERY,
+    PLOT_MEAN, PLOT_MIN_MAX). modes lists the policies in column order or maps
+    column names to them, _PLOT_KEEP and missing columns keep theirs.
+    The host sets it with DOWNSAMPLE_REQ, the rows taken so far are sent first.
+    """
+    global plot_bucket
+    if plot_taken:
+        plot_reduce()
+    plot_bucket = max(1, bucket)
+    if isinstance(modes, dict):
+        for name, mode in modes.items():
+            if name in plot_columns:
+                plot_modes[plot_columns[name]] = mode
+    elif modes:
+        for i in range(min(len(modes), len(plot_modes))):
+            if modes[i] != _PLOT_KEEP:
+                plot_modes[i] = modes[i]
+
+
+def plot_take(row):
+    # takes a row into the current bucket, reduces it once complete
+    global plot_taken
+    n = min(len(row), len(plot_modes))
+    for i in range(n):
+        v = row[i]
+        if v != v:  # NaN, a cell not set
+            continue
+        taken = plot_taken_n[i]
+        mode = plot_modes[i]
+        if not taken:
+            plot_lo[i] = plot_hi[i] = v
+            plot_min_last[i] = False
+        elif mode == PLOT_MEAN:
+            plot_lo[i] += v
+        elif mode == PLOT_MIN_MAX:
+            if v < plot_lo[i]:
+                plot_lo[i] = v
+                plot_min_last[i] = True
+            elif v > plot_hi[i]:
+                plot_hi[i] = v
+                plot_min_last[i] = False
+        plot_taken_n[i] = taken + 1
+    plot_taken += 1
+    if plot_taken >= plot_bucket:
+        plot_reduce()
+
+
+def plot_reduce():
+    # queues the row of the bucket, min/max columns put their later extreme in
+    # a second row, NaN in the other columns
+    global plot_taken
+    row = plot_out
+    late = plot_out_late
+    extremes = False
+    for i in range(len(plot_modes)):
+        taken = plot_taken_n[i]
+        mode = plot_modes[i]
+        late[i] = _NAN
+        if not taken:
+            row[i] = _NAN
+        elif mode == PLOT_MEAN:
+            row[i] = plot_lo[i] / taken
+        elif mode == PLOT_MIN_MAX and plot_lo[i] != plot_hi[i]:
+            min_last = plot_min_last[i]
+            row[i] = plot_hi[i] if min_last else plot_lo[i]
+            late[i] = plot_lo[i] if min_last else plot_hi[i]
+            extremes = True
+        else:
+            row[i] = plot_lo[i]
+        plot_taken_n[i] = 0
+    plot_taken = 0
+    plot_queue(row)
+    if extremes:
+        plot_queue(late)
+
+
+def plot_queue(row):
+    # packs a row into the batch
+    global plot_rows, plot_first_at, plot_last_at
+    count = len(plot_cells)
+    n = min(len(row), count)
+    offset = _PLOT_ROWS_HEADER + plot_rows * count * 4
+    for i in range(count):
+        pack_into('<f', plot_batch, offset, row[i] if i < n else _NAN)
+        offset += 4
+    plot_last_at = plot_watch.time()
+    if not plot_rows:
+        plot_first_at = plot_last_at
+    plot_rows += 1
+    if plot_rows >= plot_capacity or plot_last_at - plot_first_at >= _PLOT_LATENCY:
+        plot_flush(False)
+
+
+def plot_flush(now: bool = True):
+    """
+    Sends the batched rows in one UPDATE_ROWS message, with the row of a
+    bucket not complete yet. Polls the host for a downsampling request.
+    now=False lets the message share a frame with the messages following.
+    """
+    global plot_rows
+    if plot_taken:
+        plot_reduce()
+    if handshake_watch is None:
+        receive_tunnel()
+    if not plot_rows:
+        return
+    plot_batch[2] = plot_rows
+    span = min(plot_last_at - plot_first_at, 0xFFFF)
+    plot_batch[4] = span & 0xFF
+    plot_batch[5] = span >> 8
+    message = plot_view[:_PLOT_ROWS_HEADER + plot_rows * plot_batch[3] * 4]
+    if now:
+        send_tunnel_aipp(message)
+    else:
+        queue_tunnel_aipp(message)
+    plot_rows = 0
+
+
+# endregion AIPP Plot
+# ------------------------------
+
+# ------------------------------
+# region AIPP Capture
+
+capture_ring = None  # array of capture_size rows x plot columns, None when idle
+capture_times = None  # array('H') of the sample times, ms
+capture_size = 0  # rows in the ring
+capture_read = 0  # oldest row not sent yet
+capture_used = 0  # rows not sent yet
+capture_fmt = '<f'
+capture_frame = bytearray(_PLOT_CAPTURE_HEADER)
+capture_view = memoryview(capture_frame)
+capture_frame_rows = 0  # rows fitting in capture_frame
+capture_watch = StopWatch()
+capture_samples = 0
+capture_overruns = 0  # samples dropped from a full ring
+capture_first_at = 0  # capture_watch time of the first and the last sample
+capture_last_at = 0
+
+
+def capture_start(names, size: int = 500, typecode: str = 'f'):
+    """
+    Starts capturing rows of the given columns into a ring of size rows,
+    typecode 'f' for floats or 'h' for 16 bit integers. Nothing is sent
+    until capture_flush, so rows can be taken faster than the link carries.
+    """
+    global capture_ring, capture_times, capture_size, capture_read, capture_used, \
+        capture_fmt, capture_frame, capture_view, capture_frame_rows, \
+        capture_samples, capture_overruns, capture_first_at, capture_last_at
+    plot_define(names)
+    count = len(plot_columns)
+    itemsize = 2 if typecode == 'h' else 4
+    capture_ring = None  # release the former ring first
+    capture_ring = array(typecode, (0 for _ in range(size * count)))
+    capture_times = array('H', (0 for _ in range(size)))
+    capture_size = size
+    capture_read = capture_used = 0
+    capture_fmt = '<' + typecode
+    capture_frame_rows = min(255, max(
+        1, (_PLOT_BATCH - _PLOT_CAPTURE_HEADER) // (itemsize * max(count, 1))))
+    capture_frame = bytearray(
+        _PLOT_CAPTURE_HEADER + capture_frame_rows * count * itemsize)
+    capture_view = memoryview(capture_frame)
+    capture_frame[0] = _PLOT_NOTIFICATION
+    capture_frame[1] = _PLOT_CAPTURE
+    capture_frame[2] = ord(typecode)
+    capture_frame[4] = count  # rows at [3], as in UPDATE_ROWS
+    capture_samples = capture_overruns = capture_first_at = capture_last_at = 0
+    capture_watch.reset()
+
+
+def capture(values) -> bool:
+    """
+    Stores a row, values in column order, without allocating.
+    A full ring drops the row and counts an overrun, returns False then.
+    """
+    global capture_used, capture_samples, capture_overruns, capture_first_at, \
+        capture_last_at
+    if capture_used >= capture_size:
+        capture_overruns += 1
+        return False
+    row = capture_read + capture_used
+    if row >= capture_size:
+        row -= capture_size
+    ring = capture_ring
+    count = capture_frame[4]
+    base = row * count
+    for i in range(count):
+        ring[base + i] = values[i]
+    capture_last_at = capture_watch.time()
+    if not capture_samples:
+        capture_first_at = capture_last_at
+    capture_times[row] = capture_last_at & 0xFFFF
+    capture_used += 1
+    capture_samples += 1
+    return True
+
+
+def capture_flush(timeout: int = -1) -> int:
+    """
+    Sends the captured rows in CAPTURE frames, all of them or as many as fit
+    in about timeout ms, e.g. the spare time of a control loop.
+    Returns the rows still buffered.
+    """
+    global capture_read, capture_used
+    start = capture_watch.time()
+    count = capture_frame[4]
+    fmt = capture_fmt
+    itemsize = 2 if fmt == '<h' else 4
+    while capture_used:
+        # rows up to the end of the ring, a frame never wraps
+        rows = min(capture_used, capture_frame_rows, capture_size - capture_read)
+        ring = capture_ring
+        offset = _PLOT_CAPTURE_HEADER
+        for i in range(capture_read * count, (capture_read + rows) * count):
+            pack_into(fmt, capture_frame, offset, ring[i])
+            offset += itemsize
+        span = (capture_times[capture_read + rows - 1] -
+                capture_times[capture_read]) & 0xFFFF
+        capture_frame[3] = rows
+        capture_frame[5] = span & 0xFF
+        capture_frame[6] = span >> 8
+        send_tunnel_aipp(capture_view[:offset])
+        capture_read += rows
+        if capture_read >= capture_size:
+            capture_read = 0
+        capture_used -= rows
+        if 0 <= timeout <= capture_watch.time() - start:
+            break
+    return capture_used
+
+
+def capture_stats() -> tuple:  # tuple(rate Hz, samples, overruns)
+    """Returns the achieved sample rate, the samples taken and the overruns."""
+    elapsed = capture_last_at - capture_first_at
+    rate = (capture_samples - 1) * 1000 / elapsed if elapsed else 0
+    return rate, capture_samples, capture_overruns
+
+
+def capture_stop() -> tuple:  # tuple(rate Hz, samples, overruns)
+    """
+    Sends the rows left and the capture statistics, releases the ring.
+    Returns capture_stats().
+    """
+    global capture_ring, capture_times, capture_size
+    stats = capture_stats()
+    if capture_ring is not None:
+        capture_flush()
+        send_tunnel_aipp(pack('<BBIII', _PLOT_NOTIFICATION, _PLOT_CAPTURE_STATS,
+                              capture_samples, capture_overruns,
+                              capture_last_at - capture_first_at))
+    capture_ring = capture_times = None
+    capture_size = 0
+    return stats
+
+
+# endregion AIPP Capture
+# ------------------------------
+
 
 # ------------------------------
 # region Example local usage
@@ -628,11 +1548,11 @@ debug_tunnel_init()
 # # [var1, var2, str1, bool1, none1] = dt_trap('dummy.py', 42, ['var1', 'var2', 'str1', 'bool1', 'none1'], [var1, var2, str1, bool1, none1])
 # print(var1)
 
-# send_tunnel_aipp(encode_plot_message_raw([PLOT_DEFINE, ['col1', 'col2']]))
-# wait(100)
+# plot_define(['col1', 'col2'])
 # for i in range(100):
-#     send_tunnel_aipp(encode_plot_message_raw([PLOT_UPDATE_ROW, [1+i, 34324/(i+1)]]))
-#     wait(100)
+#     plot_row([1+i, 34324/(i+1)])
+#     wait(20)
+# plot_flush()
 
 
 # endregion Example local usage
@@ -1,60 +1,166 @@
-from ustruct import pack
+from ustruct import pack,pack_into,unpack_from
 from pybricks.hubs import ThisHub
 from pybricks.parameters import Side,Port
-from pybricks.tools import wait,AppData
+from pybricks.tools import wait,AppData,StopWatch
 from pybricks.iodevices import PUPDevice
+from aipp import TunnelWriter,Reassembler,Coalescer,CAP_COMPACT,CAP_CRC,CAP_MONITOR,CAP_COALESCE,CAP_DELTA_NOTIF,CAP_SCHEDULE,CAP_CREDITS,CREDIT_GRANT,CreditGate,put_varint_into
 
 class DM:
   portchars = ['A','B','C','D','E','F']
   face_map = {Side.TOP: 0,Side.BOTTOM: 1,Side.LEFT: 2,Side.RIGHT: 3,Side.FRONT: 4,Side.BACK: 5}
+  bands = {0x00: (1,),0x01: (0,0,1,1,1,50,50,50,2,2,2),0x0a: (0,0,1,1,1,1),0x0b: (0,1,0),0x0c: (0,0,2,2,2),0x0d: (0,5)}
+  sizes = {0x00: b'\1',0x01: b'\1\1\2\2\2\2\2\2\2\2\2',0x0a: b'\1\1\2\2\1\4',0x0b: b'\1\1\1',0x0c: b'\1\1\2\2\2',0x0d: b'\1\2'}
 
   def __init__(self,hub,appdata):
-    self.hub = hub; self.ports = [getattr(Port,p,None) for p in self.portchars]
-    self.devs = [None]*len(self.portchars); self.infos = [None]*len(self.portchars)
-    self.detect = [-60]*len(self.portchars); self.i = 0; self.appdata = appdata
+    self.hub = hub; self.ports = [getattr(Port,p,None) for p in self.portchars]; n = len(self.portchars)
+    self.devs = [None]*n; self.plans = [None]*n; self.i = 0; self.tunnel = TunnelWriter(appdata,10)
+    self.co = Coalescer(self.tunnel.send,StopWatch(),100,sized=True); self.frame = bytearray(203); self.fm = memoryview(self.frame)
+    self.appdata,self.rx,self.rx_last,self.compact,self.hs = appdata,Reassembler(32),None,False,0
+    self.delta,self.schedule,self.last,self.dirty,self.sent = False,False,{},{},{}
+    self.clock,self.periods = StopWatch(),{0x00: 5000,0x01: 20,0x0a: 50,0x0b: 50,0x0c: 100,0x0d: 100,0xff: 500}
+    self.kinds,self.due,self.backoff = [0x00,0x01] + [None]*n,[0]*(2+n),[0]*n
+    self.samples,self.first,self.latest = [0]*(2+n),[0]*(2+n),[0]*(2+n)
+    self.interval,self.send_at,self.kf,self.rates_from = 100,0,0,0; self.rates = bytearray(3+6*(2+n)); self.rv = memoryview(self.rates)
 
-  def get_dev_payload(self,pi,dev,info):
+  def rcv(self):
+    data = self.appdata.get_bytes(); msg = self.rx.feed(data) if data != self.rx_last else None; self.rx_last = data; return msg
+
+  def handshake(self):
+    try: c = self.tunnel.credits; msg = c.receive() if c else self.rcv()
+    except: msg = None
+    if msg is None or len(msg) < 3 or msg[0] != 0x70: pass
+    elif msg[1] == 0x00 and self.hs >= 0:
+      caps = unpack_from('<H',msg,3)[0] if msg[2] & 0x80 and len(msg) >= 5 else 0
+      self.compact,self.tunnel.crc,self.hs = caps & CAP_COMPACT != 0,caps & CAP_CRC != 0,-1
+      self.co.enabled,self.delta,self.schedule = caps & CAP_COALESCE != 0,caps & CAP_DELTA_NOTIF != 0,caps & CAP_SCHEDULE != 0
+      if caps & CAP_CREDITS: self.tunnel.credits = CreditGate(self.rcv,StopWatch())
+      return
+    elif msg[1] == 0x11:
+      now = self.clock.time()
+      for k in range(min(msg[2],(len(msg)-3)//3)):
+        rt,ms = unpack_from('<BH',msg,3+3*k)
+        if rt in self.periods:
+          self.periods[rt] = ms
+          for s,kind in enumerate(self.kinds):
+            if kind == rt: self.due[s],self.samples[s] = now,0
+    elif msg[1] == CREDIT_GRANT and self.tunnel.credits and len(msg) >= 5: self.tunnel.credits.grant(*unpack_from('<HB',msg,2))
+    if self.hs >= 0 and self.i % 30 == 1:
+      if self.hs >= 4: self.hs = -1
+      else: self.hs += 1; self.tunnel.send(pack('<BBH',0x71,0x01,CAP_MONITOR | CAP_COMPACT | CAP_CRC | CAP_COALESCE | CAP_DELTA_NOTIF | CAP_SCHEDULE | CAP_CREDITS))
+
+  def enc(self,b,i,rt,v):
+    b[i] = rt; i += 1; sz = self.sizes[rt]
+    for j in range(len(v)):
+      x,n = v[j],sz[j]
+      if n > 1 and self.compact: i = put_varint_into(b,i,x); continue
+      for _ in range(n): b[i] = x & 0xFF; x >>= 8; i += 1
+    return i
+
+  def f(self,rt,p=0):
+    key = rt << 8 | p if rt >= 0x0a else rt; v = self.last.get(key)
+    if v is None: v = self.last[key] = [0]*len(self.bands[rt])
+    self.dirty[key] = True; return v
+
+  def moved(self,key):
+    sent = self.sent.get(key)
+    if sent is None: return True
+    last,bands = self.last[key],self.bands[key >> 8 or key]
+    for j in range(len(bands)):
+      if abs(last[j]-sent[j]) > bands[j]: return True
+    return False
+
+  def notify(self,now):
+    if now >= (self.kf if self.delta else self.send_at):
+      full = True
+      if self.delta: self.kf = now + 1000
+      else: self.send_at += self.interval; self.send_at = self.send_at if self.send_at > now else now + self.interval
+    elif self.delta: full = False
+    else: return
+    b = self.frame
+    if not full: b[0],b[1],i = 0x75,int(self.compact),2
+    else: b[0],i = (0x74,1) if self.compact else (0x3c,3)
+    h = i
+    for k in self.last:
+      if full or self.dirty[k] and self.moved(k):
+        v = self.last[k]; w = self.sent.get(k)
+        if w is None: self.sent[k] = list(v)
+        else:
+          for j in range(len(v)): w[j] = v[j]
+        i = self.enc(b,i,k >> 8 or k,v)
+      self.dirty[k] = False
+    if i == h: return
+    if h == 3: b[1],b[2] = (i-3) & 0xFF,(i-3) >> 8
+    self.co.add(self.fm,i)
+
+  def plan(self,dev,info):
     did = info.get("id")
-    try:
-      if did in (48,49,65,75,76,38):
-        ap,pwr,spd = dev.read(2)[0],dev.read(0)[0],dev.read(1)[0]
-        pos = dev.read(3)[0] if len(dev.info().get("modes",[])) > 3 else ap
-        return pack('<BBBhhbi',0x0a,pi,did,ap,pwr,spd,int(pos))
-      if did == 63:
-        f,p = dev.read(0)[0],bool(dev.read(1)[0]); return pack('<BBBB',0x0b,pi,f,1 if p else 0)
-      if did == 62: return pack('<BBh',0x0d,pi,dev.read(0)[0])
-      if did == 61:
-        c,rgb = dev.read(0)[0],dev.read(3); r,g,b = (rgb if len(rgb) == 3 else (0,0,0))
-        return pack('<BBBHHH',0x0c,pi,c,r,g,b)
-      if did == 37:
-        c,d = dev.read(0)[0],dev.read(1)[0]; return pack('<BBBHHH',0x0c,pi,c,0,0,0) + pack('<BBh',0x0d,pi,d)
-    except: pass
-    return None
-
-  def loop_check(self,interval_ms=30):
-    while True:
-      self.i += 1; v = self.hub.battery.voltage(); p = min(100,max(0,int((v-6000)/(8300-6000)*100)))
-      payloads = [pack('<BB',0x00,p)]; up = self.hub.imu.up()
-      y,(pi,ro),(ax,ay,az),(gx,gy,gz) = self.hub.imu.heading(),self.hub.imu.tilt(),self.hub.imu.acceleration(),\
-        self.hub.imu.angular_velocity()
-      payloads.append(pack('<BBBhhhhhhhhh',0x01,int(up == Side.TOP),self.face_map.get(up,0),int(y),int(pi),int(ro),\
-        int(ax),int(ay),int(az),int(gx),int(gy),int(gz)))
-      for idx,port in enumerate(self.ports):
-        try:
-          if self.devs[idx] is None and self.i > self.detect[idx]+60:
-            d = PUPDevice(port); self.devs[idx],self.infos[idx] = d,d.info()
-          d,info = self.devs[idx],self.infos[idx]
-          if d and info:
-            p = self.get_dev_payload(idx,d,info)
-            if p: payloads.append(p)
-        except:
-          self.devs[idx] = self.infos[idx] = None; self.detect[idx] = self.i
-      d = b''.join(payloads); aipp_send(pack('<BH',0x3c,len(d)) + d,self.appdata); wait(interval_ms)
-
-def aipp_send(data,appdata):
-  mtu = 17; data += bytes([sum(data) & 0xFF])
-  for i in range(0,len(data),mtu):
-    appdata.write_bytes((b'\xfe' if i == 0 else b'\xff') + data[i:i+mtu] + (b'\x00' if (i+mtu) >= len(data) else b'\xff'))
-    wait(10)
-
-DM(ThisHub(),AppData("")).loop_check(100)
+    if did in (48,49,65,75,76,38): return 0x0a,self.rm,did,len(info.get("modes",[])) > 3
+    if did == 63: return 0x0b,self.rf,did,False
+    if did == 62: return 0x0d,self.rd,did,False
+    if did == 61: return 0x0c,self.rc,did,len(dev.read(3)) == 3
+    if did == 37: return 0x0c,self.rcd,did,False
+
+  def rm(self,dev,pi,did,pos):
+    v = self.f(0x0a,pi); ap = dev.read(2)[0]; v[0],v[1],v[2] = pi,did,ap
+    v[3] = dev.read(0)[0]; v[4] = dev.read(1)[0]; v[5] = dev.read(3)[0] if pos else ap
+  def rf(self,dev,pi,did,_): v = self.f(0x0b,pi); v[0] = pi; v[1] = dev.read(0)[0]; v[2] = dev.read(1)[0]
+  def rd(self,dev,pi,did,_): v = self.f(0x0d,pi); v[0] = pi; v[1] = dev.read(0)[0]
+  def rc(self,dev,pi,did,rgb):
+    v = self.f(0x0c,pi); v[0] = pi; v[1] = dev.read(0)[0]
+    if rgb: v[2],v[3],v[4] = dev.read(3)
+    else: v[2] = v[3] = v[4] = 0
+  def rcd(self,dev,pi,did,_):
+    v = self.f(0x0c,pi); v[0] = pi; v[1] = dev.read(0)[0]; v[2] = v[3] = v[4] = 0
+    v = self.f(0x0d,pi); v[0] = pi; v[1] = dev.read(1)[0]
+
+  def sample(self,s,now):
+    rt = self.kinds[s]
+    if rt is None:
+      idx = s-2
+      try: d = PUPDevice(self.ports[idx]); plan = self.plan(d,d.info())
+      except: plan = None
+      if plan is None:
+        self.backoff[idx] = min(8000,self.backoff[idx]*2 or self.periods[0xff]); self.due[s] = now + self.backoff[idx]; return
+      self.devs[idx],self.plans[idx],self.kinds[s],self.backoff[idx],self.samples[s] = d,plan,plan[0],0,0
+      rt = plan[0]
+    period = self.periods[rt]
+    if not period: self.due[s] = now + 50; return
+    due = self.due[s] + period; self.due[s] = due if due > now else now + period
+    if not self.samples[s]: self.first[s] = now
+    self.latest[s] = now; self.samples[s] += 1
+    if s == 0: v = self.hub.battery.voltage(); self.f(0x00)[0] = min(100,max(0,(v-6000)*100//(8300-6000)))
+    elif s == 1:
+      imu = self.hub.imu; v = self.f(0x01); up = imu.up(); v[0],v[1],v[2] = up == Side.TOP,self.face_map.get(up,0),int(imu.heading())
+      pi,ro = imu.tilt(); v[3] = int(pi); v[4] = int(ro)
+      ax,ay,az = imu.acceleration(); v[5] = int(ax); v[6] = int(ay); v[7] = int(az)
+      gx,gy,gz = imu.angular_velocity(); v[8] = int(gx); v[9] = int(gy); v[10] = int(gz)
+    else:
+      idx = s-2
+      try: p = self.plans[idx]; p[1](self.devs[idx],idx,p[2],p[3])
+      except:
+        self.devs[idx] = self.plans[idx] = self.kinds[s] = None
+        for k in [k for k in self.last if k > 0xff and k & 0xff == idx]: del self.last[k]; self.sent.pop(k,None); self.dirty.pop(k,None)
+        self.kf = now; self.due[s] = now + self.periods[0xff]
+
+  def report(self,now):
+    self.rates_from = now; b = self.rates; i = 3
+    for s in range(len(self.kinds)):
+      rt = self.kinds[s]
+      if rt is None: continue
+      n = self.samples[s]; self.samples[s] = 0; a = (self.latest[s]-self.first[s])//(n-1) if n > 1 else 0
+      pack_into('<BBHH',b,i,rt,s-2 if s >= 2 else 0xff,self.periods[rt],min(0xffff,a)); i += 6
+    pack_into('<BBB',b,0,0x71,0x12,(i-3)//6); self.co.add(self.rv,i)
+
+  def tick(self):
+    self.i += 1; self.handshake(); now = self.clock.time()
+    if self.schedule and now - self.rates_from >= 5000: self.report(now)
+    for s in range(len(self.due)):
+      if now >= self.due[s]: self.sample(s,now)
+    self.notify(now); self.co.poll(); return min(self.due) - self.clock.time()
+
+  def loop_check(self,interval_ms=100):
+    self.interval = interval_ms
+    while True: wait(max(1,min(50,self.tick())))
+
+if __name__ == "__main__":
+  DM(ThisHub(),AppData('<BBBBBBBBBBBBBBBBBBB')).loop_check()
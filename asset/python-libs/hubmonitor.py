@@ -7,13 +7,66 @@ device notification messages and sends them using the AppData interface.
 Follows the HubOS3 device notification message format.
 
 Encodes and sends device notification messages via AIPP protocol.
+Offers compact values, CRC framing, coalescing, delta notifications, rate
+reports and credit flow control in a START handshake (CAP_MONITOR |
+CAP_COMPACT | CAP_CRC | CAP_COALESCE | CAP_DELTA_NOTIF | CAP_SCHEDULE |
+CAP_CREDITS); once the host agrees, compact device notifications (0x74) are
+sent instead, in CRC frames, two consecutive ones sharing a frame, their
+chunks paced by the credits the host grants instead of a 5 ms wait each.
+Each source (battery, IMU, each port) is sampled on its own period
+(SOURCE_PERIODS) against StopWatch deadlines, empty ports are rescanned with
+a backoff. The host may change the periods (0x70 0x11) and gets the target
+and actual period of each source every RATES_MS (0x71 0x12).
+With delta notifications only the sources with a field moved beyond its
+deadband are sent (0x75), all of them in a keyframe every KEYFRAME_MS.
+Notifications are packed into one preallocated frame and written from it, so
+sending them does not allocate.
 """
 
-from ustruct import pack
+from ustruct import pack, pack_into, unpack_from
 from pybricks.hubs import ThisHub
 from pybricks.parameters import Side, Port
-from pybricks.tools import wait, AppData
+from pybricks.tools import wait, AppData, StopWatch
 from pybricks.iodevices import PUPDevice
+from aipp import TunnelWriter, Reassembler, Coalescer, CAP_COMPACT, CAP_CRC, CAP_MONITOR, CAP_COALESCE, CAP_DELTA_NOTIF, CAP_SCHEDULE, CAP_CREDITS, CREDIT_GRANT, CreditGate, put_varint_into
+
+# DeviceMonitor START handshake: capabilities offered, loop cycles between
+# START notifications and notifications sent before giving up
+HANDSHAKE_CAPS = CAP_MONITOR | CAP_COMPACT | CAP_CRC | CAP_COALESCE | \
+    CAP_DELTA_NOTIF | CAP_SCHEDULE | CAP_CREDITS
+HANDSHAKE_RESEND = 30
+HANDSHAKE_TRIES = 4
+# wait after each chunk unless the host grants credits (CAP_CREDITS)
+PACE_MS = 5
+# longest time a notification waits to share a frame with the next one (ms)
+COALESCE_MS = 100
+# delta notifications: time between keyframes sending every source (ms), and
+# per record type the change of each encoder argument that is not sent yet
+KEYFRAME_MS = 1000
+DEADBANDS = {
+    0x00: (1,),  # battery %
+    0x01: (0, 0, 1, 1, 1, 50, 50, 50, 2, 2, 2),  # deg, mm/s2, deg/s
+    0x0a: (0, 0, 1, 1, 1, 1),  # motor deg, %, %, deg
+    0x0b: (0, 1, 0),  # force
+    0x0c: (0, 0, 2, 2, 2),  # color, rgb
+    0x0d: (0, 5),  # distance mm
+}
+# sampling period per record type (ms), 0 pauses; RESCAN: first rescan of an
+# empty port, doubled per miss up to RESCAN_MAX_MS
+RESCAN = 0xff
+SOURCE_PERIODS = {0x00: 5000, 0x01: 20, 0x0a: 50, 0x0b: 50, 0x0c: 100,
+                  0x0d: 100, RESCAN: 500}
+RESCAN_MAX_MS = 8000
+# device ids of the motors, and the IMU face codes
+MOTOR_IDS = (48, 49, 65, 75, 76, 38)
+FACES = {Side.TOP: 0, Side.BOTTOM: 1, Side.LEFT: 2, Side.RIGHT: 3,
+         Side.FRONT: 4, Side.BACK: 5}
+# longest device notification: the 0x3c header, battery, IMU and six ports
+# with a color and a distance record, compact values of 32 bits at most
+NOTIF_MAX = 3 + 2 + (3 + 9 * 5) + 6 * ((3 + 3 * 5) + (2 + 5))
+# time between rate reports, and longest wait of the loop (ms)
+RATES_MS = 5000
+LOOP_MAX_MS = 50
 
 # DeviceMonitor feature
 portchars = ['A', 'B', 'C', 'D', 'E', 'F']
@@ -25,112 +78,407 @@ class DeviceMonitor:
         self.ports = [getattr(Port, p, None) for p in portchars]
         pl = len(portchars)
         self.devs = [None]*pl
-        self.infos = [None]*pl
-        self.detect = [-60]*pl
+        self.plans = [None]*pl  # read plan of each attached device
         self.i = 0
+        self.tunnel = TunnelWriter(appdata, PACE_MS)
+        self.co = Coalescer(self.tunnel.send, StopWatch(), COALESCE_MS,
+                            sized=True)
+        self.frame = bytearray(NOTIF_MAX)  # the notification being sent
+        self.frame_mv = memoryview(self.frame)
         self.appdata = appdata
+        self.rx = Reassembler(32)
+        self.rx_last = None
+        self.compact = False  # CAP_COMPACT agreed by the host
+        self.hs = 0  # START notifications sent, -1 once acknowledged or given up
+        self.delta = False  # CAP_DELTA_NOTIF agreed by the host
+        self.schedule = False  # CAP_SCHEDULE agreed by the host
+        self.encoders = {0x00: self.enc_bat, 0x01: self.enc_imu,
+                         0x0a: self.enc_motor, 0x0b: self.enc_force,
+                         0x0c: self.enc_color, 0x0d: self.enc_dist}
+        # sources: 0 battery, 1 IMU, 2.. the ports
+        self.clock = StopWatch()
+        self.periods = dict(SOURCE_PERIODS)
+        self.kinds = [0x00, 0x01] + [None]*pl  # record type, None: empty port
+        self.due = [0]*(2 + pl)  # clock time of the next sample or rescan
+        self.backoff = [0]*pl  # next rescan delay of an empty port (ms)
+        self.samples = [0]*(2 + pl)  # since the last rate report
+        self.first = [0]*(2 + pl)  # clock time of the first and last of them
+        self.latest = [0]*(2 + pl)
+        self.last = {}  # source key: fields last sampled, filled in place
+        self.dirty = {}  # source key: sampled since the last notification
+        self.sent = {}  # source key: copy of the fields last sent
+        self.interval = 100  # full notifications without delta mode (ms)
+        self.send_at = 0  # clock time of the next full notification
+        self.kf = 0  # clock time of the next keyframe
+        self.rates_from = 0  # clock time of the last rate report
+        self.rates = bytearray(3 + 6 * (2 + pl))  # the rate report being sent
+        self.rates_mv = memoryview(self.rates)
+
+    def handshake(self):
+        # polls the host once per loop cycle without blocking: answers the
+        # START until acknowledged, period requests and credit grants
+        try:
+            # messages received while a send waited for credits come first
+            credits = self.tunnel.credits
+            msg = credits.receive() if credits else self.receive()
+        except:
+            msg = None
+        if msg is None or len(msg) < 3 or msg[0] != 0x70:
+            pass
+        elif msg[1] == 0x00 and self.hs >= 0:
+            # START_ACK: success flags, u16 capabilities if bit 7 is set
+            caps = unpack_from('<H', msg, 3)[0] if msg[2] & 0x80 and len(msg) >= 5 else 0
+            self.compact = caps & CAP_COMPACT != 0
+            self.tunnel.crc = caps & CAP_CRC != 0
+            self.co.enabled = caps & CAP_COALESCE != 0
+            self.delta = caps & CAP_DELTA_NOTIF != 0
+            self.schedule = caps & CAP_SCHEDULE != 0
+            if caps & CAP_CREDITS:
+                self.tunnel.credits = CreditGate(self.receive, StopWatch())
+            self.hs = -1
+            return
+        elif msg[1] == 0x11:
+            self.set_periods(msg)
+        elif msg[1] == CREDIT_GRANT and self.tunnel.credits and len(msg) >= 5:
+            received, window = unpack_from('<HB', msg, 2)
+            self.tunnel.credits.grant(received, window)
+        if self.hs >= 0 and self.i % HANDSHAKE_RESEND == 1:
+            if self.hs >= HANDSHAKE_TRIES:
+                self.hs = -1
+            else:
+                self.hs += 1
+                self.tunnel.send(pack('<BBH', 0x71, 0x01, HANDSHAKE_CAPS))
+
+    def receive(self):
+        # reads a new chunk once, returns the host message it completes
+        data = self.appdata.get_bytes()
+        msg = self.rx.feed(data) if data != self.rx_last else None
+        self.rx_last = data
+        return msg
+
+    def set_periods(self, msg):
+        # 0x70 0x11 count, count x (record type u8, period ms u16); the
+        # sources of a changed type are sampled at once
+        now = self.clock.time()
+        for k in range(min(msg[2], (len(msg) - 3) // 3)):
+            rt, ms = unpack_from('<BH', msg, 3 + 3 * k)
+            if rt in self.periods:
+                self.periods[rt] = ms
+                for s, kind in enumerate(self.kinds):
+                    if kind == rt:
+                        self.due[s] = now
+                        self.samples[s] = 0
+
+    def enc_varints(self, b, i, a, j):
+        # compact payload: the fields a[j:] as zigzag varints from b[i]
+        for j in range(j, len(a)):
+            i = put_varint_into(b, i, a[j])
+        return i
 
-    def enc_bat(self, l): return pack('<BB', 0x00, l)
+    # the encoders pack the record of a sample (encoder arguments a) into b
+    # at i and return the position after it
 
-    def enc_imu(self, fu, yf, y, pi, r, ax, ay, az, gx, gy, gz): return pack(
-        '<BBBhhhhhhhhh', 0x01, int(fu), yf, y, pi, r, ax, ay, az, gx, gy, gz)
+    def enc_bat(self, b, i, a):
+        pack_into('<BB', b, i, 0x00, a[0])
+        return i + 2
 
-    def enc_motor(self, p, t, ap, po, sp, pos): return pack(
-        '<BBBhhbi', 0x0a, p, t, ap, po, sp, pos)
+    def enc_imu(self, b, i, a):
+        if self.compact:
+            pack_into('<BBB', b, i, 0x01, int(a[0]), a[1])
+            return self.enc_varints(b, i + 3, a, 2)
+        pack_into('<BBBhhhhhhhhh', b, i, 0x01, int(a[0]), a[1], a[2], a[3],
+                  a[4], a[5], a[6], a[7], a[8], a[9], a[10])
+        return i + 21
 
-    def enc_force(self, p, v, pr): return pack(
-        '<BBBB', 0x0b, p, v, 1 if pr else 0)
+    def enc_motor(self, b, i, a):
+        p, t, ap, po, sp, pos = a
+        if self.compact:
+            pack_into('<BBB', b, i, 0x0a, p, t)
+            i = put_varint_into(b, i + 3, ap)
+            i = put_varint_into(b, i, po)
+            b[i] = sp & 0xFF
+            return put_varint_into(b, i + 1, pos)
+        pack_into('<BBBhhbi', b, i, 0x0a, p, t, ap, po, sp, pos)
+        return i + 12
 
-    def enc_color(self, p, c, r, g, b): return pack(
-        '<BBBHHH', 0x0c, p, c, r, g, b)
+    def enc_force(self, b, i, a):
+        pack_into('<BBBB', b, i, 0x0b, a[0], a[1], 1 if a[2] else 0)
+        return i + 4
 
-    def enc_dist(self, p, d): return pack('<BBh', 0x0d, p, d)
+    def enc_color(self, b, i, a):
+        if self.compact:
+            pack_into('<BBB', b, i, 0x0c, a[0], a[1])
+            return self.enc_varints(b, i + 3, a, 2)
+        pack_into('<BBBHHH', b, i, 0x0c, a[0], a[1], a[2], a[3], a[4])
+        return i + 9
 
-    def enc_devnotif(self, pl): d = b''.join(
-        pl); return pack('<BH', 0x3c, len(d))+d
+    def enc_dist(self, b, i, a):
+        if self.compact:
+            pack_into('<BB', b, i, 0x0d, a[0])
+            return put_varint_into(b, i + 2, a[1])
+        pack_into('<BBh', b, i, 0x0d, a[0], a[1])
+        return i + 4
 
-    def get_dev_payload(self, pi, dev, info):
+    def enc_devnotif(self, delta=False):
+        # packs the latest sample of every source into the frame, in delta
+        # mode of the sources moved beyond their deadband, and keeps them as
+        # sent; returns the frame length, 0 if there is nothing to send.
+        # Compact and delta notifications carry no length, the tunnel frame
+        # delimits them; delta flags bit 0: compact payloads
+        b = self.frame
+        if delta:
+            pack_into('<BB', b, 0, 0x75, 1 if self.compact else 0)
+            i = 2
+        else:
+            b[0] = 0x74 if self.compact else 0x3c
+            i = 1 if self.compact else 3
+        start = i
+        for k in self.last:
+            if not delta or self.dirty[k] and self.moved(k):
+                args = self.last[k]
+                sent = self.sent.get(k)
+                if sent is None:
+                    self.sent[k] = list(args)  # once per source
+                else:
+                    for j in range(len(args)):
+                        sent[j] = args[j]
+                i = self.encoders[k >> 8 or k](b, i, args)
+            self.dirty[k] = False
+        if i == start:
+            return 0
+        if start == 3:  # 0x3c
+            pack_into('<H', b, 1, i - 3)  # the length, patched in place
+        return i
+
+    def fields(self, rt, port=0):
+        # the fields of a source for its latest sample, the encoder arguments:
+        # allocated once, filled in place by the reader, sent with the next
+        # notification
+        key = rt << 8 | port if rt >= 0x0a else rt
+        v = self.last.get(key)
+        if v is None:
+            v = self.last[key] = [0] * len(DEADBANDS[rt])
+        self.dirty[key] = True
+        return v
+
+    def moved(self, key):
+        # True if a field moved beyond its deadband since the source was sent
+        sent = self.sent.get(key)
+        if sent is None:
+            return True
+        last = self.last[key]
+        bands = DEADBANDS[key >> 8 or key]
+        for j in range(len(bands)):
+            if abs(last[j] - sent[j]) > bands[j]:
+                return True
+        return False
+
+    def notify(self, now):
+        # without delta mode every source each interval, in delta mode the
+        # sources moved beyond their deadband, every source in a keyframe;
+        # written from the frame, without a copy unless coalesced
+        if now >= (self.kf if self.delta else self.send_at):
+            full = True
+            if self.delta:
+                self.kf = now + KEYFRAME_MS
+            else:
+                self.send_at += self.interval
+                if self.send_at <= now:
+                    self.send_at = now + self.interval
+        elif self.delta:
+            full = False
+        else:
+            return
+        n = self.enc_devnotif(not full)
+        if n:
+            self.co.add(self.frame_mv, n)
+
+    def plan(self, dev, info):
+        # read plan of a device, built once when attached: record type, reader
+        # method, device id and capability flag; None if not monitored
         did = info.get("id")
-        try:
-            if did in (48, 49, 65, 75, 76, 38):
-                abs_pos = dev.read(2)[0]
-                power = dev.read(0)[0]
-                speed = dev.read(1)[0]
-                position = dev.read(3)[0] if len(
-                    dev.info().get("modes", [])) > 3 else abs_pos
-                return self.enc_motor(pi, did, abs_pos, power, speed, int(position))
-            if did == 63:
-                f = dev.read(0)[0]
-                p = bool(dev.read(1)[0])
-                return self.enc_force(pi, f, p)
-            if did == 62:
-                return self.enc_dist(pi, dev.read(0)[0])
-            if did == 61:
-                c = dev.read(0)[0]
-                rgb = dev.read(3)
-                r, g, b = (rgb if len(rgb) == 3 else (0, 0, 0))
-                return self.enc_color(pi, c, r, g, b)
-            if did == 37:
-                c = dev.read(0)[0]
-                d = dev.read(1)[0]
-                return self.enc_color(pi, c, 0, 0, 0)+self.enc_dist(pi, d)
-        except:
-            pass
+        if did in MOTOR_IDS:
+            # the position mode is missing on some motors
+            return 0x0a, self.read_motor, did, len(info.get("modes", [])) > 3
+        if did == 63:
+            return 0x0b, self.read_force, did, False
+        if did == 62:
+            return 0x0d, self.read_dist, did, False
+        if did == 61:
+            # raw rgb, if mode 3 reads three values
+            return 0x0c, self.read_color, did, len(dev.read(3)) == 3
+        if did == 37:
+            return 0x0c, self.read_color_dist, did, False
         return None
 
-    def bat_payload(self):
+    def read_motor(self, dev, pi, did, pos):
+        v = self.fields(0x0a, pi)
+        ap = dev.read(2)[0]
+        v[0] = pi
+        v[1] = did
+        v[2] = ap
+        v[3] = dev.read(0)[0]
+        v[4] = dev.read(1)[0]
+        v[5] = dev.read(3)[0] if pos else ap
+
+    def read_force(self, dev, pi, did, _):
+        v = self.fields(0x0b, pi)
+        v[0] = pi
+        v[1] = dev.read(0)[0]
+        v[2] = dev.read(1)[0]
+
+    def read_dist(self, dev, pi, did, _):
+        v = self.fields(0x0d, pi)
+        v[0] = pi
+        v[1] = dev.read(0)[0]
+
+    def read_color(self, dev, pi, did, rgb):
+        v = self.fields(0x0c, pi)
+        v[0] = pi
+        v[1] = dev.read(0)[0]
+        if rgb:
+            v[2], v[3], v[4] = dev.read(3)
+        else:
+            v[2] = v[3] = v[4] = 0
+
+    def read_color_dist(self, dev, pi, did, _):
+        v = self.fields(0x0c, pi)
+        v[0] = pi
+        v[1] = dev.read(0)[0]
+        v[2] = v[3] = v[4] = 0
+        v = self.fields(0x0d, pi)
+        v[0] = pi
+        v[1] = dev.read(1)[0]
+
+    def sample_dev(self, idx):
+        # runs the read plan of the device on port idx, raises once the
+        # device was detached
+        rt, read, did, flag = self.plans[idx]
+        read(self.devs[idx], idx, did, flag)
+
+    def sample_bat(self):
+        # integer math, a float would be allocated
         v = self.hub.battery.voltage()
-        p = min(100, max(0, int((v-6000)/(8300-6000)*100)))
-        return self.enc_bat(p)
-
-    def imu_payload(self):
-        up = self.hub.imu.up()
-        face_map = {Side.TOP: 0, Side.BOTTOM: 1, Side.LEFT: 2,
-                    Side.RIGHT: 3, Side.FRONT: 4, Side.BACK: 5}
-        face_up = up == Side.TOP
-        yf = face_map.get(up, 0)
-        y = int(self.hub.imu.heading())
-        pi, ro = map(int, self.hub.imu.tilt())
-        ax, ay, az = map(int, self.hub.imu.acceleration())
-        gx, gy, gz = map(int, self.hub.imu.angular_velocity())
-        return self.enc_imu(face_up, yf, y, pi, ro, ax, ay, az, gx, gy, gz)
-
-    def loop_check(self, interval_ms=30):
+        self.fields(0x00)[0] = min(100, max(0, (v - 6000) * 100 // (8300 - 6000)))
+
+    def sample_imu(self):
+        imu = self.hub.imu
+        v = self.fields(0x01)
+        up = imu.up()
+        v[0] = up == Side.TOP
+        v[1] = FACES.get(up, 0)
+        v[2] = int(imu.heading())
+        pi, ro = imu.tilt()
+        v[3] = int(pi)
+        v[4] = int(ro)
+        ax, ay, az = imu.acceleration()
+        v[5] = int(ax)
+        v[6] = int(ay)
+        v[7] = int(az)
+        gx, gy, gz = imu.angular_velocity()
+        v[8] = int(gx)
+        v[9] = int(gy)
+        v[10] = int(gz)
+
+    def scan(self, idx, now):
+        # rescans an empty port, backing off while it stays empty
+        s = 2 + idx
+        try:
+            d = PUPDevice(self.ports[idx])
+            plan = self.plan(d, d.info())
+        except:
+            plan = None
+        if plan is None:
+            self.backoff[idx] = min(RESCAN_MAX_MS, self.backoff[idx] * 2
+                                    or self.periods[RESCAN])
+            self.due[s] = now + self.backoff[idx]
+            return
+        self.devs[idx] = d
+        self.plans[idx] = plan
+        self.kinds[s] = plan[0]
+        self.backoff[idx] = 0
+        self.samples[s] = 0
+        self.sample(s, now)
+
+    def detach(self, idx, now):
+        # forgets the device of a port and resyncs the host with a keyframe
+        self.devs[idx] = None
+        self.plans[idx] = None
+        self.kinds[2 + idx] = None
+        for k in [k for k in self.last if k > 0xff and k & 0xff == idx]:
+            del self.last[k]
+            self.sent.pop(k, None)
+            self.dirty.pop(k, None)
+        self.kf = now
+        self.due[2 + idx] = now + self.periods[RESCAN]
+
+    def sample(self, s, now):
+        # samples source s if due and sets its next deadline, missed ones are
+        # skipped
+        rt = self.kinds[s]
+        if rt is None:
+            return self.scan(s - 2, now)
+        period = self.periods[rt]
+        if not period:
+            self.due[s] = now + LOOP_MAX_MS  # paused
+            return
+        due = self.due[s] + period
+        self.due[s] = due if due > now else now + period
+        if not self.samples[s]:
+            self.first[s] = now
+        self.latest[s] = now
+        self.samples[s] += 1
+        if s == 0:
+            self.sample_bat()
+        elif s == 1:
+            self.sample_imu()
+        else:
+            try:
+                self.sample_dev(s - 2)
+            except:
+                self.detach(s - 2, now)
+
+    def report(self, now):
+        # 0x71 0x12 count, count x (record type u8, port u8 (0xff: hub),
+        # target period ms u16, actual period ms u16 (0: sampled once at most))
+        # between the samples since the last report; packed in place
+        self.rates_from = now
+        b = self.rates
+        i = 3
+        for s in range(len(self.kinds)):
+            rt = self.kinds[s]
+            if rt is None:
+                continue
+            n = self.samples[s]
+            self.samples[s] = 0
+            actual = (self.latest[s] - self.first[s]) // (n - 1) if n > 1 else 0
+            pack_into('<BBHH', b, i, rt, s - 2 if s >= 2 else 0xff,
+                      self.periods[rt], min(0xffff, actual))
+            i += 6
+        pack_into('<BBB', b, 0, 0x71, 0x12, (i - 3) // 6)
+        self.co.add(self.rates_mv, i)
+
+    def tick(self):
+        # one loop cycle: queues the rate report, samples the sources due and
+        # queues the notification; returns the time to the next deadline (ms)
+        self.i += 1
+        self.handshake()
+        now = self.clock.time()
+        if self.schedule and now - self.rates_from >= RATES_MS:
+            self.report(now)
+        for s in range(len(self.due)):
+            if now >= self.due[s]:
+                self.sample(s, now)
+        self.notify(now)
+        self.co.poll()
+        return min(self.due) - self.clock.time()
+
+    def loop_check(self, interval_ms=100):
+        # full notifications every interval_ms unless delta mode is agreed
+        self.interval = interval_ms
         while True:
-            self.i += 1
-            payloads = [self.bat_payload(), self.imu_payload()]
-            for idx, port in enumerate(self.ports):
-                try:
-                    if self.devs[idx] is None and self.i > self.detect[idx]+60:
-                        d = PUPDevice(port)
-                        self.devs[idx] = d
-                        self.infos[idx] = d.info()
-                    d = self.devs[idx]
-                    info = self.infos[idx]
-                    if d and info:
-                        p = self.get_dev_payload(idx, d, info)
-                        if p:
-                            payloads.append(p)
-                except:
-                    self.devs[idx] = None
-                    self.infos[idx] = None
-                    self.detect[idx] = self.i
-            msg = self.enc_devnotif(payloads)
-            aipp_send(msg, self.appdata)
-            wait(interval_ms)
-
-# AIPP module
-
-
-def aipp_send(data, appdata):
-    mtu = 17
-    data += bytes([sum(data) & 0xFF])
-    total = len(data)
-    for i in range(0, total, mtu):
-        chunk = (b'\xfe' if i == 0 else b'\xff') + \
-            data[i:i+mtu]+(b'\x00' if (i+mtu) >= total else b'\xff')
-        appdata.write_bytes(chunk)
-        wait(5)
-
-
-DeviceMonitor(ThisHub(), AppData("")).loop_check(100)
+            wait(max(1, min(LOOP_MAX_MS, self.tick())))
+
+
+if __name__ == "__main__":
+    DeviceMonitor(ThisHub(), AppData('<BBBBBBBBBBBBBBBBBBB')).loop_check()
@@ -0,0 +1,55 @@
+import * as vscode from 'vscode';
+
+import { DebugTunnel } from '../debug-tunnel/debug-tunnel';
+import { getLastMonitorRates } from '../debug-tunnel/debugtunnel-appdata-helper';
+import {
+    DebugSubCode,
+    MessageType,
+    MONITOR_RESCAN,
+} from '../pybricks/appdata-instrumentation-protocol';
+import {
+    DeviceNotificationMessageType,
+} from '../spike/utils/device-notification-parser';
+
+const SOURCES = [
+    { label: 'IMU', source: DeviceNotificationMessageType.ImuValues },
+    { label: 'Motors', source: DeviceNotificationMessageType.Motor },
+    { label: 'Color sensors', source: DeviceNotificationMessageType.ColorSensor },
+    { label: 'Distance sensors', source: DeviceNotificationMessageType.DistanceSensor },
+    { label: 'Force sensors', source: DeviceNotificationMessageType.ForceSensor },
+    { label: 'Battery', source: DeviceNotificationMessageType.Battery },
+    { label: 'Port rescan', source: MONITOR_RESCAN },
+];
+
+export async function PromptHubMonitorPeriods() {
+    // the last rate report of the hub, if any
+    const rates = getLastMonitorRates();
+    const picked = await vscode.window.showQuickPick(
+        SOURCES.map((item) => {
+            const rate = rates.find((r) => r.type === item.source);
+            return {
+                ...item,
+                description: rate
+                    ? `every ${rate.actualMs || '-'} ms, target ${rate.targetMs} ms`
+                    : undefined,
+            };
+        }),
+        { title: 'Sampling period of the Hub Monitor source' },
+    );
+    if (!picked) return; // cancelled
+
+    const input = await vscode.window.showInputBox({
+        title: `${picked.label}: sampling period in ms, 0 pauses`,
+        validateInput: (value) =>
+            /^\d+$/.test(value) && Number(value) <= 0xffff
+                ? undefined
+                : 'Enter a period from 0 to 65535 ms',
+    });
+    if (input === undefined) return; // cancelled
+
+    await DebugTunnel.sendToHub({
+        Id: MessageType.DebugAcknowledge,
+        subcode: DebugSubCode.MonitorPeriodsRequest,
+        periods: new Map([[picked.source, Number(input)]]),
+    });
+}
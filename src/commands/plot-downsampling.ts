@@ -0,0 +1,62 @@
+import * as vscode from 'vscode';
+
+import { DebugTunnel } from '../debug-tunnel/debug-tunnel';
+import { plotManager } from '../plot/plot';
+import {
+    MessageType,
+    PlotDownsampleMode,
+    PlotSubCode,
+} from '../pybricks/appdata-instrumentation-protocol';
+
+const BUCKETS = [1, 2, 5, 10, 20, 50];
+
+export async function PromptPlotDownsampling() {
+    const columns = plotManager.columns;
+    if (!columns.length) throw new Error('No plot columns received yet from the hub.');
+
+    const bucket = await vscode.window.showQuickPick(
+        BUCKETS.map((n) => ({
+            label: n === 1 ? 'Off' : `1 of ${n} rows`,
+            description: n === 1 ? 'send every row' : undefined,
+            n,
+        })),
+        { title: 'Downsample the plot on the hub' },
+    );
+    if (!bucket) return; // cancelled
+
+    const modes = new Array<PlotDownsampleMode>(columns.length).fill(
+        PlotDownsampleMode.Every,
+    );
+    if (bucket.n > 1) {
+        const mode = await vscode.window.showQuickPick(
+            [
+                {
+                    label: 'Min/max',
+                    description: 'keeps the envelope and the spikes',
+                    mode: PlotDownsampleMode.MinMax,
+                },
+                { label: 'Mean', mode: PlotDownsampleMode.Mean },
+                { label: 'Every Nth', mode: PlotDownsampleMode.Every },
+            ],
+            { title: 'Reduce each bucket of rows to' },
+        );
+        if (!mode) return; // cancelled
+
+        const picks = await vscode.window.showQuickPick(
+            columns.map((label) => ({ label, picked: true })),
+            {
+                title: `Columns to reduce to ${mode.label}, the others to every Nth`,
+                canPickMany: true,
+            },
+        );
+        if (!picks) return; // cancelled
+        for (const pick of picks) modes[columns.indexOf(pick.label)] = mode.mode;
+    }
+
+    await DebugTunnel.sendToHub({
+        Id: MessageType.PlotAcknowledge,
+        subcode: PlotSubCode.Downsample,
+        bucket: bucket.n,
+        modes,
+    });
+}
@@ -0,0 +1,120 @@
+import {
+    BreakpointCompareOp,
+    BreakpointHitOp,
+    DebugVarType,
+} from '../pybricks/appdata-instrumentation-protocol';
+
+/**
+ * A breakpoint condition in the form the hub evaluates it, see
+ * DebugSubCode.ConditionRequest.
+ */
+export type HubBreakpointCondition = {
+    hitOp: BreakpointHitOp;
+    hitValue: number;
+    varname: string;
+    compareOp: BreakpointCompareOp;
+    value: DebugVarType;
+};
+
+const COMPARE_OPS: Record<string, BreakpointCompareOp> = {
+    '==': BreakpointCompareOp.Equal,
+    '!=': BreakpointCompareOp.NotEqual,
+    '<': BreakpointCompareOp.Less,
+    '<=': BreakpointCompareOp.LessEqual,
+    '>': BreakpointCompareOp.Greater,
+    '>=': BreakpointCompareOp.GreaterEqual,
+};
+
+// operator when the literal is on the left side: 300 < speed => speed > 300
+const SWAPPED_OPS: Record<string, string> = {
+    '==': '==',
+    '!=': '!=',
+    '<': '>',
+    '<=': '>=',
+    '>': '<',
+    '>=': '<=',
+};
+
+const NAME = '[A-Za-z_]\\w*';
+const LITERAL = `-?\\d+(?:\\.\\d*)?(?:[eE][-+]?\\d+)?|'[^']*'|"[^"]*"|True|False|None`;
+const OP = '==|!=|<=|>=|<|>';
+const CONDITION_RE = new RegExp(`^\\s*(${NAME})\\s*(${OP})\\s*(${LITERAL})\\s*$`);
+const CONDITION_SWAPPED_RE = new RegExp(
+    `^\\s*(${LITERAL})\\s*(${OP})\\s*(${NAME})\\s*$`,
+);
+const HIT_CONDITION_RE = /^\s*(>=|>|==|=|%)?\s*(\d+)\s*$/;
+
+function parseLiteral(text: string): DebugVarType {
+    if (text === 'True') return true;
+    if (text === 'False') return false;
+    if (text === 'None') return null;
+    if (text.startsWith("'") || text.startsWith('"')) return text.slice(1, -1);
+    return Number(text);
+}
+
+/**
+ * Parse the condition and hit condition of a breakpoint into a hub condition.
+ *
+ * condition: `variable <op> literal` or `literal <op> variable`, op one of
+ * == != < <= > >=, literal a number, a quoted string, True, False or None.
+ * hitCondition: `n` or `>= n` (stop from the n-th hit on), `> n` (ignore n hits),
+ * `== n` (only the n-th hit), `% n` (every n-th hit).
+ *
+ * @returns the hub condition, undefined without any condition, or an error message
+ */
+export function parseBreakpointCondition(
+    condition?: string,
+    hitCondition?: string,
+): HubBreakpointCondition | undefined | string {
+    const result: HubBreakpointCondition = {
+        hitOp: BreakpointHitOp.Any,
+        hitValue: 0,
+        varname: '',
+        compareOp: BreakpointCompareOp.Equal,
+        value: null,
+    };
+
+    if (condition?.trim()) {
+        let match = CONDITION_RE.exec(condition);
+        if (match) {
+            result.varname = match[1];
+            result.compareOp = COMPARE_OPS[match[2]];
+            result.value = parseLiteral(match[3]);
+        } else if ((match = CONDITION_SWAPPED_RE.exec(condition))) {
+            result.varname = match[3];
+            result.compareOp = COMPARE_OPS[SWAPPED_OPS[match[2]]];
+            result.value = parseLiteral(match[1]);
+        } else {
+            return `Unsupported condition "${condition}", use: variable <op> value`;
+        }
+    }
+
+    if (hitCondition?.trim()) {
+        const match = HIT_CONDITION_RE.exec(hitCondition);
+        const n = match ? Number(match[2]) : NaN;
+        if (!match || n >= 0xffff || (match[1] !== '>' && n === 0)) {
+            return `Unsupported hit condition "${hitCondition}", use: n, >= n, > n, == n or % n`;
+        }
+        switch (match[1]) {
+            case '>':
+                result.hitOp = BreakpointHitOp.AtLeast;
+                result.hitValue = n + 1;
+                break;
+            case '==':
+            case '=':
+                result.hitOp = BreakpointHitOp.Equal;
+                result.hitValue = n;
+                break;
+            case '%':
+                result.hitOp = BreakpointHitOp.Every;
+                result.hitValue = n;
+                break;
+            default:
+                result.hitOp = BreakpointHitOp.AtLeast;
+                result.hitValue = n;
+                break;
+        }
+    }
+
+    return result.varname || result.hitOp !== BreakpointHitOp.Any ? result : undefined;
+}
@@ -9,7 +9,8 @@ import { compiledModules, CompileModule } from '../logic/compile';
 
 export const DEBUG_MODULE_NAME = 'dap_aipp_full'; // name of the module to import in user code - file name without .py
 // export const DEBUG_MODULE_NAME = 'dap_aipp_min'; // name of the module to import in user code - file name without .py
-export const DEBUG_ASSET_MODULES = [DEBUG_MODULE_NAME];
+export const AIPP_MODULE_NAME = 'aipp'; // shared AIPP tunnel module imported by the asset modules
+export const DEBUG_ASSET_MODULES = [DEBUG_MODULE_NAME, AIPP_MODULE_NAME];
 const DEBUG_TRAP_FUNCTION = 'dt_trap';
 // Quick stmt keyword test used both for analysis and for skipping trap insertion
 const STATEMENT_KEYWORD_RE =
@@ -21,10 +22,22 @@ export function PybricksDebugEnabled() {
     );
 }
 
-function canHaveBreakpoint(_path: string, _lineno: number, line: string) {
-    // check if lines is empty or line starts with a comment
-    return line.trim().length > 0 && !line.trim().startsWith('#');
-}
+// Simple statements a trap can be put in front of on the same line
+const TRAP_STATEMENTS = new Set([
+    'ExpressionStatement',
+    'AssignStatement',
+    'UpdateStatement',
+    'PassStatement',
+    'BreakStatement',
+    'ContinueStatement',
+    'ReturnStatement',
+    'RaiseStatement',
+    'DeleteStatement',
+    'AssertStatement',
+]);
+
+// Top-level statements the debug module import can be put in front of on the same line
+const IMPORT_STATEMENTS = new Set([...TRAP_STATEMENTS, 'ImportStatement']);
 
 export function checkLineForBreakpoint(path: string, lineno: number, _line: string) {
     return !!compiledModules?.get(path)?.breakpoints?.includes(lineno);
@@ -42,6 +55,8 @@ const MAX_TRAP_VARIABLES = 255;
 function analyzeVariablesWholeFile(source: string): {
     refsPerLine: string[][]; // variables to expose per 1-based line
     definedBeforeLine: Set<string>[]; // debugging: cumulative (global) definitions per line
+    statementLines: Set<number>; // 1-based lines starting with a simple statement
+    importLine?: number; // 1-based line of the first top-level simple statement
 } {
     const tree = rawParser.parse(source);
     const lines = source.split('\n');
@@ -67,6 +82,8 @@ function analyzeVariablesWholeFile(source: string): {
     }
 
     const refsPerLine: Array<Set<string>> = lines.map(() => new Set<string>());
+    const statementLines = new Set<number>();
+    let importLine: number | undefined;
     const definedBeforeLine: Set<string>[] = lines.map(() => new Set<string>());
 
     // Scope stack: each scope has a set of defined names
@@ -190,6 +207,33 @@ function analyzeVariablesWholeFile(source: string): {
                 scopeStack.push({ names: new Set<string>() });
             }
 
+            // Trap candidates: the statement starts the line, not a continuation line or
+            // a one-line body; docstrings are skipped
+            if (TRAP_STATEMENTS.has(type)) {
+                const lineNo = offsetToLine(node.from);
+                const lineText = lines[lineNo - 1];
+                const indent = lineText.length - lineText.trimStart().length;
+                const first = node.node.firstChild?.type.name;
+                if (
+                    node.from === lineStarts[lineNo - 1] + indent &&
+                    first !== 'String' &&
+                    first !== 'FormatString'
+                ) {
+                    statementLines.add(lineNo);
+                }
+            }
+
+            // The module level runs its statements in order, so the traps after the
+            // first top-level simple statement can use an import put in front of it
+            if (
+                importLine === undefined &&
+                IMPORT_STATEMENTS.has(type) &&
+                node.node.parent?.type.name === 'Script'
+            ) {
+                const lineNo = offsetToLine(node.from);
+                if (node.from === lineStarts[lineNo - 1]) importLine = lineNo;
+            }
+
             if (type !== 'VariableName') return;
 
             const sn = node.node;
@@ -237,13 +281,10 @@ function analyzeVariablesWholeFile(source: string): {
                 return;
             }
 
-            // Reference: include only if already defined in some scope (prior to this point)
-            // Check scopes from inner to outer
-            let defined = false;
-            for (let i = scopeStack.length - 1; i >= 0 && !defined; i--) {
-                if (scopeStack[i].names.has(name)) defined = true;
-            }
-            if (!defined) return;
+            // Reference: include only if already defined in the current scope (prior to
+            // this point); the trap assigns its variables, which would make names of an
+            // outer scope local to a function
+            if (!currentScope().names.has(name)) return;
 
             // Exclude if first defined on this same line
             if (lineFirstDefinitions.get(lineNo)?.has(name)) return;
@@ -270,15 +311,16 @@ function analyzeVariablesWholeFile(source: string): {
     return {
         refsPerLine: refsPerLine.map((s) => Array.from(s)),
         definedBeforeLine,
+        statementLines,
+        importLine,
     };
 }
 
-export function transformCodeForDebugTunnel(
-    module: CompileModule,
-    breakpointsInput: number[] = [],
-) {
+export function transformCodeForDebugTunnel(module: CompileModule) {
     const analysis = analyzeVariablesWholeFile(module.content);
     const refsPerLine = analysis.refsPerLine;
+    const statementLines = analysis.statementLines;
+    const importLine = analysis.importLine ?? Infinity;
 
     const lines = module.content.split('\n');
     const linesOut: string[] = [];
@@ -288,39 +330,44 @@ export function transformCodeForDebugTunnel(
         let line = lines[i];
         const lineno1 = i + 1;
 
+        // Import the debug module once, in front of the first top-level simple
+        // statement, keeping the line numbers of the module
+        const module_pre =
+            lineno1 === importLine ? `import ${DEBUG_MODULE_NAME}; ` : '';
+
         // If the line starts with a compound/skip keyword, leave it untouched
         // and do not add any debug trap here.
         if (STATEMENT_KEYWORD_RE.test(line)) {
-            linesOut.push(line);
+            linesOut.push(module_pre + line);
             continue;
         }
 
-        // If there are variable references to expose, or if the line is a user-set
-        // breakpoint, add a debug trap call at the start of the line.
+        // Add a debug trap call at the start of every line starting a simple statement,
+        // the hub skips the lines without a breakpoint (breakpoint bitmap), so
+        // breakpoints can be changed without a recompile.
         // example:
-        //    [i,j] = dap_aipp_full.dt_trap('simple1.py', 4, i=i, j=j); print(i,j)
-        //    dap_aipp_full.dt_trap('simple1.py', 5)
-        if (
-            checkLineForBreakpoint(module.path, lineno1, line) ||
-            (breakpointsInput.includes(lineno1) &&
-                canHaveBreakpoint(module.path, lineno1, line))
-        ) {
+        //    [i,j] = dap_aipp_full.dt_trap('simple1.py', 4, ['i','j'], [i,j]); print(i,j)
+        //    dap_aipp_full.dt_trap('simple1.py', 5, [], [])
+        // the traps before the module level import (in a function defined before it)
+        // import the module themselves
+        if (statementLines.has(lineno1)) {
             const indentation = line.match(/^\s*/)?.[0] ?? '';
             const vars = refsPerLine[lineno1 - 1].slice(0, MAX_TRAP_VARIABLES);
 
-            // e.g. import dap_aipp_full; [i,s,v2,x] = dap_aipp_full.dt_trap('simple1.py', 33, ['i', 's', 'v2', 'x'], [i, s, v2, x]); print(i,s,v2,x)
+            // e.g. [i,s,v2,x] = dap_aipp_full.dt_trap('simple1.py', 33, ['i', 's', 'v2', 'x'], [i, s, v2, x]); print(i,s,v2,x)
             // return values as list [i, j] = ...
             const varspre = vars.length ? `[${vars.join(',')}] = ` : '';
             // exposed keys and values as two lists
             const varnames = `[${vars.map((v) => `'${v}'`).join(', ')}]`;
             const varvalues = `[${vars.map((v) => `${v}`).join(', ')}]`;
-            const line_pre = `import ${DEBUG_MODULE_NAME}; ${varspre}${DEBUG_MODULE_NAME}.${DEBUG_TRAP_FUNCTION}('${module.filename}', ${lineno1}, ${varnames}, ${varvalues})`;
+            const import_pre =
+                lineno1 < importLine ? `import ${DEBUG_MODULE_NAME}; ` : '';
+            const line_pre = `${import_pre}${varspre}${DEBUG_MODULE_NAME}.${DEBUG_TRAP_FUNCTION}('${module.filename}', ${lineno1}, ${varnames}, ${varvalues})`;
             line = `${indentation}${line_pre}; ${line.trimStart()}`;
 
             breakpointsCompiled.add(lineno1);
-            if (!breakpointsInput.includes(lineno1)) breakpointsInput.push(lineno1);
         }
-        linesOut.push(line);
+        linesOut.push(module_pre + line);
     }
 
     module.content = linesOut.join('\n');
@@ -21,9 +21,14 @@ import { basename } from 'path';
 import { DebugTerminal, logDebug } from '../extension/debug-channel';
 import { showWarning } from '../extension/diagnostics';
 import { runPhase1Async, runPhase2Async } from '../logic/run';
+import {
+    ContainerValue,
+    DeferredValue,
+} from '../pybricks/appdata-instrumentation-protocol';
 import { DebugTunnel } from './debug-tunnel';
 import {
     FileAccessor,
+    formatValue,
     IRuntimeBreakpoint,
     IRuntimeVariableType,
     PybricksTunnelDebugRuntime,
@@ -242,6 +247,11 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
         // make VS Code send setVariable request
         response.body.supportsSetVariable = true;
 
+        // conditions and hit counts of breakpoints are evaluated on the hub
+        response.body.supportsConditionalBreakpoints = true;
+        response.body.supportsHitConditionalBreakpoints = true;
+        response.body.supportsLogPoints = true;
+
         // make VS Code send setExpression request
         // response.body.supportsSetExpression = true;
 
@@ -372,22 +382,27 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
         args: DebugProtocol.SetBreakpointsArguments,
     ): Promise<void> {
         const path = args.source.path as string;
-        const clientLines = args.lines || [];
+        const clientBreakpoints: DebugProtocol.SourceBreakpoint[] =
+            args.breakpoints ?? (args.lines ?? []).map((line) => ({ line }));
 
         // clear all breakpoints for this file
         this._runtime.clearBreakpoints(path);
 
-        // set and verify breakpoint locations
-        const actualBreakpoints0 = clientLines.map(async (l) => {
-            const { verified, line, id } = await this._runtime.setBreakPoint(
+        // set and verify breakpoint locations, conditions are evaluated on the hub
+        const actualBreakpoints0 = clientBreakpoints.map(async (sbp) => {
+            const { verified, line, id, message } = await this._runtime.setBreakPoint(
                 path,
-                this.convertClientLineToDebugger(l),
+                this.convertClientLineToDebugger(sbp.line),
+                sbp.condition,
+                sbp.hitCondition,
+                sbp.logMessage,
             );
             const bp = new Breakpoint(
                 verified,
                 this.convertDebuggerLineToClient(line),
             ) as DebugProtocol.Breakpoint;
             bp.id = id;
+            bp.message = message;
             return bp;
         });
         const actualBreakpoints = await Promise.all<DebugProtocol.Breakpoint>(
@@ -399,6 +414,9 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
             breakpoints: actualBreakpoints,
         };
         this.sendResponse(response);
+
+        // update the running program, traps are compiled in on every line
+        await DebugTunnel.performSetBreakpoints(path);
     }
 
     protected override breakpointLocationsRequest(
@@ -580,7 +598,7 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
     //     this.sendResponse(response);
     // }
 
-    // eslint-disable-next-line @typescript-eslint/no-misused-promises, @typescript-eslint/require-await
+    // eslint-disable-next-line @typescript-eslint/no-misused-promises
     protected override async variablesRequest(
         response: DebugProtocol.VariablesResponse,
         args: DebugProtocol.VariablesArguments,
@@ -591,6 +609,17 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
         const v = this._variableHandles.get(args.variablesReference);
         if (v === 'locals') {
             vs = this._runtime.getLocalVariables();
+        } else if (v && v.value instanceof DeferredValue) {
+            // lazy variable expanded: fetch its value from the hub
+            await this._runtime.fetchVariable(v);
+            vs = [v];
+        } else if (v && v.value instanceof ContainerValue) {
+            // paged by VS Code for long containers, missing pages come from the hub
+            vs = await this._runtime.getVariableItems(
+                v,
+                args.start ?? 0,
+                args.count || v.value.length,
+            );
         } else if (v && Array.isArray(v.value)) {
             vs = v.value;
         }
@@ -791,17 +820,18 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
             evaluateName: '$' + v.name,
         };
 
-        // if (v.name.indexOf('lazy') >= 0) {
-        //     // a "lazy" variable needs an additional click to retrieve its value
-
-        //     dapVariable.value = 'lazy var'; // placeholder value
-        //     v.reference ??= this._variableHandles.create(
-        //         new RuntimeVariable('', [new RuntimeVariable('', v.value)]),
-        //     );
-        //     dapVariable.variablesReference = v.reference;
-        //     dapVariable.presentationHint = { lazy: true };
-        // } else {
-        if (Array.isArray(v.value)) {
+        if (v.value instanceof DeferredValue) {
+            // a "lazy" variable needs an additional click to retrieve its value
+            dapVariable.value = `str (${v.value.size} characters)`; // placeholder value
+            v.reference ??= this._variableHandles.create(v);
+            dapVariable.variablesReference = v.reference;
+            dapVariable.presentationHint = { lazy: true };
+        } else if (v.value instanceof ContainerValue) {
+            dapVariable.value = formatValue(v.value);
+            v.reference ??= this._variableHandles.create(v);
+            dapVariable.variablesReference = v.reference;
+            dapVariable.indexedVariables = v.value.length;
+        } else if (Array.isArray(v.value)) {
             dapVariable.value = 'Object';
             v.reference ??= this._variableHandles.create(v);
             dapVariable.variablesReference = v.reference;
@@ -819,7 +849,8 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
                     }
                     break;
                 case 'string':
-                    dapVariable.value = `"${v.value}"`;
+                    // a truncated string is marked as continuing
+                    dapVariable.value = v.truncated ? `"${v.value}…` : `"${v.value}"`;
                     break;
                 case 'boolean':
                     dapVariable.value = v.value ? 'True' : 'False';
@@ -830,7 +861,6 @@ export class PybricksTunnelDebugSession extends LoggingDebugSession {
                     break;
             }
         }
-        // }
 
         // if (v.memory) {
         //     v.reference ??= this._variableHandles.create(v);
@@ -1,18 +1,32 @@
+import * as path from 'path';
 import * as vscode from 'vscode';
 
 import { ConnectionManager } from '../communication/connection-manager';
 import { showWarning } from '../extension/diagnostics';
+import { compiledModules } from '../logic/compile';
 import { hasState, onStateChange, StateChangeEvent, StateProp } from '../logic/state';
+import { CreditGranter } from '../pybricks/appdata-credits';
 import {
     AppDataInstrumentationPybricksProtocol,
+    DebugMessage,
     DebugSubCode,
     DebugVarType,
+    encodeMessageRaw,
     Message,
     MessageType,
 } from '../pybricks/appdata-instrumentation-protocol';
+import { SequencedLink } from '../pybricks/appdata-sequenced-link';
 import { sleep } from '../utils';
 import { IRuntimeVariableType, PybricksTunnelDebugRuntime } from './runtime';
 
+const GETVAR_MAX = 512; // longest string value fetched from the hub
+const GETVAR_TIMEOUT = 3000; // ms
+
+type GetVariableResult = Extract<
+    DebugMessage,
+    { subcode: DebugSubCode.GetVariableResponse }
+>;
+
 type HubDebugMessage =
     | {
           type: 'start';
@@ -29,6 +43,13 @@ type HubDebugMessage =
 class DebugTunnel {
     static _runtime: PybricksTunnelDebugRuntime | undefined;
     static _state_isTrapped: boolean = false;
+    static _state_isStarted: boolean = false;
+    private static pendingGetVariable = new Map<
+        string,
+        (result: GetVariableResult | undefined) => void
+    >();
+    // one request at a time, pages of the same variable are told apart by order
+    private static getVariableQueue: Promise<unknown> = Promise.resolve();
 
     static isDebugging(): boolean {
         return this._runtime !== undefined;
@@ -52,6 +73,7 @@ class DebugTunnel {
         switch (message.type) {
             case 'start':
                 this._state_isTrapped = false;
+                this._state_isStarted = true;
                 break;
             case 'trap':
                 this._state_isTrapped = true;
@@ -63,25 +85,66 @@ class DebugTunnel {
     }
 
     public static async sendToHub(message: Message) {
-        const client = ConnectionManager.client;
-        const encodeds = AppDataInstrumentationPybricksProtocol.encode(message);
-        // logDebug(
-        //     `Sending to hub: ${encodeds
-        //         .map((encoded) => bufferToHexString(encoded))
-        //         .join(' | ')}`,
-        // );
+        // logDebug(`Sending to hub: ${JSON.stringify(message)}`);
         await sleep(100); // small delay to avoid congestion
-        for (const encoded of encodeds) {
-            await client?.action_sendAppData(encoded);
-            // logDebug(`Sent to hub: ${Buffer.from(encoded).toString('hex')}`); //!!
+        // the link times its round trips from here, after the delay
+        const link = AppDataInstrumentationPybricksProtocol.link;
+        if (link) {
+            await link.send(encodeMessageRaw(message));
+        } else {
+            await this.writeToHub(encodeMessageRaw(message));
         }
     }
 
+    private static writeQueue: Promise<void> = Promise.resolve();
+
+    /**
+     * Write one framed message, queued so that the chunks of link retransmits, acks and
+     * messages never interleave.
+     */
+    private static writeToHub(raw: Uint8Array, alternate = false): Promise<void> {
+        const encodeds = AppDataInstrumentationPybricksProtocol.frame(raw, alternate);
+        const write = this.writeQueue.then(async () => {
+            const client = ConnectionManager.client;
+            for (const encoded of encodeds) {
+                await client?.action_sendAppData(encoded);
+                // logDebug(`Sent to hub: ${Buffer.from(encoded).toString('hex')}`); //!!
+            }
+        });
+        this.writeQueue = write.catch(() => {});
+        return write;
+    }
+
+    /**
+     * Switch to sequenced frames (negotiated CAP_SEQ) or back to legacy framing.
+     */
+    public static setSequencedLink(enabled: boolean) {
+        AppDataInstrumentationPybricksProtocol.link?.dispose();
+        AppDataInstrumentationPybricksProtocol.link = enabled
+            ? new SequencedLink((frame) => this.writeToHub(frame, true))
+            : undefined;
+    }
+
+    public static setCrcFraming(enabled: boolean) {
+        AppDataInstrumentationPybricksProtocol.crc = enabled;
+    }
+
+    /**
+     * Grant the hub credits for its chunks (negotiated CAP_CREDITS), or stop granting.
+     * Grants go out unsequenced and without the congestion delay of sendToHub.
+     */
+    public static setCreditGrants(enabled: boolean) {
+        AppDataInstrumentationPybricksProtocol.credits = enabled
+            ? new CreditGranter((message) => this.writeToHub(message))
+            : undefined;
+    }
+
     public static registerRuntime(value: PybricksTunnelDebugRuntime) {
         this._runtime = value;
     }
 
     public static async deregisterRuntime() {
+        this._state_isStarted = false;
         if (this._runtime) {
             this._runtime.endSession();
             // this._runtime.dispose();
@@ -99,6 +162,7 @@ class DebugTunnel {
     }
 
     public static async stopSession() {
+        this._state_isStarted = false;
         if (this._runtime) {
             this._runtime.endSession();
             // this._runtime.dispose();
@@ -121,6 +185,93 @@ class DebugTunnel {
         });
     }
 
+    /**
+     * Send the breakpoint lines of the compiled files (or of filepath only) to the hub,
+     * which skips the traps of all other lines without a recompile, followed by the
+     * breakpoint conditions the hub evaluates itself.
+     */
+    public static async performSetBreakpoints(filepath?: string) {
+        if (!this._runtime || !this._state_isStarted) return;
+        for (const module of compiledModules.values()) {
+            if (!module.breakpoints?.length) continue; // no traps compiled in
+            if (filepath && path.basename(filepath) !== path.basename(module.filename))
+                continue;
+            const bps = this._runtime.getBreakpointsOfFile(module.filename);
+            await this.sendToHub({
+                Id: MessageType.DebugAcknowledge,
+                subcode: DebugSubCode.BreakpointsRequest,
+                filename: module.filename,
+                lines: bps.map((bp) => bp.line),
+                step: this._runtime.isStepping(),
+            });
+            const logpoints = bps.filter((bp) => bp.logMessage).map((bp) => bp.line);
+            if (logpoints.length) {
+                await this.sendToHub({
+                    Id: MessageType.DebugAcknowledge,
+                    subcode: DebugSubCode.LogpointsRequest,
+                    filename: module.filename,
+                    lines: logpoints,
+                });
+            }
+            for (const bp of bps) {
+                if (!bp.condition) continue;
+                await this.sendToHub({
+                    Id: MessageType.DebugAcknowledge,
+                    subcode: DebugSubCode.ConditionRequest,
+                    filename: module.filename,
+                    line: bp.line,
+                    ...bp.condition,
+                });
+            }
+        }
+    }
+
+    /**
+     * Fetch the value of a variable the hub deferred in the trap, or a page of a
+     * container: elements start to start + count of the value at path.
+     * Resolves undefined if the hub does not answer or continued meanwhile.
+     */
+    public static performGetVariable(
+        varname: string,
+        page: { path?: number[]; start?: number; count?: number } = {},
+    ): Promise<GetVariableResult | undefined> {
+        const request = this.getVariableQueue.then(() =>
+            this.requestVariable(varname, page),
+        );
+        this.getVariableQueue = request.catch(() => {});
+        return request;
+    }
+
+    private static async requestVariable(
+        varname: string,
+        page: { path?: number[]; start?: number; count?: number },
+    ): Promise<GetVariableResult | undefined> {
+        if (!this._state_isTrapped) return undefined;
+        let done: (result: GetVariableResult | undefined) => void = () => {};
+        const result = new Promise<GetVariableResult | undefined>((resolve) => {
+            done = resolve;
+            setTimeout(() => resolve(undefined), GETVAR_TIMEOUT);
+        });
+        this.pendingGetVariable.set(varname, done);
+        await this.sendToHub({
+            Id: MessageType.DebugAcknowledge,
+            subcode: DebugSubCode.GetVariableRequest,
+            varname,
+            max: GETVAR_MAX,
+            ...page,
+        });
+        const response = await result;
+        if (this.pendingGetVariable.get(varname) === done)
+            this.pendingGetVariable.delete(varname);
+        return response;
+    }
+
+    public static onGetVariableResponse(message: GetVariableResult) {
+        const resolve = this.pendingGetVariable.get(message.varname);
+        this.pendingGetVariable.delete(message.varname);
+        resolve?.(message);
+    }
+
     public static async performSetVariable(
         _varName: string,
         value: IRuntimeVariableType,
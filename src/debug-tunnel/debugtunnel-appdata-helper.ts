@@ -1,31 +1,109 @@
 import { logDebug } from '../extension/debug-channel';
 import { showWarning } from '../extension/diagnostics';
+import { AIPP_CAP_CREDITS } from '../pybricks/appdata-credits';
 import {
+    AIPP_CAP_COALESCE,
+    AIPP_CAP_COMPACT,
+    AIPP_CAP_CONTAINERS,
+    AIPP_CAP_CRC,
+    AIPP_CAP_DELTA_NOTIF,
+    AIPP_CAP_LAZY_VALUES,
+    AIPP_CAP_MONITOR,
+    AIPP_CAP_SCHEDULE,
+    AIPP_CAP_TRAP_DELTA,
     DebugMessage,
     DebugSubCode,
-    DebugVarType,
+    DebugTrapValue,
     MessageType,
+    MonitorRate,
+    resetTrapDelta,
 } from '../pybricks/appdata-instrumentation-protocol';
+import { AIPP_CAP_SEQ } from '../pybricks/appdata-sequenced-link';
+import {
+    DeviceNotificationMessageType,
+    DeviceNotificationPort,
+} from '../spike/utils/device-notification-parser';
 import { DebugTunnel } from './debug-tunnel';
 
+// a source sampled this much slower than its target is reported as lagging
+const MONITOR_LAG_RATIO = 1.25;
+
+let lastMonitorRates: MonitorRate[] = [];
+export function getLastMonitorRates() {
+    return lastMonitorRates;
+}
+
 export async function handleIncomingAIPPDebug(message: DebugMessage): Promise<void> {
     if (message.Id !== MessageType.DebugNotification) return;
     switch (message.subcode) {
         case DebugSubCode.StartNotification: {
             // Start
 
-            // send acknowledge
+            // a monitor program only negotiates its encoding, there is nothing to debug
+            const offered = message.caps ?? 0;
+            if (offered & AIPP_CAP_MONITOR) {
+                const agreed =
+                    offered &
+                    (AIPP_CAP_MONITOR |
+                        AIPP_CAP_COMPACT |
+                        AIPP_CAP_CRC |
+                        AIPP_CAP_COALESCE |
+                        AIPP_CAP_DELTA_NOTIF |
+                        AIPP_CAP_SCHEDULE |
+                        AIPP_CAP_CREDITS);
+                DebugTunnel.setSequencedLink(false);
+                DebugTunnel.setCrcFraming(false);
+                DebugTunnel.setCreditGrants(false);
+                await DebugTunnel.sendToHub({
+                    Id: MessageType.DebugAcknowledge,
+                    subcode: DebugSubCode.StartAcknowledge,
+                    success: true,
+                    caps: agreed,
+                });
+                DebugTunnel.setCrcFraming(!!(agreed & AIPP_CAP_CRC));
+                DebugTunnel.setCreditGrants(!!(agreed & AIPP_CAP_CREDITS));
+                break;
+            }
+
+            // send acknowledge, agree on sequenced frames, delta traps, deferred
+            // values, paged containers, compact values, CRC framing, coalescing and
+            // credits if offered
             const canAcknoledge = DebugTunnel.isDebugging();
+            const caps =
+                offered &
+                (AIPP_CAP_SEQ |
+                    AIPP_CAP_TRAP_DELTA |
+                    AIPP_CAP_LAZY_VALUES |
+                    AIPP_CAP_CONTAINERS |
+                    AIPP_CAP_COMPACT |
+                    AIPP_CAP_CRC |
+                    AIPP_CAP_COALESCE |
+                    AIPP_CAP_CREDITS);
+            resetTrapDelta();
+            DebugTunnel.setSequencedLink(false); // the handshake itself is unsequenced
+            DebugTunnel.setCrcFraming(false); // and sum framed
+            DebugTunnel.setCreditGrants(false);
             await DebugTunnel.sendToHub({
                 Id: MessageType.DebugAcknowledge,
                 subcode: DebugSubCode.StartAcknowledge,
                 success: canAcknoledge,
+                caps: caps ? caps : undefined,
             });
+            DebugTunnel.setSequencedLink(canAcknoledge && !!(caps & AIPP_CAP_SEQ));
+            DebugTunnel.setCrcFraming(canAcknoledge && !!(caps & AIPP_CAP_CRC));
+            DebugTunnel.setCreditGrants(canAcknoledge && !!(caps & AIPP_CAP_CREDITS));
 
             // send to debug tunnel
             if (canAcknoledge) {
                 logDebug('🐞 Hub started debug session');
                 await DebugTunnel.onHubMessage({ type: 'start' });
+                // enable the traps of the breakpoint lines only; the first trap of
+                // the hub waits for all of them, files without a bitmap never stop
+                await DebugTunnel.performSetBreakpoints();
+                await DebugTunnel.sendToHub({
+                    Id: MessageType.DebugAcknowledge,
+                    subcode: DebugSubCode.BreakpointsDone,
+                });
             } else {
                 showWarning('No debugger connected, not acknowledging start.');
             }
@@ -38,7 +116,7 @@ export async function handleIncomingAIPPDebug(message: DebugMessage): Promise<vo
             const message1 = message as DebugMessage & {
                 filename: string;
                 line: number;
-                variables: Map<string, DebugVarType>;
+                variables: Map<string, DebugTrapValue>;
             };
             const filename = message1.filename;
             const line = message1.line;
@@ -55,7 +133,8 @@ export async function handleIncomingAIPPDebug(message: DebugMessage): Promise<vo
             // send acknowledge
             const canAcknowledge =
                 DebugTunnel.isDebugging() &&
-                !!DebugTunnel._runtime?.canStopOnLocation(filename, line);
+                (!!DebugTunnel._runtime?.isStepping() ||
+                    !!DebugTunnel._runtime?.canStopOnLocation(filename, line));
             await DebugTunnel.sendToHub({
                 Id: MessageType.DebugAcknowledge,
                 subcode: DebugSubCode.TrapAcknowledge,
@@ -72,6 +151,48 @@ export async function handleIncomingAIPPDebug(message: DebugMessage): Promise<vo
             break;
         }
 
+        case DebugSubCode.LogNotification: {
+            // Logpoint hits, batched by the hub which did not stop
+            for (const entry of message.entries) {
+                if (entry.subcode !== DebugSubCode.TrapNotification) continue;
+                DebugTunnel._runtime?.onHubLogpoint(
+                    entry.filename,
+                    entry.line,
+                    entry.variables ?? new Map(),
+                );
+            }
+            DebugTunnel._runtime?.onHubLogDropped(message.dropped);
+            break;
+        }
+
+        case DebugSubCode.GetVariableResponse: {
+            // deferred value or container page requested by the Variables view
+            DebugTunnel.onGetVariableResponse(message);
+            break;
+        }
+
+        case DebugSubCode.MonitorRatesNotification: {
+            // target and actual sampling period of each hub monitor source
+            lastMonitorRates = message.rates;
+            for (const rate of message.rates) {
+                const port =
+                    rate.port === undefined
+                        ? ''
+                        : `[${DeviceNotificationPort[rate.port]}]`;
+                const lagging =
+                    rate.targetMs > 0 &&
+                    rate.actualMs > rate.targetMs * MONITOR_LAG_RATIO;
+                logDebug(
+                    `${lagging ? '🐢' : '⏱️'} Hub monitor ${
+                        DeviceNotificationMessageType[rate.type]
+                    }${port}: every ${rate.actualMs || '-'} ms, target ${
+                        rate.targetMs || 'paused'
+                    }`,
+                );
+            }
+            break;
+        }
+
         case DebugSubCode.ContinueResponse: {
             const message1 = message as DebugMessage & { step: boolean };
             const step = message1.step;
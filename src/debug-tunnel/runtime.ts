@@ -2,6 +2,12 @@
 
 import { EventEmitter } from 'events';
 import * as path from 'path';
+import {
+    ContainerValue,
+    DebugVarTypeEnum,
+    DeferredValue,
+} from '../pybricks/appdata-instrumentation-protocol';
+import { HubBreakpointCondition, parseBreakpointCondition } from './breakpoint-condition';
 import { checkLineForBreakpoint } from './compile-helper';
 import { DebugTunnel } from './debug-tunnel';
 
@@ -15,6 +21,9 @@ export interface IRuntimeBreakpoint {
     id: number;
     line: number;
     verified: boolean;
+    condition?: HubBreakpointCondition; // evaluated on the hub
+    logMessage?: string; // logpoint: the hub logs the variables and does not stop
+    message?: string; // why the breakpoint is not verified
 }
 
 interface IRuntimeStackFrame {
@@ -30,12 +39,46 @@ interface IRuntimeStack {
     frames: IRuntimeStackFrame[];
 }
 
-export type IRuntimeVariableType = number | boolean | string | null | RuntimeVariable[];
+export type IRuntimeVariableType =
+    | number
+    | boolean
+    | string
+    | null
+    | RuntimeVariable[]
+    | DeferredValue
+    | ContainerValue;
+
+/**
+ * Text of a value as in the log of a logpoint, containers show the elements received
+ * so far.
+ */
+export function formatValue(value: IRuntimeVariableType): string {
+    if (value instanceof DeferredValue) return `<${value.size} characters>`;
+    if (!(value instanceof ContainerValue)) return JSON.stringify(value);
+    const items = value.items.map((item, i) =>
+        value.keys
+            ? `${formatValue(value.keys[i])}: ${formatValue(item)}`
+            : formatValue(item),
+    );
+    if (value.start > 0) items.unshift('…');
+    if (value.start + value.items.length < value.length) items.push('…');
+    const text = items.join(', ');
+    switch (value.type) {
+        case DebugVarTypeEnum.Tuple:
+            return `(${text})`;
+        case DebugVarTypeEnum.Dict:
+            return `{${text}}`;
+        default:
+            return `[${text}]`;
+    }
+}
 
 export class RuntimeVariable {
     private _memory?: Uint8Array;
 
     public reference?: number;
+    public truncated = false; // the hub sent the start of a longer string only
+    public items: RuntimeVariable[] = []; // container elements received so far, sparse
 
     public get value() {
         return this._value;
@@ -55,7 +98,42 @@ export class RuntimeVariable {
         return this._memory;
     }
 
-    constructor(public readonly name: string, private _value: IRuntimeVariableType) {}
+    /**
+     * @param root exposed variable on the hub this value belongs to
+     * @param path element indexes of the value within the root variable
+     */
+    constructor(
+        public readonly name: string,
+        private _value: IRuntimeVariableType,
+        public readonly root = name,
+        public readonly path: number[] = [],
+    ) {
+        if (_value instanceof ContainerValue) this.addPage(_value);
+    }
+
+    /**
+     * Add the elements of a container page fetched from the hub.
+     */
+    public addPage(page: ContainerValue) {
+        page.items.forEach((item, i) => {
+            const index = page.start + i;
+            const name = page.keys ? formatValue(page.keys[i]) : String(index);
+            this.items[index] = new RuntimeVariable(name, item, this.root, [
+                ...this.path,
+                index,
+            ]);
+        });
+    }
+
+    /**
+     * Replace a deferred value with the value fetched from the hub, without setting it
+     * on the hub.
+     */
+    public resolve(value: IRuntimeVariableType, truncated: boolean) {
+        this._value = value;
+        this.truncated = truncated;
+        this._memory = undefined;
+    }
 
     public setMemory(data: Uint8Array, offset = 0) {
         //!! //??
@@ -117,6 +195,9 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
     // 'step' => stop on any trap
     private resumeMode: 'continue' | 'step' = 'continue';
 
+    // logpoint hits the hub reported as dropped so far
+    private logDropped = 0;
+
     // since we want to send breakpoint events, we will assign an id to every event
     // so that the frontend can match events with breakpoints.
     private breakpointId = 1;
@@ -193,6 +274,9 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
     public async setBreakPoint(
         path: string,
         line: number,
+        condition?: string,
+        hitCondition?: string,
+        logMessage?: string,
     ): Promise<IRuntimeBreakpoint> {
         path = this.normalizePathAndCasing(path);
 
@@ -201,6 +285,10 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
             line,
             id: this.breakpointId++,
         };
+        const parsed = parseBreakpointCondition(condition, hitCondition);
+        if (typeof parsed === 'string') bp.message = parsed;
+        else bp.condition = parsed;
+        if (logMessage) bp.logMessage = logMessage;
         let bps = this.breakPoints.get(path);
         if (!bps) {
             bps = new Array<IRuntimeBreakpoint>();
@@ -268,18 +356,90 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
         return this.variables.get(name);
     }
 
-    public canStopOnLocation(filename: string, line: number): boolean {
-        // receives filename only, with not path
+    /**
+     * Fetch a value the hub deferred in the trap, resolving the variable in place.
+     */
+    public async fetchVariable(v: RuntimeVariable): Promise<void> {
+        if (!(v.value instanceof DeferredValue)) return;
+        const result = await DebugTunnel.performGetVariable(v.root, { path: v.path });
+        if (result?.found) v.resolve(result.value, result.truncated);
+    }
+
+    /**
+     * Elements start to start + count of a container, the pages not received yet are
+     * fetched from the hub.
+     */
+    public async getVariableItems(
+        v: RuntimeVariable,
+        start: number,
+        count: number,
+    ): Promise<RuntimeVariable[]> {
+        const container = v.value;
+        if (!(container instanceof ContainerValue)) return [];
+        const end = Math.min(start + count, container.length);
+        for (let i = start; i < end; i++) {
+            if (v.items[i]) continue;
+            const result = await DebugTunnel.performGetVariable(v.root, {
+                path: v.path,
+                start: i,
+                count: end - i,
+            });
+            const page = result?.found ? result.value : undefined;
+            if (!(page instanceof ContainerValue) || !page.items.length) break;
+            v.addPage(page);
+            i += page.items.length - 1;
+        }
+        return v.items.slice(start, end).filter((item) => item !== undefined);
+    }
+
+    public getBreakpointsOfFile(filename: string): IRuntimeBreakpoint[] {
+        // receives filename only, with not path; breakpoints with an invalid condition
+        // are left out
         const filepath = [...this.breakPoints.keys()].find((f) => {
             return path.basename(f) === path.basename(filename);
         });
+        return (this.breakPoints.get(filepath ?? '') ?? []).filter((bp) => !bp.message);
+    }
 
-        const bps = this.breakPoints.get(filepath ?? '');
-        if (bps) {
-            const matched = bps.filter((bp) => bp.line === line);
-            return matched.length > 0;
-        }
-        return false;
+    /**
+     * Print a logpoint hit the hub sent without stopping,
+     * {name} in the log message is replaced by the value of the variable.
+     */
+    public onHubLogpoint(
+        filename: string,
+        line: number,
+        vars: Map<string, IRuntimeVariableType>,
+    ): void {
+        const bp = this.getBreakpointsOfFile(filename).find((bp) => bp.line === line);
+        const values = Array.from(
+            vars,
+            ([name, value]) => `${JSON.stringify(name)}:${formatValue(value)}`,
+        );
+        const text = bp?.logMessage
+            ? bp.logMessage.replace(/\{\s*(\w+)\s*\}/g, (match, name: string) =>
+                  vars.has(name) ? formatValue(vars.get(name) ?? null) : match,
+              )
+            : `${path.basename(filename)}:${line} {${values.join(',')}}`;
+        this.output(text, 'out', this._sourceFile, line - 1);
+    }
+
+    public onHubLogDropped(dropped: number): void {
+        // the hub counts all drops of the session (uint16)
+        const lost = (dropped - this.logDropped) & 0xffff;
+        this.logDropped = dropped;
+        if (lost) this.output(`${lost} logpoint hits dropped by the hub`, 'err');
+    }
+
+    public isStepping(): boolean {
+        return this.resumeMode === 'step';
+    }
+
+    public canStopOnLocation(filename: string, line: number): boolean {
+        // the breakpoints sent to the hub, as getBreakpointsOfFile, less the logpoints
+        // the hub logs without stopping
+        return this.getBreakpointsOfFile(filename).some(
+            (bp) => bp.line === line && !bp.logMessage,
+        );
     }
 
     public onHubTrapped(line?: number): void {
@@ -304,8 +464,8 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
                 if (this.canStopOnLocation(this._sourceFile, this.currentLine)) {
                     this.sendEvent('stopOnBreakpoint');
                 } else {
-                    // no dedicated breakpoint -> ignore trap during continue, step to next trap
-                    void DebugTunnel.performContinueAfterTrap(true);
+                    // no dedicated breakpoint -> ignore trap during continue, run to next breakpoint
+                    void DebugTunnel.performContinueAfterTrap(false);
                 }
             } else {
                 // step mode: stop on any trap
@@ -378,7 +538,7 @@ export class PybricksTunnelDebugRuntime extends EventEmitter {
         if (bps) {
             await this.loadSource(path);
             bps.forEach((bp) => {
-                if (!bp.verified && bp.line < this.sourceLines.length) {
+                if (!bp.verified && !bp.message && bp.line < this.sourceLines.length) {
                     const srcLine = this.getLine(bp.line);
 
                     // we only allow specific lines for breakpoints:
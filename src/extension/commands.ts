@@ -6,13 +6,16 @@ import { compileAndRunAsync, compileOnlyAsync } from '../commands/compile-and-ru
 import { connectDeviceAsyncAny } from '../commands/connect-device';
 import { PromptDeviceNotificationPlotFilter } from '../commands/device-notifications';
 import { disconnectDeviceAsync } from '../commands/disconnect-device';
+import { PromptHubMonitorPeriods } from '../commands/hub-monitor-periods';
 import { moveSlotAny } from '../commands/move-slot';
+import { PromptPlotDownsampling } from '../commands/plot-downsampling';
 import { startUserProgramAsync } from '../commands/start-user-program';
 import { stopUserProgramAsync } from '../commands/stop-user-program';
 import { DeviceOSType, StartMode } from '../communication/clients/base-client';
 import { ConnectionManager } from '../communication/connection-manager';
 import { BLOCKLYPY_COMMANDS_VIEW_ID, EXTENSION_KEY } from '../const';
-import { loadPythonAssetModule } from '../logic/compile';
+import { AIPP_MODULE_NAME } from '../debug-tunnel/compile-helper';
+import { inlinePythonAssetModules, loadPythonAssetModule } from '../logic/compile';
 import { hasState, StateProp } from '../logic/state';
 import { plotManager } from '../plot/plot';
 import { getActiveFileFolder, getDateTimeString } from '../utils/files';
@@ -24,6 +27,9 @@ import { showInfo, showWarning } from './diagnostics';
 import { RefreshTree } from './tree-commands';
 import { openOrActivate as openOrActivateAsync, wrapErrorHandling } from './utils';
 
+// characters of the inlined Hub Monitor script pasted to the REPL, parsed on the hub
+const HUB_MONITOR_MAX_SIZE = 25 * 1024;
+
 // Define the BlocklyPyCommand enum for all command strings
 export enum Commands {
     ConnectDevice = EXTENSION_KEY + '.connectDevice',
@@ -53,8 +59,10 @@ export enum Commands {
     DatalogClear = EXTENSION_KEY + '.datalogClear',
     PromptDeviceNotificationPlotFilter = EXTENSION_KEY +
         '.promptDeviceNotificationPlotFilter',
+    PromptPlotDownsampling = EXTENSION_KEY + '.promptPlotDownsampling',
     StartREPL = EXTENSION_KEY + '.startREPL',
     StartHubMonitor = EXTENSION_KEY + '.startHubMonitor',
+    PromptHubMonitorPeriods = EXTENSION_KEY + '.promptHubMonitorPeriods',
     // StartJupyter = EXTENSION_KEY + '.startJupyter',
 }
 
@@ -236,6 +244,12 @@ export const CommandMetaData: CommandMetaDataEntryExtended[] = [
             await PromptDeviceNotificationPlotFilter();
         },
     },
+    {
+        command: Commands.PromptPlotDownsampling,
+        handler: async () => {
+            await PromptPlotDownsampling();
+        },
+    },
     {
         command: Commands.StartREPL,
         handler: async () => {
@@ -269,13 +283,19 @@ export const CommandMetaData: CommandMetaDataEntryExtended[] = [
 
             const { uri, content } = await loadPythonAssetModule('hubmonitor.min.py');
             if (!uri || !content) throw new Error('Hub Monitor script not found.');
+            const script = await inlinePythonAssetModules(content, [AIPP_MODULE_NAME]);
+            if (script.length > HUB_MONITOR_MAX_SIZE) {
+                throw new Error(
+                    `Hub Monitor script is too large (${script.length} of ${HUB_MONITOR_MAX_SIZE} characters).`,
+                );
+            }
 
             await vscode.window.withProgress(
                 {
                     location: { viewId: BLOCKLYPY_COMMANDS_VIEW_ID },
                 },
                 async () => {
-                    await client.action_start(StartMode.REPL, content);
+                    await client.action_start(StartMode.REPL, script);
                     logDebug(
                         `📡 Started Hub Monitor from ${path.basename(
                             uri.fsPath,
@@ -285,6 +305,12 @@ export const CommandMetaData: CommandMetaDataEntryExtended[] = [
             );
         },
     },
+    {
+        command: Commands.PromptHubMonitorPeriods,
+        handler: async () => {
+            await PromptHubMonitorPeriods();
+        },
+    },
 ];
 
 export type CommandMetaDataEntry = {
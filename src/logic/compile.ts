@@ -31,20 +31,6 @@ export type CompileModule = {
     mpy?: Uint8Array; // filled after compilation
 };
 
-function getBreakpointsFromEditors(): Map<string, number[]> {
-    const breakpointsByFile = new Map<string, number[]>();
-
-    for (const bp of vscode.debug.breakpoints) {
-        if (bp instanceof vscode.SourceBreakpoint) {
-            const uripath = bp.location.uri.path;
-            const line = bp.location.range.start.line + 1;
-            if (!breakpointsByFile.has(uripath)) breakpointsByFile.set(uripath, []);
-            breakpointsByFile.get(uripath)!.push(line);
-        }
-    }
-    return breakpointsByFile;
-}
-
 export function ensurePyExtension(pathname: string): string {
     if (!pathname.toLowerCase().endsWith('.py')) {
         return pathname + '.py';
@@ -102,17 +88,13 @@ export async function compileWorkerAsync(
     try {
         const checkedModules = new Set<string>();
         const assetImportedModules = new Set<string>();
-        const breakpointsFromEditors = getBreakpointsFromEditors();
         const breakpointsCompiled = new Map<string, number[] | undefined>();
 
         const compileHooks: Array<(module: CompileModule) => void> = [];
         //-- add debug hook if enabled
         if (debug && PybricksDebugEnabled()) {
             compileHooks.push((module) => {
-                transformCodeForDebugTunnel(
-                    module,
-                    breakpointsFromEditors.get(module.uri.path),
-                );
+                transformCodeForDebugTunnel(module);
                 breakpointsCompiled.set(module.uri.path, module.breakpoints);
             });
             DEBUG_ASSET_MODULES.forEach((module) => assetImportedModules.add(module));
@@ -197,7 +179,7 @@ export async function compileWorkerAsync(
             for (const [file, bps] of breakpointsCompiled.entries()) {
                 if (bps && bps.length > 0) {
                     logDebug(
-                        `Compiled breakpoints for ${path.basename(file)}: ${bps
+                        `Compiled debug traps for ${path.basename(file)}: ${bps
                             .map((line) => `#${line}`)
                             .join(', ')}`,
                     );
@@ -416,4 +398,72 @@ export async function loadPythonAssetModule(
     const file = await vscode.workspace.fs.readFile(uri);
     const content = Buffer.from(file).toString('utf8');
     return { uri, content };
-}
\ No newline at end of file
+}
+
+/**
+ * Inline asset modules into a single script for targets that receive plain source
+ * code (e.g. the REPL) and cannot import other modules.
+ * Each `from <module> import ...` line is replaced by the module content, pruned to
+ * the imported definitions and the ones these use.
+ */
+export async function inlinePythonAssetModules(
+    content: string,
+    modules: string[],
+): Promise<string> {
+    for (const module of modules) {
+        const importRe = new RegExp(`^from ${module} import (.*)$`, 'm');
+        const match = importRe.exec(content);
+        if (!match) continue;
+        const { content: moduleContent } = await loadPythonAssetModule(
+            ensurePyExtension(module),
+        );
+        const names = match[1].split(',').map((name) => name.trim());
+        content = content.replace(importRe, () =>
+            pruneUnusedDefinitions(moduleContent, names),
+        );
+    }
+    return content;
+}
+
+/**
+ * Drop the top-level definitions (def, class, assignment) of a Python module that
+ * are neither in names nor used by a kept one; imports and other statements stay.
+ * A statement runs from a line starting in the first column up to the next one.
+ * Uses are matched as words, a name mentioned in a comment keeps its definition.
+ */
+export function pruneUnusedDefinitions(content: string, names: string[]): string {
+    const statements: { text: string; name?: string }[] = [];
+    let inString = false;
+    for (const line of content.split(/\r?\n/)) {
+        const last = statements[statements.length - 1];
+        if (
+            last &&
+            (inString || !/^[^\s#]/.test(line) || last.text.endsWith('\\'))
+        ) {
+            last.text += '\n' + line;
+        } else {
+            const match = /^(?:(?:def|class)\s+(\w+)|(\w+)\s*=)/.exec(line);
+            statements.push({ text: line, name: match?.[1] ?? match?.[2] });
+        }
+        if (line.split('"""').length % 2 === 0) inString = !inString;
+    }
+
+    const defined = new Set(statements.map((statement) => statement.name));
+    const kept = new Set<string>();
+    const pending = names.filter((name) => defined.has(name));
+    while (pending.length > 0) {
+        const name = pending.pop()!;
+        if (kept.has(name)) continue;
+        kept.add(name);
+        for (const statement of statements) {
+            if (statement.name !== name) continue;
+            for (const word of statement.text.match(/\w+/g) ?? []) {
+                if (defined.has(word) && !kept.has(word)) pending.push(word);
+            }
+        }
+    }
+    return statements
+        .filter((statement) => !statement.name || kept.has(statement.name))
+        .map((statement) => statement.text)
+        .join('\n');
+}
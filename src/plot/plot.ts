@@ -18,6 +18,7 @@ export class PlotManager {
     private _columns: string[] | undefined = undefined;
     private _buffer: number[] | undefined = undefined;
     private _bufferTimeout: NodeJS.Timeout | null = null;
+    private _bufferAge = 0; // ms the buffered row was taken before it arrived
     private _lastValues: number[] | undefined = undefined;
     private _data: number[][] | undefined = undefined;
     private _datastream: fs.WriteStream | null = null;
@@ -59,7 +60,11 @@ export class PlotManager {
     }
 
     private get delta(): number {
-        const now = Date.now();
+        return this.deltaAt(0);
+    }
+
+    private deltaAt(ageMs: number): number {
+        const now = Date.now() - ageMs;
         const seconds = ((now - this._startTime) / 1000).toFixed(3);
         return Number(seconds);
     }
@@ -111,6 +116,7 @@ export class PlotManager {
     private resetBuffer(resetLastValues: boolean = false) {
         if (!this._initialized || !this._columns?.length) return;
         this._buffer = new Array(this._columns.length).fill(NaN);
+        this._bufferAge = 0;
 
         if (resetLastValues) {
             this._lastValues = new Array(this._columns.length).fill(NaN);
@@ -129,7 +135,7 @@ export class PlotManager {
         const hasData = this._buffer.some((v) => typeof v === 'number' && !isNaN(v));
         if (!hasData) return;
 
-        const lineToWrite = [this.delta, ...this._buffer];
+        const lineToWrite = [this.deltaAt(this._bufferAge), ...this._buffer];
         this._data?.push(lineToWrite);
         if (this._data && this._data.length > PLOT_MAX_ROWS) {
             this._data.shift(); // keep last entries
@@ -296,7 +302,11 @@ export class PlotManager {
         }
     }
 
-    public setRowValues(values: number[]) {
+    /**
+     * Merge a row of values into the buffer.
+     * @param ageMs how long before now the row was taken, for rows sent batched
+     */
+    public setRowValues(values: number[], ageMs: number = 0) {
         if (
             !this._initialized ||
             !this._columns?.length ||
@@ -315,6 +325,7 @@ export class PlotManager {
         }
 
         // merge values to buffer
+        this._bufferAge = ageMs;
         for (let i = 0; i < Math.min(values.length, this.columns.length); i++) {
             if (typeof values[i] === 'number' && !isNaN(values[i])) {
                 this.setBufferAt(i, values[i]);
@@ -0,0 +1,55 @@
+/** AIPP credit flow control (host side)
+ *
+ * The hub writes its tunnel chunks against credits granted by the host instead of
+ * waiting a fixed time after each, negotiated with the CAP_CREDITS capability in the
+ * START handshake. Mirrors aipp.CreditGate of the hub (asset/python-libs/aipp.py).
+ *
+ * Grant: 0x70 0x13, uint16 chunks received since the handshake, uint8 window. The hub
+ * writes while fewer than window chunks are in flight; grants are cumulative, so a lost
+ * one is made good by the next.
+ */
+
+export const AIPP_CAP_CREDITS = 0x0400;
+
+const DEBUG_ACKNOWLEDGE = 0x70; // MessageType.DebugAcknowledge
+const CREDIT_GRANT = 0x13; // DebugSubCode.CreditGrant
+const CREDIT_WINDOW = 8; // chunks in flight, the hub buffers a few chunks only
+const CREDITS_INITIAL = 4; // window of the hub until the first grant
+
+export class CreditGranter {
+    private received = 0; // chunks received, uint16
+    private granted = 0; // chunks received as of the last grant
+    private readonly batch: number;
+
+    public grants = 0;
+
+    /**
+     * @param write writes one grant as an unsequenced AIPP tunnel message
+     * @param window chunks the hub may have in flight
+     */
+    constructor(
+        private readonly write: (message: Uint8Array) => Promise<void>,
+        private readonly window = CREDIT_WINDOW,
+    ) {
+        // grant before the hub runs out of its initial credits
+        this.batch = Math.max(1, Math.min(CREDITS_INITIAL, window >> 1));
+    }
+
+    /**
+     * Count a chunk received from the hub, granting credits every batch of chunks.
+     */
+    public onChunk() {
+        this.received = (this.received + 1) & 0xffff;
+        if (((this.received - this.granted) & 0xffff) < this.batch) return;
+        this.granted = this.received;
+        this.grants++;
+        const message = new Uint8Array([
+            DEBUG_ACKNOWLEDGE,
+            CREDIT_GRANT,
+            this.received & 0xff,
+            this.received >> 8,
+            this.window,
+        ]);
+        void this.write(message).catch(() => {});
+    }
+}
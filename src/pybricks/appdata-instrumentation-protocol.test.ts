@@ -0,0 +1,39 @@
+import {
+    decodeMessageRaw,
+    MessageType,
+    PlotSubCode,
+} from './appdata-instrumentation-protocol';
+
+jest.mock('../debug-tunnel/debugtunnel-appdata-helper', () => ({}));
+jest.mock('../plot/plot', () => ({}));
+jest.mock('../user-hooks/device-notification-hook', () => ({}));
+
+function fromHex(hex: string): Uint8Array {
+    return Uint8Array.from(Buffer.from(hex, 'hex'));
+}
+
+// frames sent by capture_flush of asset/python-libs/dap_aipp_full.py, the same
+// bytes are checked on the hub side in tools/aipp/test_aipp.py
+const CAPTURE_H_FRAME = '73056803020400000000000100ffff0200feff';
+const CAPTURE_F_FRAME = '730566020105000000c03f000010c0';
+
+describe('appdata-instrumentation-protocol', () => {
+    it('should decode capture frames of the hub, rows before columns', () => {
+        expect(decodeMessageRaw(fromHex(CAPTURE_H_FRAME))).toEqual({
+            Id: MessageType.PlotNotification,
+            subcode: PlotSubCode.Capture,
+            rows: [
+                [0, 0],
+                [1, -1],
+                [2, -2],
+            ],
+            span: 4,
+        });
+        expect(decodeMessageRaw(fromHex(CAPTURE_F_FRAME))).toEqual({
+            Id: MessageType.PlotNotification,
+            subcode: PlotSubCode.Capture,
+            rows: [[1.5], [-2.25]],
+            span: 5,
+        });
+    });
+});
@@ -4,14 +4,21 @@
  * Uses AIPP framing for frame and message boundaries.
  */
 import { handleIncomingAIPPDebug } from '../debug-tunnel/debugtunnel-appdata-helper';
+import { logDebug } from '../extension/debug-channel';
 import { plotManager } from '../plot/plot';
 import { DeviceNotificationMessage } from '../spike/messages/device-notification-message';
 import { TunnelNotificationMessage } from '../spike/messages/tunnel-notification-message';
 import { TunnelRequestMessage } from '../spike/messages/tunnel-request-message';
 import { DataViewExtended } from '../spike/utils/dataview-extended';
-import { handleDeviceNotificationAsync } from '../user-hooks/device-notification-hook';
-
-export const AIPP_MODULE_NAME = 'aipp'; // name of the module to import in user code - file name without .py
+import {
+    mergeDeviceNotificationPayloads,
+} from '../spike/utils/device-notification-parser';
+import { CreditGranter } from './appdata-credits';
+import { AIPP_SEQUENCED_FRAME, SequencedLink } from './appdata-sequenced-link';
+import {
+    getLastDeviceNotificationPayloads,
+    handleDeviceNotificationAsync,
+} from '../user-hooks/device-notification-hook';
 
 /**
  * Supported message types.
@@ -23,6 +30,10 @@ export enum MessageType {
     DebugNotification = 0x71, // uses little-endian
     PlotAcknowledge = 0x72, // uses little-endian
     PlotNotification = 0x73, // uses little-endian
+    CompactDeviceNotification = 0x74, // AIPP_CAP_COMPACT, uses little-endian
+    DeltaDeviceNotification = 0x75, // AIPP_CAP_DELTA_NOTIF, uses little-endian
+    Coalesced = 0x77, // AIPP_CAP_COALESCE, transport envelope, see splitCoalesced
+    SequencedFrame = AIPP_SEQUENCED_FRAME, // transport envelope, see SequencedLink
 }
 
 const DebugMessageLittleEndian = true; // little-endian
@@ -35,12 +46,44 @@ export enum DebugSubCode {
     TrapNotification = 0x03,
     ContinueRequest = 0x04,
     ContinueResponse = 0x05,
-    GetVariableRequest = 0x06 /* not used */,
-    GetVariableResponse = 0x07 /* not used */,
+    GetVariableRequest = 0x06,
+    GetVariableResponse = 0x07,
     SetVariableRequest = 0x08,
     SetVariableResponse = 0x09,
     TerminateRequest = 0x0a,
     TerminateResponse = 0x0b,
+    BreakpointsRequest = 0x0c,
+    ConditionRequest = 0x0d,
+    LogpointsRequest = 0x0e,
+    LogNotification = 0x0f,
+    TrapDeltaNotification = 0x10, // decoded into a TrapNotification
+    MonitorPeriodsRequest = 0x11, // AIPP_CAP_SCHEDULE
+    MonitorRatesNotification = 0x12, // AIPP_CAP_SCHEDULE
+    CreditGrant = 0x13, // AIPP_CAP_CREDITS, sent by CreditGranter
+    BreakpointsDone = 0x14, // after the breakpoints of all files at the start
+}
+
+/**
+ * Hit count operators of a hub side breakpoint condition.
+ * Hits count the trap calls that pass the comparison.
+ */
+export enum BreakpointHitOp {
+    Any = 0x00,
+    AtLeast = 0x01, // hits >= n
+    Equal = 0x02, // hits == n
+    Every = 0x03, // every n-th hit
+}
+
+/**
+ * Comparison operators of a hub side breakpoint condition (variable <op> value).
+ */
+export enum BreakpointCompareOp {
+    Equal = 0x00,
+    NotEqual = 0x01,
+    Less = 0x02,
+    LessEqual = 0x03,
+    Greater = 0x04,
+    GreaterEqual = 0x05,
 }
 
 export enum PlotSubCode {
@@ -48,6 +91,20 @@ export enum PlotSubCode {
     Define = 0x01,
     UpdateCells = 0x02,
     UpdateRow = 0x03,
+    UpdateRows = 0x04, // rows batched by the hub
+    Capture = 0x05, // rows captured on the hub, sent in bulk
+    CaptureStats = 0x06,
+    Downsample = 0x07, // host to hub
+}
+
+/**
+ * Downsampling policy of a plot column on the hub, a row is sent per bucket of rows.
+ */
+export enum PlotDownsampleMode {
+    Every = 0x00, // the first value of the bucket
+    Mean = 0x01,
+    MinMax = 0x02, // the minimum and the maximum, in the order seen
+    Keep = 0xff, // unchanged
 }
 
 /**
@@ -59,11 +116,41 @@ export enum DebugVarTypeEnum {
     Float = 2,
     String = 3,
     Bool = 4,
+    List = 5,
+    Tuple = 6,
+    Dict = 7,
+    VarInt = 8, // AIPP_CAP_COMPACT: zigzag varint, decoded as Int
+    Decimal = 9, // AIPP_CAP_COMPACT: varint m * 4 + d = m / 10^d, decoded as Float
 }
 export type DebugVarType = number | string | boolean | null;
 
+/**
+ * Value the hub left out of a trap (AIPP_CAP_LAZY_VALUES), fetched with a
+ * GetVariableRequest once needed.
+ */
+export class DeferredValue {
+    constructor(public readonly type: DebugVarTypeEnum, public readonly size: number) {}
+}
+
+/**
+ * Page of a list, tuple or dict (AIPP_CAP_CONTAINERS): the elements from start on,
+ * further pages are fetched with a GetVariableRequest.
+ */
+export class ContainerValue {
+    constructor(
+        public readonly type: DebugVarTypeEnum,
+        public readonly length: number,
+        public readonly start: number,
+        public readonly items: DebugTrapValue[],
+        public readonly keys?: DebugTrapValue[], // dict only
+    ) {}
+}
+export type DebugTrapValue = DebugVarType | DeferredValue | ContainerValue;
+
 const AIPPFirstPrefix = 0xfe;
+const AIPPCrcFirstPrefix = 0xfc; // CRC framing (AIPP_CAP_CRC): uint16 length, CRC-8
 const AIPPContinuationPrefix = 0xff;
+const AIPPAlternateContinuationPrefix = 0xfd; // sequenced frames alternate 0xff / 0xfd
 const AIPPContinuationPostfix = 0xff;
 const AIPPNoContinuationPostfix = 0x00;
 
@@ -73,18 +160,20 @@ export type DebugMessage =
     | {
           Id: MessageType.DebugNotification;
           subcode: DebugSubCode.StartNotification;
+          caps?: number; // hub capabilities, see AIPP_CAP_SEQ
       }
     | {
           Id: MessageType.DebugAcknowledge;
           subcode: DebugSubCode.StartAcknowledge;
           success: boolean;
+          caps?: number; // agreed capabilities, omitted for hubs not offering any
       }
     | {
           Id: MessageType.DebugNotification;
           subcode: DebugSubCode.TrapNotification;
           filename: string;
           line: number;
-          variables?: Map<string, DebugVarType>; // maximum 255 variables
+          variables?: Map<string, DebugTrapValue>; // maximum 255 variables
       }
     | {
           Id: MessageType.DebugAcknowledge;
@@ -105,13 +194,19 @@ export type DebugMessage =
           Id: MessageType.DebugAcknowledge;
           subcode: DebugSubCode.GetVariableRequest;
           varname: string;
+          max: number; // longest string value to send, longer ones are truncated
+          start?: number; // container page: first element
+          count?: number; // container page: number of elements
+          path?: number[]; // element indexes of a nested value
       }
     | {
           Id: MessageType.DebugNotification;
           subcode: DebugSubCode.GetVariableResponse;
           varname: string;
+          found: boolean;
+          truncated: boolean;
           //   type: DebugVarTypeEnum;
-          value: DebugVarType;
+          value: DebugTrapValue;
       }
     | {
           Id: MessageType.DebugAcknowledge;
@@ -133,6 +228,45 @@ export type DebugMessage =
           Id: MessageType.DebugNotification;
           subcode: DebugSubCode.TerminateResponse;
           success: boolean;
+      }
+    | {
+          Id: MessageType.DebugAcknowledge;
+          subcode: DebugSubCode.BreakpointsRequest | DebugSubCode.LogpointsRequest;
+          filename: string;
+          // enabled trap lines, the hub skips all others; logpoints: lines that log
+          lines: number[];
+          step?: boolean; // stop at the next trap regardless of the lines
+      }
+    | {
+          Id: MessageType.DebugAcknowledge;
+          subcode: DebugSubCode.BreakpointsDone;
+      }
+    | {
+          Id: MessageType.DebugNotification;
+          subcode: DebugSubCode.LogNotification;
+          dropped: number; // snapshots dropped by the hub so far
+          entries: DebugMessage[]; // TrapNotification snapshots of logpoint hits
+      }
+    | {
+          Id: MessageType.DebugAcknowledge;
+          subcode: DebugSubCode.ConditionRequest;
+          filename: string;
+          line: number;
+          hitOp: BreakpointHitOp;
+          hitValue: number;
+          varname: string; // empty: no comparison
+          compareOp: BreakpointCompareOp;
+          value: DebugVarType;
+      }
+    | {
+          Id: MessageType.DebugAcknowledge;
+          subcode: DebugSubCode.MonitorPeriodsRequest;
+          periods: Map<number, number>; // source: period in ms, 0 pauses
+      }
+    | {
+          Id: MessageType.DebugNotification;
+          subcode: DebugSubCode.MonitorRatesNotification;
+          rates: MonitorRate[];
       };
 
 export type PlotMessage =
@@ -140,6 +274,12 @@ export type PlotMessage =
           Id: MessageType.PlotAcknowledge;
           subcode: PlotSubCode.Ack;
       }
+    | {
+          Id: MessageType.PlotAcknowledge;
+          subcode: PlotSubCode.Downsample;
+          bucket: number; // rows per bucket, 1 sends every row
+          modes: PlotDownsampleMode[]; // in column order
+      }
     | {
           Id: MessageType.PlotNotification;
           subcode: PlotSubCode.Define;
@@ -154,6 +294,19 @@ export type PlotMessage =
           Id: MessageType.PlotNotification;
           subcode: PlotSubCode.UpdateRow;
           values: number[];
+      }
+    | {
+          Id: MessageType.PlotNotification;
+          subcode: PlotSubCode.UpdateRows | PlotSubCode.Capture;
+          rows: number[][];
+          span: number; // ms from the first to the last row
+      }
+    | {
+          Id: MessageType.PlotNotification;
+          subcode: PlotSubCode.CaptureStats;
+          samples: number;
+          overruns: number; // samples dropped from the full ring of the hub
+          elapsed: number; // ms from the first to the last sample
       };
 
 export type Message =
@@ -164,6 +317,130 @@ export type Message =
 
 const MAX_DEBUG_MESSAGE_SIZE = 1024;
 
+// StartAcknowledge success byte flag: uint16 capabilities follow
+const START_ACK_CAPS = 0x80;
+// BreakpointsRequest flag: stop at the next trap
+const BREAKPOINTS_STEP = 0x01;
+
+/**
+ * Capability: TrapDeltaNotification with a session string table, see resetTrapDelta.
+ */
+export const AIPP_CAP_TRAP_DELTA = 0x0002;
+// TrapDeltaNotification type flag: value unchanged since the previous trap
+const VAR_UNCHANGED = 0x80;
+
+/**
+ * Capability: traps send larger values as DeferredValue, see GetVariableRequest.
+ */
+export const AIPP_CAP_LAZY_VALUES = 0x0004;
+/**
+ * Capability: traps send lists, tuples and dicts as ContainerValue pages.
+ */
+export const AIPP_CAP_CONTAINERS = 0x0008;
+/**
+ * Capability: integers and decimal floats as varints (DebugVarTypeEnum.VarInt and
+ * Decimal), device notifications as CompactDeviceNotification.
+ */
+export const AIPP_CAP_COMPACT = 0x0010;
+/**
+ * Capability: the START comes from a monitor program (hubmonitor), not a debuggee;
+ * acknowledged with the agreed capabilities only, no debug session is started.
+ */
+export const AIPP_CAP_MONITOR = 0x0020;
+/**
+ * Capability: the monitor sends DeltaDeviceNotification with the changed payloads
+ * only, and a full device notification as a keyframe every few notifications.
+ */
+export const AIPP_CAP_DELTA_NOTIF = 0x0100;
+/**
+ * Capability: the monitor samples each source on its own period, changed with
+ * MonitorPeriodsRequest, and reports them in MonitorRatesNotification.
+ */
+export const AIPP_CAP_SCHEDULE = 0x0200;
+/**
+ * MonitorPeriodsRequest source of the first rescan of an empty port, the other
+ * sources are device notification record types (DeviceNotificationMessageType).
+ */
+export const MONITOR_RESCAN = 0xff;
+// MonitorRatesNotification port of the battery and the IMU
+const MONITOR_HUB_PORT = 0xff;
+
+export type MonitorRate = {
+    type: number; // device notification record type
+    port?: number; // undefined for the battery and the IMU
+    targetMs: number; // sampling period set, 0: paused
+    actualMs: number; // mean period since the last report, 0: sampled once at most
+};
+// trap type flag: value deferred, uint16 size follows instead
+const VAR_DEFERRED = 0x40;
+// GetVariableResponse flags
+const GETVAR_TRUNCATED = 0x01;
+const GETVAR_UNKNOWN = 0x02;
+
+// session string table and last variable values of TrapDeltaNotification
+const trapStrings = new Map<number, string>();
+const trapValues = new Map<number, DebugTrapValue>();
+
+/**
+ * Forget the string table and values of delta traps, on each debug start.
+ */
+export function resetTrapDelta() {
+    trapStrings.clear();
+    trapValues.clear();
+}
+
+/**
+ * Capability: frames carry a uint16 message length and a CRC-8 instead of the sum,
+ * marked by their first chunk (0xfc), see AppDataInstrumentationPybricksProtocol.crc.
+ */
+export const AIPP_CAP_CRC = 0x0040;
+
+/**
+ * Capability: several messages in one frame, a Coalesced message: 0x77, then for each
+ * message uint8 length and the message.
+ */
+export const AIPP_CAP_COALESCE = 0x0080;
+
+/**
+ * Split a Coalesced message into its messages.
+ */
+export function splitCoalesced(data: Uint8Array): Uint8Array[] {
+    const messages: Uint8Array[] = [];
+    let offset = 1;
+    while (offset < data.length) {
+        const length = data[offset];
+        if (offset + 1 + length > data.length) {
+            console.error('Coalesced message truncated');
+            break;
+        }
+        messages.push(data.subarray(offset + 1, offset + 1 + length));
+        offset += 1 + length;
+    }
+    return messages;
+}
+
+// CRC-8 polynomial x^8 + x^2 + x + 1 (0x07), most significant bit first, as aipp.py
+const CRC8_TABLE = (() => {
+    const table = new Uint8Array(256);
+    for (let i = 0; i < 256; i++) {
+        let c = i;
+        for (let bit = 0; bit < 8; bit++) c = ((c << 1) ^ (c & 0x80 ? 0x07 : 0)) & 0xff;
+        table[i] = c;
+    }
+    return table;
+})();
+
+/**
+ * Computes the CRC-8 of data continuing from crc, one table lookup per byte.
+ * A message followed by its CRC-8 has a CRC-8 of 0.
+ */
+function crc8(data: Uint8Array, crc = 0): number {
+    for (const byte of data) {
+        crc = CRC8_TABLE[crc ^ byte];
+    }
+    return crc;
+}
+
 /**
  * Computes a simple 8-bit checksum by summing all bytes.
  * The result is modulo 256.
@@ -190,7 +467,7 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
     dataview.writeUInt8(data.Id);
     dataview.writeUInt8(data.subcode);
 
-    const encodeValue = (value: DebugVarType, dataview: DataViewExtended) => {
+    const encodeValue = (value: DebugTrapValue, dataview: DataViewExtended) => {
         if (value === null) {
             dataview.writeUInt8(DebugVarTypeEnum.None);
         } else if (typeof value === 'number') {
@@ -214,6 +491,7 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
 
     switch (data.subcode) {
         case DebugSubCode.StartNotification:
+        case DebugSubCode.BreakpointsDone:
             // nothing to add
             break;
 
@@ -237,8 +515,12 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
             break;
 
         case DebugSubCode.GetVariableResponse:
-            // varname: zstring, type: uint8, value: depends on type
+            // varname: zstring, flags: uint8, type: uint8, value: depends on type
             dataview.writeString(data.varname);
+            dataview.writeUInt8(
+                (data.found ? 0 : GETVAR_UNKNOWN) |
+                    (data.truncated ? GETVAR_TRUNCATED : 0),
+            );
             encodeValue(data.value, dataview);
             break;
 
@@ -248,8 +530,14 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
             break;
 
         case DebugSubCode.GetVariableRequest:
-            // varname: zstring
+            // varname: zstring, max: uint16, start: uint16, count: uint8,
+            // depth: uint8, then depth x index: uint16
             dataview.writeString(data.varname);
+            dataview.writeUInt16(data.max);
+            dataview.writeUInt16(data.start ?? 0);
+            dataview.writeUInt8(Math.min(data.count ?? 0, 255));
+            dataview.writeUInt8(data.path?.length ?? 0);
+            for (const index of data.path ?? []) dataview.writeUInt16(index);
             break;
 
         case DebugSubCode.SetVariableRequest:
@@ -259,6 +547,15 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
             break;
 
         case DebugSubCode.StartAcknowledge:
+            // success: boolean, or flag byte followed by capabilities: uint16
+            if (data.success && data.caps !== undefined) {
+                dataview.writeUInt8(0x01 | START_ACK_CAPS);
+                dataview.writeUInt16(data.caps);
+            } else {
+                dataview.writeBool(data.success);
+            }
+            break;
+
         case DebugSubCode.TrapAcknowledge:
             // success: boolean
             dataview.writeBool(data.success);
@@ -270,6 +567,41 @@ function encodeDebugMessageRaw(data: DebugMessage): Uint8Array {
             dataview.writeBool(data.step);
             break;
 
+        case DebugSubCode.BreakpointsRequest:
+        case DebugSubCode.LogpointsRequest: {
+            // flags: uint8, filename: zstring, length: uint16, bitmap (bit n: line n)
+            const bitmap = new Uint8Array(
+                data.lines.length ? (Math.max(...data.lines) >> 3) + 1 : 0,
+            );
+            for (const line of data.lines) bitmap[line >> 3] |= 1 << (line & 7);
+            dataview.writeUInt8(data.step ? BREAKPOINTS_STEP : 0);
+            dataview.writeString(data.filename);
+            dataview.writeUInt16(bitmap.length);
+            dataview.writeBuffer(bitmap);
+            break;
+        }
+
+        case DebugSubCode.ConditionRequest:
+            // filename: zstring, line: uint16, hit op: uint8, hit count: uint16,
+            // varname: zstring, compare op: uint8, type: uint8, value
+            dataview.writeString(data.filename);
+            dataview.writeUInt16(data.line);
+            dataview.writeUInt8(data.hitOp);
+            dataview.writeUInt16(data.hitValue);
+            dataview.writeString(data.varname);
+            dataview.writeUInt8(data.compareOp);
+            encodeValue(data.value, dataview);
+            break;
+
+        case DebugSubCode.MonitorPeriodsRequest:
+            // count: uint8, then count x (source: uint8, period ms: uint16)
+            dataview.writeUInt8(data.periods.size);
+            for (const [source, period] of data.periods) {
+                dataview.writeUInt8(source);
+                dataview.writeUInt16(period);
+            }
+            break;
+
         default:
             throw new Error('Unknown debug subcode');
     }
@@ -307,6 +639,15 @@ function decodeDebugMessageRaw(data: Uint8Array): DebugMessage {
             case DebugVarTypeEnum.Bool:
                 value = dataview.readBool();
                 break;
+            case DebugVarTypeEnum.VarInt:
+                value = dataview.readVarInt();
+                return { type: DebugVarTypeEnum.Int, value };
+            case DebugVarTypeEnum.Decimal: {
+                const n = dataview.readVarInt();
+                const d = n & 3;
+                value = (n - d) / 4 / 10 ** d;
+                return { type: DebugVarTypeEnum.Float, value };
+            }
             case DebugVarTypeEnum.None:
             default:
                 value = null;
@@ -315,18 +656,120 @@ function decodeDebugMessageRaw(data: Uint8Array): DebugMessage {
         return { type, value };
     };
 
+    // trap values may be deferred: type with VAR_DEFERRED, uint16 size;
+    // containers: length: uint16, start: uint16, count: uint8, then count elements
+    // (dict: key, value)
+    const decodeTrapValue = (dataview: DataViewExtended): DebugTrapValue => {
+        const type = data[dataview.offset];
+        if (type & VAR_DEFERRED) {
+            dataview.offset++;
+            return new DeferredValue(type & ~VAR_DEFERRED, dataview.readUInt16());
+        }
+        if (
+            type !== DebugVarTypeEnum.List &&
+            type !== DebugVarTypeEnum.Tuple &&
+            type !== DebugVarTypeEnum.Dict
+        )
+            return decodeValue(dataview).value;
+        dataview.offset++;
+        const length = dataview.readUInt16();
+        const start = dataview.readUInt16();
+        const count = dataview.readUInt8();
+        const items: DebugTrapValue[] = [];
+        const keys: DebugTrapValue[] | undefined =
+            type === DebugVarTypeEnum.Dict ? [] : undefined;
+        for (let i = 0; i < count; i++) {
+            keys?.push(decodeTrapValue(dataview));
+            items.push(decodeTrapValue(dataview));
+        }
+        return new ContainerValue(type, length, start, items, keys);
+    };
+
     switch (subcode) {
         case DebugSubCode.StartNotification:
             return {
                 Id: MessageType.DebugNotification,
                 subcode: DebugSubCode.StartNotification,
+                // older hubs send no capabilities
+                caps: dataview.length - dataview.offset >= 2 ? dataview.readUInt16() : 0,
             };
-        case DebugSubCode.StartAcknowledge:
+        case DebugSubCode.TrapDeltaNotification: {
+            // definitions: uint8, then (id: uint8, zstring), filename id: uint8,
+            // line: uint16, count: uint8, then (id: uint8, type: uint8, value)
+            // type bit 7 set: unchanged, no value follows; bit 6 set: deferred
+            const definitions = dataview.readUInt8();
+            for (let i = 0; i < definitions; i++) {
+                const id = dataview.readUInt8();
+                trapStrings.set(id, dataview.readString());
+            }
+            const filename = trapStrings.get(dataview.readUInt8()) ?? '';
+            const line = dataview.readUInt16();
+            const count = dataview.readUInt8();
+            const variables = new Map<string, DebugTrapValue>();
+            for (let i = 0; i < count; i++) {
+                const id = dataview.readUInt8();
+                if (data[dataview.offset] & VAR_UNCHANGED) {
+                    dataview.offset++;
+                } else {
+                    trapValues.set(id, decodeTrapValue(dataview));
+                }
+                const name = trapStrings.get(id) ?? `#${id}`;
+                variables.set(name, trapValues.get(id) ?? null);
+            }
+            return {
+                Id: MessageType.DebugNotification,
+                subcode: DebugSubCode.TrapNotification,
+                filename,
+                line,
+                variables,
+            };
+        }
+        case DebugSubCode.LogNotification: {
+            // dropped: uint16, count: uint8, then (length: uint16, TrapNotification)
+            const dropped = dataview.readUInt16();
+            const count = dataview.readUInt8();
+            const entries: DebugMessage[] = [];
+            for (let i = 0; i < count; i++) {
+                const length = dataview.readUInt16();
+                entries.push(decodeDebugMessageRaw(dataview.readBuffer(length)));
+            }
+            return {
+                Id: MessageType.DebugNotification,
+                subcode: DebugSubCode.LogNotification,
+                dropped,
+                entries,
+            };
+        }
+        case DebugSubCode.MonitorRatesNotification: {
+            // count: uint8, then count x (type: uint8, port: uint8, target ms: uint16,
+            // actual ms: uint16)
+            const count = dataview.readUInt8();
+            const rates: MonitorRate[] = [];
+            for (let i = 0; i < count; i++) {
+                const type = dataview.readUInt8();
+                const port = dataview.readUInt8();
+                rates.push({
+                    type,
+                    port: port === MONITOR_HUB_PORT ? undefined : port,
+                    targetMs: dataview.readUInt16(),
+                    actualMs: dataview.readUInt16(),
+                });
+            }
+            return {
+                Id: MessageType.DebugNotification,
+                subcode: DebugSubCode.MonitorRatesNotification,
+                rates,
+            };
+        }
+        case DebugSubCode.StartAcknowledge: {
+            const flags = dataview.readUInt8();
             return {
                 Id: MessageType.DebugAcknowledge,
                 subcode: DebugSubCode.StartAcknowledge,
-                success: dataview.readBool(),
+                success: flags !== 0,
+                caps: flags & START_ACK_CAPS ? dataview.readUInt16() : undefined,
             };
+        }
         case DebugSubCode.TrapNotification:
             return {
                 Id: MessageType.DebugNotification,
@@ -337,11 +780,10 @@ function decodeDebugMessageRaw(data: Uint8Array): DebugMessage {
                     const count = dataview.readUInt8();
                     if (count === 0) return undefined;
 
-                    const vars = new Map<string, DebugVarType>();
+                    const vars = new Map<string, DebugTrapValue>();
                     for (let i = 0; i < count; i++) {
                         const varname = dataview.readString();
-                        let { value } = decodeValue(dataview);
-                        vars.set(varname, value);
+                        vars.set(varname, decodeTrapValue(dataview));
                     }
                     return vars;
                 })(),
@@ -369,14 +811,18 @@ function decodeDebugMessageRaw(data: Uint8Array): DebugMessage {
                 Id: MessageType.DebugAcknowledge,
                 subcode: DebugSubCode.GetVariableRequest,
                 varname: dataview.readString(),
+                max: dataview.readUInt16(),
             };
         case DebugSubCode.GetVariableResponse: {
             const varname = dataview.readString();
-            let { value } = decodeValue(dataview);
+            const flags = dataview.readUInt8();
+            const value = decodeTrapValue(dataview);
             return {
                 Id: MessageType.DebugNotification,
                 subcode: DebugSubCode.GetVariableResponse,
                 varname,
+                found: !(flags & GETVAR_UNKNOWN),
+                truncated: !!(flags & GETVAR_TRUNCATED),
                 // type,
                 value,
             };
@@ -418,6 +864,15 @@ function encodePlotMessageRaw(data: PlotMessage): Uint8Array {
             // nothing to add
             break;
 
+        case PlotSubCode.Downsample: {
+            // uint8 bucket, uint8 count, then uint8 policy for each column
+            const count = Math.min(data.modes.length, 255);
+            dataview.writeUInt8(Math.min(Math.max(data.bucket, 1), 255));
+            dataview.writeUInt8(count);
+            for (let i = 0; i < count; i++) dataview.writeUInt8(data.modes[i]);
+            break;
+        }
+
         case PlotSubCode.Define: {
             // columns: uint8 count, then zstring for each
             const count = Math.min(data.columns.length, 255); // max 255 columns
@@ -451,6 +906,22 @@ function encodePlotMessageRaw(data: PlotMessage): Uint8Array {
             break;
         }
 
+        case PlotSubCode.UpdateRows:
+        case PlotSubCode.Capture: {
+            // [Capture: array typecode 'f'], uint8 rows, uint8 count (columns),
+            // uint16 span, then rows x count float
+            if (data.subcode === PlotSubCode.Capture) dataview.writeUInt8(0x66);
+            const rows = Math.min(data.rows.length, 255);
+            const count = Math.min(data.rows[0]?.length ?? 0, 255);
+            dataview.writeUInt8(rows);
+            dataview.writeUInt8(count);
+            dataview.writeUInt16(data.span);
+            for (let r = 0; r < rows; r++) {
+                for (let i = 0; i < count; i++) dataview.writeFloat(data.rows[r][i]);
+            }
+            break;
+        }
+
         default:
             throw new Error('Unknown plot subcode');
     }
@@ -513,6 +984,41 @@ function decodePlotMessageRaw(data: Uint8Array): PlotMessage {
                 values,
             };
         }
+        case PlotSubCode.UpdateRows:
+        case PlotSubCode.Capture: {
+            // captured values are floats ('f') or 16 bit integers ('h')
+            const capture = subcode === PlotSubCode.Capture;
+            const typecode = capture ? String.fromCharCode(dataview.readUInt8()) : 'f';
+            // uint8 rows, uint8 columns, uint16 span, then rows x columns values
+            const rowCount = dataview.readUInt8();
+            const columns = dataview.readUInt8();
+            const span = dataview.readUInt16();
+            const rows: number[][] = [];
+            for (let r = 0; r < rowCount; r++) {
+                const values: number[] = [];
+                for (let i = 0; i < columns; i++) {
+                    values.push(
+                        typecode === 'h' ? dataview.readInt16() : dataview.readFloat(),
+                    );
+                }
+                rows.push(values);
+            }
+            return {
+                Id: MessageType.PlotNotification,
+                subcode: capture ? PlotSubCode.Capture : PlotSubCode.UpdateRows,
+                rows,
+                span,
+            };
+        }
+        case PlotSubCode.CaptureStats: {
+            return {
+                Id: MessageType.PlotNotification,
+                subcode: PlotSubCode.CaptureStats,
+                samples: dataview.readUInt32(),
+                overruns: dataview.readUInt32(),
+                elapsed: dataview.readUInt32(),
+            };
+        }
         default:
             throw new Error('Unknown plot subcode');
     }
@@ -550,6 +1056,10 @@ export function decodeMessageRaw(data: Uint8Array): Message {
             return decodePlotMessageRaw(data);
         case MessageType.DeviceNotification:
             return DeviceNotificationMessage.fromBytes(data);
+        case MessageType.CompactDeviceNotification:
+            return DeviceNotificationMessage.fromCompactBytes(data);
+        case MessageType.DeltaDeviceNotification:
+            return DeviceNotificationMessage.fromDeltaBytes(data);
         case MessageType.TunnelNotification:
             return TunnelNotificationMessage.fromBytes(
                 data,
@@ -561,15 +1071,47 @@ export function decodeMessageRaw(data: Uint8Array): Message {
 
 export class AppDataInstrumentationPybricksProtocol {
     private static packageid = 0;
+
+    /** Sequenced link of the debug session, set once CAP_SEQ was negotiated. */
+    public static link: SequencedLink | undefined;
+
+    /** Send CRC frames, set once AIPP_CAP_CRC was negotiated; both are received. */
+    public static crc = false;
+
+    /** Credits granted to the hub, set once AIPP_CAP_CREDITS was negotiated. */
+    public static credits: CreditGranter | undefined;
+
     public static encode(payload: Message): ArrayBuffer[] {
-        const encoded0 = encodeMessageRaw(payload);
+        return this.frame(encodeMessageRaw(payload));
+    }
 
+    /**
+     * Split a raw message into AIPP tunnel chunks.
+     * @param alternate mark every other continuation chunk 0xfd, so that the hub, comparing
+     * consecutive chunks to detect new data, never mistakes two equal chunks for one
+     */
+    public static frame(encoded0: Uint8Array, alternate = false): ArrayBuffer[] {
         // appdata receiver channel cannot receive the same message twice in a row, extend the buffer and add package number as an unused field at the end
         this.packageid = (this.packageid + 1) & 0xff;
-        const encoded0WithPackageId = Buffer.from([...encoded0, this.packageid]);
+        // CRC frames start with the message length, the package id is padding then
+        const header = this.crc ? [encoded0.length & 0xff, encoded0.length >> 8] : [];
+        const encoded0WithPackageId = Buffer.from([
+            ...header,
+            ...encoded0,
+            this.packageid,
+        ]);
+        const maxPacketSize = AIPP_MTU - 2;
 
         // checksum will be aligned to the last(-1) byte of the buffer
-        const checksum = simpleSumChecksum(encoded0WithPackageId);
+        // the CRC-8 covers the zero padding in front of it as well
+        const padding =
+            Math.ceil((encoded0WithPackageId.length + 1) / maxPacketSize) *
+                maxPacketSize -
+            encoded0WithPackageId.length -
+            1;
+        const checksum = this.crc
+            ? crc8(new Uint8Array(padding), crc8(encoded0WithPackageId))
+            : simpleSumChecksum(encoded0WithPackageId);
         // placeholder for checksum, will be aligned to the last payload byte of the last packet
         const encoded1 = Buffer.from([...encoded0WithPackageId, 0x00]);
         // logDebug(`AppDataInstrumentationPybricksProtocol encoded message: ${encoded1.toString(
@@ -578,7 +1120,6 @@ export class AppDataInstrumentationPybricksProtocol {
 
         // split into chunks of MTU size (AIPP_MTU)
         const chunks: ArrayBuffer[] = [];
-        const maxPacketSize = AIPP_MTU - 2;
         for (let i = 0; i < encoded1.length; i += maxPacketSize) {
             const firstPacket = i === 0;
             // const packet_size = Math.min(maxPacketSize, encoded1.length - i);
@@ -597,8 +1138,13 @@ export class AppDataInstrumentationPybricksProtocol {
                 chunk[chunk.length - 1] = checksum;
             }
 
+            const continuationPrefix =
+                alternate && (i / maxPacketSize) % 2
+                    ? AIPPAlternateContinuationPrefix
+                    : AIPPContinuationPrefix;
+            const firstPrefix = this.crc ? AIPPCrcFirstPrefix : AIPPFirstPrefix;
             const chunk_framed = Buffer.from([
-                firstPacket ? AIPPFirstPrefix : AIPPContinuationPrefix,
+                firstPacket ? firstPrefix : continuationPrefix,
                 ...chunk,
                 isLastChunk ? AIPPNoContinuationPostfix : AIPPContinuationPostfix,
             ]);
@@ -614,15 +1160,19 @@ export class AppDataInstrumentationPybricksProtocol {
     }
 
     static appDataBuffer: Uint8Array = Buffer.alloc(0); // buffer for assembling appdata packets
+    static appDataCrc = false; // the frame being assembled uses CRC framing
     public static reset() {
         this.appDataBuffer = Buffer.alloc(0);
     }
 
     public static async decode(data: Uint8Array): Promise<ArrayBuffer | undefined> {
         let buffer: Uint8Array;
-        const isFirstPacket = data[0] === 0xfe;
+        const isFirstPacket =
+            data[0] === AIPPFirstPrefix || data[0] === AIPPCrcFirstPrefix;
+        if (isFirstPacket) this.appDataCrc = data[0] === AIPPCrcFirstPrefix;
         const hasContinuation = data[data.length - 1] === 0xff;
         data = data.subarray(1, data.length - 1);
+        this.credits?.onChunk();
 
         //-- assemble packets
         if (isFirstPacket && this.appDataBuffer.length > 0) {
@@ -649,11 +1199,21 @@ export class AppDataInstrumentationPybricksProtocol {
         //         this.appDataBuffer,
         //     )}`,
         // );
-        buffer = this.appDataBuffer.slice(0, this.appDataBuffer.length - 1);
+        const frame = this.appDataBuffer;
+        buffer = frame.slice(0, frame.length - 1);
         const checksum = data[data.length - 1];
         this.appDataBuffer = Buffer.alloc(0); // reset buffer
 
-        if (simpleSumChecksum(buffer) !== checksum) {
+        if (this.appDataCrc) {
+            // uint16 length, message, CRC-8 over all bytes before it: no remainder
+            const length =
+                frame.length >= 3 ? frame[0] | (frame[1] << 8) : frame.length;
+            if (crc8(frame) !== 0 || length > frame.length - 3) {
+                console.error('App data CRC mismatch');
+                throw new Error('App data CRC mismatch');
+            }
+            buffer = frame.slice(2, 2 + length);
+        } else if (simpleSumChecksum(buffer) !== checksum) {
             console.error(
                 'App data checksum mismatch',
                 simpleSumChecksum(buffer),
@@ -662,6 +1222,26 @@ export class AppDataInstrumentationPybricksProtocol {
             throw new Error('App data checksum mismatch');
         }
 
+        //-- unwrap sequenced frames, acks and repeated frames end here
+        if (buffer[0] === MessageType.SequencedFrame) {
+            const inner = this.link?.receive(buffer);
+            if (!inner) return undefined;
+            buffer = inner;
+        }
+
+        //-- split coalesced messages
+        if (buffer[0] === MessageType.Coalesced) {
+            for (const inner of splitCoalesced(buffer)) {
+                await this.handleMessage(inner);
+            }
+            return undefined;
+        }
+
+        await this.handleMessage(buffer);
+        return undefined;
+    }
+
+    private static async handleMessage(buffer: Uint8Array) {
         //-- decode incoming message
         const message = decodeMessageRaw(buffer);
         const msgtype = buffer[0];
@@ -674,11 +1254,22 @@ export class AppDataInstrumentationPybricksProtocol {
                 await handleIncomingAIPPPlot(message as PlotMessage);
                 break;
             }
-            case MessageType.DeviceNotification: {
+            case MessageType.DeviceNotification:
+            case MessageType.CompactDeviceNotification: {
                 const devmsg = message as DeviceNotificationMessage;
                 await handleDeviceNotificationAsync(devmsg.payloads);
                 break;
             }
+            case MessageType.DeltaDeviceNotification: {
+                const devmsg = message as DeviceNotificationMessage;
+                await handleDeviceNotificationAsync(
+                    mergeDeviceNotificationPayloads(
+                        getLastDeviceNotificationPayloads(),
+                        devmsg.payloads,
+                    ),
+                );
+                break;
+            }
             // case MessageType.TunnelNotification: {
             //     const tunmsg = message as TunnelNotificationMessage;
             //     console.debug(`Appdata tunnel notification: ${tunmsg.toString()}`);
@@ -688,8 +1279,6 @@ export class AppDataInstrumentationPybricksProtocol {
                 console.error('Unknown appdata message type', msgtype);
                 break;
         }
-
-        return undefined;
     }
 }
 async function handleIncomingAIPPPlot(arg0: PlotMessage) {
@@ -706,5 +1295,27 @@ async function handleIncomingAIPPPlot(arg0: PlotMessage) {
         case PlotSubCode.UpdateRow:
             plotManager.setRowValues(message.values);
             break;
+        case PlotSubCode.UpdateRows:
+        case PlotSubCode.Capture: {
+            // the hub batched the rows, spread them over the time they were taken
+            const last = message.rows.length - 1;
+            message.rows.forEach((values, i) =>
+                plotManager.setRowValues(
+                    values,
+                    last > 0 ? (message.span * (last - i)) / last : 0,
+                ),
+            );
+            break;
+        }
+        case PlotSubCode.CaptureStats: {
+            const rate = message.elapsed
+                ? ((message.samples - 1) * 1000) / message.elapsed
+                : 0;
+            logDebug(
+                `📈 Hub captured ${message.samples} samples at ${rate.toFixed(1)}` +
+                    ` Hz, ${message.overruns} overruns`,
+            );
+            break;
+        }
     }
 }
@@ -0,0 +1,190 @@
+/** AIPP sequenced link (host side)
+ *
+ * Sequenced, acknowledged frames on top of the AIPP tunnel framing, negotiated with the
+ * CAP_SEQ capability in the debug START handshake. Mirrors aipp.SeqLink of the hub
+ * (asset/python-libs/aipp.py).
+ *
+ * Frame: 0x76, seq, ack (next expected seq), base (oldest seq still retransmitted),
+ * uint16 length (bit 15: NAK), message. A frame with length 0 is a pure acknowledge.
+ */
+
+export const AIPP_CAP_SEQ = 0x0001;
+export const AIPP_SEQUENCED_FRAME = 0x76;
+
+const SEQ_HEADER = 6;
+const SEQ_NAK = 0x80; // in the length high byte
+const SEQ_WINDOW = 4; // unacknowledged frames kept for retransmission
+const RTO_INIT = 1000; // ms, until the first round trip was measured
+const RTO_MIN = 50;
+const RTO_MAX = 3000;
+const ACK_DELAY = 20; // ms to wait for an outgoing frame to piggyback the ack on
+const POLL_INTERVAL = 10; // ms
+
+type PendingFrame = {
+    seq: number;
+    frame: Uint8Array;
+    sentAt: number;
+    retries: number;
+};
+
+export class SequencedLink {
+    private nextSeq = 0;
+    private expected = 0; // next in-order sequence number to receive
+    private frames: PendingFrame[] = [];
+    private srtt = 0; // smoothed round trip x8, 0 = no sample yet
+    private rttvar = 0; // round trip variance x4
+    private ackDueAt: number | undefined;
+    private nakPending = false;
+    private timer: NodeJS.Timeout | undefined;
+
+    public rto = RTO_INIT;
+    public retransmits = 0;
+    public fastRetransmits = 0;
+    public duplicates = 0;
+    public dropped = 0;
+    public skipped = 0;
+
+    /**
+     * @param write writes one sequenced frame as an AIPP tunnel message
+     * @param now millisecond clock
+     */
+    constructor(
+        private readonly write: (frame: Uint8Array) => Promise<void>,
+        private readonly now: () => number = () => Date.now(),
+    ) {}
+
+    /**
+     * Send a raw message as the next sequenced frame.
+     * A full window evicts the oldest frame, the hub then skips it (base field).
+     */
+    public async send(message: Uint8Array) {
+        if (this.frames.length >= SEQ_WINDOW) {
+            this.frames.shift();
+            this.dropped++;
+        }
+        const frame = new Uint8Array(SEQ_HEADER + message.length);
+        frame[0] = AIPP_SEQUENCED_FRAME;
+        frame[1] = this.nextSeq;
+        frame[4] = message.length & 0xff;
+        frame[5] = message.length >> 8;
+        frame.set(message, SEQ_HEADER);
+        const entry = { seq: this.nextSeq, frame, sentAt: 0, retries: 0 };
+        this.frames.push(entry);
+        this.nextSeq = (this.nextSeq + 1) & 0xff;
+        await this.transmit(entry);
+    }
+
+    /**
+     * Handle a sequenced frame received from the hub.
+     * @returns the message of a new in-order frame, otherwise undefined
+     */
+    public receive(data: Uint8Array): Uint8Array | undefined {
+        if (data.length < SEQ_HEADER || data[0] !== AIPP_SEQUENCED_FRAME) return;
+        this.acknowledged(data[2]);
+        const skip = (data[3] - this.expected) & 0xff;
+        if (skip > 0 && skip < 0x80) {
+            this.skipped += skip;
+            this.expected = data[3];
+        }
+        if (data[5] & SEQ_NAK) this.goBack();
+
+        const length = data[4] | ((data[5] & ~SEQ_NAK) << 8);
+        if (length === 0 || SEQ_HEADER + length > data.length) return;
+        this.ackDueAt ??= this.now() + ACK_DELAY;
+        this.schedule();
+        if (data[1] !== this.expected) {
+            this.duplicates++;
+            // early: an earlier frame was lost
+            if (((data[1] - this.expected) & 0xff) < 0x80) this.nakPending = true;
+            return;
+        }
+        this.expected = (this.expected + 1) & 0xff;
+        return data.subarray(SEQ_HEADER, SEQ_HEADER + length);
+    }
+
+    public dispose() {
+        clearInterval(this.timer);
+        this.timer = undefined;
+        this.frames = [];
+    }
+
+    private async transmit(entry: PendingFrame) {
+        const frame = entry.frame;
+        frame[2] = this.expected; // piggyback the latest ack
+        frame[3] = this.frames[0].seq;
+        frame[5] = (frame[5] & ~SEQ_NAK) | (this.nakPending ? SEQ_NAK : 0);
+        this.ackDueAt = undefined;
+        this.nakPending = false;
+        entry.sentAt = this.now();
+        this.schedule();
+        await this.write(frame);
+    }
+
+    private async retransmit(entry: PendingFrame) {
+        entry.retries++;
+        this.retransmits++;
+        await this.transmit(entry);
+    }
+
+    private acknowledged(ack: number) {
+        const now = this.now();
+        while (this.frames.length) {
+            const entry = this.frames[0];
+            const distance = (ack - entry.seq) & 0xff;
+            if (distance === 0 || distance > SEQ_WINDOW) break;
+            this.frames.shift();
+            const rtt = now - entry.sentAt;
+            // Karn: no samples from retransmitted frames or frames the hub did not poll for
+            if (entry.retries === 0 && rtt < RTO_MAX) this.sample(rtt);
+        }
+    }
+
+    private sample(rtt: number) {
+        if (!this.srtt) {
+            this.srtt = rtt * 8;
+            this.rttvar = rtt * 2;
+        } else {
+            const delta = rtt - this.srtt / 8;
+            this.srtt += delta;
+            this.rttvar += Math.abs(delta) - this.rttvar / 4;
+        }
+        this.rto = Math.min(Math.max(this.srtt / 8 + this.rttvar, RTO_MIN), RTO_MAX);
+    }
+
+    private goBack() {
+        // retransmit the missing frame only, the hub keeps just the last chunk written
+        const first = this.frames[0];
+        if (first && this.now() - first.sentAt >= this.srtt / 16) {
+            this.fastRetransmits++;
+            void this.retransmit(first);
+        }
+    }
+
+    private schedule() {
+        if (this.timer) return;
+        this.timer = setInterval(() => void this.poll(), POLL_INTERVAL);
+    }
+
+    private async poll() {
+        const now = this.now();
+        const first = this.frames[0];
+        if (first && now - first.sentAt >= this.rto) {
+            this.rto = Math.min(this.rto * 2, RTO_MAX);
+            await this.retransmit(first);
+        }
+        if (this.ackDueAt !== undefined && now >= this.ackDueAt) {
+            const ack = new Uint8Array(SEQ_HEADER);
+            ack[0] = AIPP_SEQUENCED_FRAME;
+            ack[2] = this.expected;
+            ack[3] = this.frames.length ? this.frames[0].seq : this.nextSeq;
+            ack[5] = this.nakPending ? SEQ_NAK : 0;
+            this.ackDueAt = undefined;
+            this.nakPending = false;
+            await this.write(ack);
+        }
+        if (!this.frames.length && this.ackDueAt === undefined) {
+            clearInterval(this.timer);
+            this.timer = undefined;
+        }
+    }
+}
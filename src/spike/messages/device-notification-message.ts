@@ -1,5 +1,7 @@
 import {
     DeviceNotificationPayload,
+    parseCompactDeviceNotificationPayloads,
+    parseDeltaDeviceNotificationPayloads,
     parseDeviceNotificationPayloads,
 } from '../utils/device-notification-parser';
 import { InboundMessage } from './base-message';
@@ -7,7 +9,10 @@ import { InboundMessage } from './base-message';
 export class DeviceNotificationMessage extends InboundMessage {
     public static override readonly Id = 0x3c;
 
-    constructor(public payloads: DeviceNotificationPayload[]) {
+    constructor(
+        public payloads: DeviceNotificationPayload[],
+        public readonly delta = false,
+    ) {
         super();
     }
 
@@ -15,4 +20,14 @@ export class DeviceNotificationMessage extends InboundMessage {
         const { payloads } = parseDeviceNotificationPayloads(data);
         return new DeviceNotificationMessage(payloads);
     }
+
+    public static fromCompactBytes(data: Uint8Array): DeviceNotificationMessage {
+        const { payloads } = parseCompactDeviceNotificationPayloads(data);
+        return new DeviceNotificationMessage(payloads);
+    }
+
+    public static fromDeltaBytes(data: Uint8Array): DeviceNotificationMessage {
+        const { payloads } = parseDeltaDeviceNotificationPayloads(data);
+        return new DeviceNotificationMessage(payloads, true);
+    }
 }
@@ -50,6 +50,19 @@ export class DataViewExtended {
         return value;
     }
 
+    /** zigzag LEB128 varint (AIPP compact values), exact up to 2^53 */
+    readVarInt(): number {
+        let value = 0;
+        let scale = 1;
+        let byte: number;
+        do {
+            byte = this._view.getUint8(this.offset++);
+            value += (byte & 0x7f) * scale;
+            scale *= 0x80;
+        } while (byte & 0x80);
+        return value % 2 ? -(value + 1) / 2 : value / 2;
+    }
+
     readBool(): boolean {
         const value = this._view.getUint8(this.offset) !== 0;
         this.offset += 1;
@@ -146,7 +146,12 @@ export function checkIsDeviceNotification(data: Uint8Array): number | undefined
 
 function parseDeviceNotificationElem(
     view: DataViewExtended,
+    compact = false,
 ): DeviceNotificationPayload {
+    // compact payloads send the fields wider than a byte as zigzag varints
+    const readInt16 = () => (compact ? view.readVarInt() : view.readInt16());
+    const readUInt16 = () => (compact ? view.readVarInt() : view.readUInt16());
+    const readInt32 = () => (compact ? view.readVarInt() : view.readInt32());
     const type = view.readUInt8() as DeviceNotificationMessageType;
     switch (type) {
         case DeviceNotificationMessageType.Battery: {
@@ -156,15 +161,15 @@ function parseDeviceNotificationElem(
         case DeviceNotificationMessageType.ImuValues: {
             const faceUp = view.readUInt8();
             const yawFace = view.readUInt8();
-            const yaw = view.readInt16();
-            const pitch = view.readInt16();
-            const roll = view.readInt16();
-            const accX = view.readInt16();
-            const accY = view.readInt16();
-            const accZ = view.readInt16();
-            const gyroX = view.readInt16();
-            const gyroY = view.readInt16();
-            const gyroZ = view.readInt16();
+            const yaw = readInt16();
+            const pitch = readInt16();
+            const roll = readInt16();
+            const accX = readInt16();
+            const accY = readInt16();
+            const accZ = readInt16();
+            const gyroX = readInt16();
+            const gyroY = readInt16();
+            const gyroZ = readInt16();
             return {
                 type,
                 faceUp,
@@ -187,10 +192,10 @@ function parseDeviceNotificationElem(
         case DeviceNotificationMessageType.Motor: {
             const port = view.readUInt8();
             const deviceType = view.readUInt8();
-            const absPos = view.readInt16();
-            const power = view.readInt16();
+            const absPos = readInt16();
+            const power = readInt16();
             const speed = view.readInt8();
-            const position = view.readInt32();
+            const position = readInt32();
             return {
                 type,
                 port,
@@ -210,14 +215,14 @@ function parseDeviceNotificationElem(
         case DeviceNotificationMessageType.ColorSensor: {
             const port = view.readUInt8();
             const color = view.readInt8();
-            const red = view.readUInt16();
-            const green = view.readUInt16();
-            const blue = view.readUInt16();
+            const red = readUInt16();
+            const green = readUInt16();
+            const blue = readUInt16();
             return { type, port, color, red, green, blue };
         }
         case DeviceNotificationMessageType.DistanceSensor: {
             const port = view.readUInt8();
-            const distance = view.readInt16();
+            const distance = readInt16();
             return { type, port, distance };
         }
         case DeviceNotificationMessageType.ColorMatrix3x3: {
@@ -252,3 +257,75 @@ export function parseDeviceNotificationPayloads(data: Uint8Array): {
     }
     return { payloads: retval, length: view.offset };
 }
+
+/**
+ * Compact device notification (AIPP_CAP_COMPACT): 0x74, payloads without a length
+ * header, the tunnel frame delimits the message.
+ */
+export const COMPACT_DEVICE_NOTIFICATION_ID = 0x74;
+
+export function parseCompactDeviceNotificationPayloads(data: Uint8Array): {
+    payloads: DeviceNotificationPayload[];
+    length: number;
+} {
+    if (
+        data[0] !== COMPACT_DEVICE_NOTIFICATION_ID ||
+        data.byteLength > MAX_PAYLOAD_SIZE
+    )
+        throw new Error('Invalid compact DeviceNotification');
+
+    const view = new DataViewExtended(data, 1, DeviceNoficicationLittleEndian);
+    const retval: DeviceNotificationPayload[] = [];
+    while (view.offset < data.byteLength) {
+        retval.push(parseDeviceNotificationElem(view, true));
+    }
+    return { payloads: retval, length: view.offset };
+}
+
+/**
+ * Delta device notification (AIPP_CAP_DELTA_NOTIF): 0x75, flags, then only the
+ * payloads that changed since the last one, see mergeDeviceNotificationPayloads.
+ * Flags bit 0: the payloads are compact.
+ */
+export const DELTA_DEVICE_NOTIFICATION_ID = 0x75;
+const DELTA_COMPACT = 0x01;
+
+export function parseDeltaDeviceNotificationPayloads(data: Uint8Array): {
+    payloads: DeviceNotificationPayload[];
+    length: number;
+} {
+    if (
+        data[0] !== DELTA_DEVICE_NOTIFICATION_ID ||
+        data.byteLength < 2 ||
+        data.byteLength > MAX_PAYLOAD_SIZE
+    )
+        throw new Error('Invalid delta DeviceNotification');
+
+    const compact = !!(data[1] & DELTA_COMPACT);
+    const view = new DataViewExtended(data, 2, DeviceNoficicationLittleEndian);
+    const retval: DeviceNotificationPayload[] = [];
+    while (view.offset < data.byteLength) {
+        retval.push(parseDeviceNotificationElem(view, compact));
+    }
+    return { payloads: retval, length: view.offset };
+}
+
+/**
+ * Apply the payloads of a delta device notification to the last full list: each
+ * replaces the payload of the same type and port, new ones are appended.
+ */
+export function mergeDeviceNotificationPayloads(
+    last: readonly DeviceNotificationPayload[] | undefined,
+    delta: readonly DeviceNotificationPayload[],
+): DeviceNotificationPayload[] {
+    const key = (p: DeviceNotificationPayload) =>
+        `${p.type}:${(p as Record<string, unknown>)['port'] ?? ''}`;
+    const changed = new Map(delta.map((p) => [key(p), p]));
+    const merged = (last ?? []).map((p) => {
+        const k = key(p);
+        const update = changed.get(k);
+        changed.delete(k);
+        return update ?? p;
+    });
+    return merged.concat([...changed.values()]);
+}
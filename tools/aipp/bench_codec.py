@@ -0,0 +1,758 @@
+"""
+CPython benchmark for the AIPP hub codecs in asset/python-libs.
+
+Measures per operation:
+  ops_per_sec      throughput on CPython (relative numbers only, not hub speed)
+  wire_bytes       bytes written to AppData, framing included
+  chunks           AppData writes (19 byte BLE chunks)
+  peak_bytes       transient heap peak of one operation (tracemalloc)
+  retained_blocks  heap blocks still alive per operation (tracemalloc)
+
+Usage:
+  python tools/aipp/bench_codec.py --out baseline.json
+  python tools/aipp/bench_codec.py --compare baseline.json
+
+The JSON output is sorted and rounded so two runs can be diffed directly.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+import hubsim
+
+TUNNEL_SIZES = (1, 16, 17, 64, 256, 1024, 4096)
+STRING_SIZES = (1, 16, 64, 256, 1024)
+VARIABLE_COUNTS = (1, 4, 16, 64)
+
+
+class WireAppData:
+    # stand-in AppData counting the bytes on the wire, keeping no references
+    def __init__(self):
+        self.chunks = 0
+        self.nbytes = 0
+        self.rx = bytes(19)
+
+    def get_bytes(self):
+        return self.rx
+
+    def write_bytes(self, data):
+        self.chunks += 1
+        self.nbytes += len(data)
+
+
+def _round(value):
+    # keep 3 significant digits so reruns diff quietly
+    return float('%.3g' % value) if value else 0
+
+
+def measure(fn, min_time=0.2):
+    """Returns ops/sec, transient peak bytes and retained blocks of fn()."""
+    fn()  # warm up caches and lazily created objects
+    count, elapsed = 1, 0.0
+    while True:
+        start = time.perf_counter()
+        for _ in range(count):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        count *= 2
+    ops = count / elapsed
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - base
+        repeat = 20
+        before = tracemalloc.take_snapshot()
+        for _ in range(repeat):
+            fn()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    retained = sum(s.count_diff for s in stats if 'tracemalloc' not in
+                   s.traceback[0].filename) / repeat
+    return ops, peak, retained
+
+
+def record(results, name, fn, appdata=None, min_time=0.2):
+    if appdata is not None:
+        appdata.chunks = appdata.nbytes = 0
+        fn()
+        chunks, nbytes = appdata.chunks, appdata.nbytes
+    ops, peak, retained = measure(fn, min_time)
+    entry = {
+        'ops_per_sec': _round(ops),
+        'peak_bytes': peak,
+        'retained_blocks': round(retained, 2),
+    }
+    if appdata is not None:
+        entry['chunks'] = chunks
+        entry['wire_bytes'] = nbytes
+    results[name] = entry
+    print('%-40s %12.0f ops/s %8s B wire %7d B peak' % (
+        name, ops, entry.get('wire_bytes', '-'), peak), file=sys.stderr)
+
+
+def bench_tunnel(results, min_time):
+    aipp = hubsim.load('aipp')
+    for size in TUNNEL_SIZES:
+        data = bytes(i & 0xFF for i in range(size))
+        appdata = WireAppData()
+        writer = aipp.TunnelWriter(appdata)
+        record(results, 'tunnel.send/%d' % size,
+               lambda: writer.send(data), appdata, min_time)
+
+        chunks = hubsim.host_chunks(data)
+        reassembler = aipp.Reassembler(capacity=size + 32)
+
+        def feed():
+            for chunk in chunks:
+                reassembler.feed(chunk)
+        record(results, 'tunnel.reassemble/%d' % size, feed, None, min_time)
+
+        # CRC framing (CAP_CRC): length header and table-driven CRC-8
+        crc_appdata = WireAppData()
+        crc_writer = aipp.TunnelWriter(crc_appdata)
+        crc_writer.crc = True
+        record(results, 'tunnel.send+crc/%d' % size,
+               lambda: crc_writer.send(data), crc_appdata, min_time)
+
+        crc_chunks = hubsim.host_chunks(data, crc=True)
+
+        def feed_crc():
+            for chunk in crc_chunks:
+                reassembler.feed(chunk)
+        record(results, 'tunnel.reassemble+crc/%d' % size, feed_crc, None,
+               min_time)
+
+
+def corrupt(chunk, kind, rng):
+    # damages the payload bytes of a chunk, marker and terminator stay intact
+    chunk = bytearray(chunk)
+    last = len(chunk) - 2
+    if kind == 'bitflip2':
+        for _ in range(2):
+            chunk[rng.randint(1, last)] ^= 1 << rng.randrange(8)
+    elif kind == 'swap':
+        i = rng.randint(1, last - 1)
+        chunk[i], chunk[i + 1] = chunk[i + 1], chunk[i]
+    elif kind == 'burst3':
+        i = rng.randint(1, last - 2)
+        for k in range(3):
+            chunk[i + k] = rng.randrange(256)
+    return bytes(chunk)
+
+
+def bench_frame_check(results, trials=20000):
+    # false accepts: corrupted frames decoded as a different message, sum
+    # checksum against length and CRC-8
+    aipp = hubsim.load('aipp')
+    for kind in ('bitflip2', 'swap', 'burst3'):
+        for name, crc in (('sum', False), ('crc', True)):
+            rng = random.Random(1)
+            reassembler = aipp.Reassembler()
+            damaged = accepted = 0
+            for _ in range(trials):
+                size = rng.randint(4, 12)
+                message = bytes(rng.randrange(256) for _ in range(size))
+                chunk = hubsim.host_chunks(message, rng.randrange(256),
+                                           crc=crc)[0]
+                bad = corrupt(chunk, kind, rng)
+                if bad == chunk:
+                    continue
+                damaged += 1
+                decoded = reassembler.feed(bad)
+                if decoded is not None and bytes(decoded)[:size] != message:
+                    accepted += 1
+            key = 'frame_check.%s/%s' % (kind, name)
+            results[key] = {'false_accept_rate': round(accepted / damaged, 4)}
+            print('%-40s %8.2f %% false accepts of %d damaged frames' % (
+                key, 100 * accepted / damaged, damaged), file=sys.stderr)
+
+
+def bench_debug(results, min_time):
+    dap = hubsim.load('dap_aipp_full')
+    appdata = WireAppData()
+    dap.tunnel_writer.appdata = appdata
+    samples = (42, 3.25, 'speed', True, None, -70000)
+    for count in VARIABLE_COUNTS:
+        keys = ['var%d' % i for i in range(count)]
+        values = [samples[i % len(samples)] for i in range(count)]
+        msg = [dap._DEBUG_TRAP_NOTIF, 'program.py', 42, keys, values]
+
+        def encode_send():
+            dap.send_tunnel_aipp(dap.encode_debug_message_raw(msg))
+        record(results, 'debug.encode_trap/%dvars' % count,
+               lambda: dap.encode_debug_message_raw(msg), None, min_time)
+        record(results, 'debug.send_trap/%dvars' % count,
+               encode_send, appdata, min_time)
+
+    for size in STRING_SIZES:
+        keys = ['text']
+        values = ['x' * size]
+        msg = [dap._DEBUG_TRAP_NOTIF, 'program.py', 42, keys, values]
+        record(results, 'debug.send_trap/str%d' % size,
+               lambda: dap.send_tunnel_aipp(dap.encode_debug_message_raw(msg)),
+               appdata, min_time)
+
+        setvar = bytes([dap._DEBUG_ACKNOWLEDGE, dap._DEBUG_SETVAR_REQ]) + \
+            b'text\x00' + bytes([dap._VAR_STRING]) + b'y' * size + b'\x00'
+        view = memoryview(setvar)
+        record(results, 'debug.decode_setvar/str%d' % size,
+               lambda: dap.decode_message_raw(view), None, min_time)
+
+        chunks = hubsim.host_chunks(setvar)
+        reassembler = dap.Reassembler(capacity=len(setvar) + 32)
+
+        def receive():
+            for chunk in chunks:
+                decoded = reassembler.feed(chunk)
+            dap.decode_message_raw(decoded)
+        record(results, 'debug.receive_setvar/str%d' % size,
+               receive, None, min_time)
+
+    # containers: a trap sends the first page whatever the size, the host
+    # fetches slices with GETVAR_REQ
+    dap.containers = True
+    for size in (10, 2000):
+        samples = list(range(size))
+        msg = [dap._DEBUG_TRAP_NOTIF, 'program.py', 42, ['samples'], [samples]]
+        record(results, 'debug.send_trap/list%d' % size,
+               lambda: dap.send_tunnel_aipp(dap.encode_debug_message_raw(msg)),
+               appdata, min_time)
+    msg = [dap._DEBUG_GETVAR_RESP, 'samples', True, samples, 0, 100, 50]
+    record(results, 'debug.send_getvar/list2000[100:150]',
+           lambda: dap.send_tunnel_aipp(dap.encode_debug_message_raw(msg)),
+           appdata, min_time)
+    dap.containers = False
+
+
+STEP_VARIABLES = (
+    'speed', 'target', 'error', 'last_error', 'integral', 'derivative',
+    'kp', 'ki', 'kd', 'turn', 'left_power', 'right_power', 'reflection',
+    'threshold', 'heading', 'distance', 'counter', 'state', 'mode',
+    'max_speed', 'min_speed', 'lap', 'finished', 'label')
+
+
+def step_trace(steps=400):
+    """
+    Stepping through a PID line follower loop of 8 lines, each exposing the
+    24 variables: per line only the values computed there change.
+    Yields (filename, line, keys, values).
+    """
+    v = dict(speed=300, target=50, error=0, last_error=0, integral=0.0,
+             derivative=0.0, kp=1.2, ki=0.01, kd=4.0, turn=0.0, left_power=0,
+             right_power=0, reflection=50, threshold=50, heading=0,
+             distance=0, counter=0, state='follow', mode=1, max_speed=500,
+             min_speed=100, lap=0, finished=False, label='pid')
+    keys = list(STEP_VARIABLES)
+    for step in range(steps):
+        line = 20 + step % 8
+        if line == 20:
+            v['reflection'] = 50 + (step * 7) % 23 - 11
+        elif line == 21:
+            v['last_error'], v['error'] = v['error'], v['reflection'] - v['target']
+        elif line == 22:
+            v['integral'] += v['error']
+        elif line == 23:
+            v['derivative'] = float(v['error'] - v['last_error'])
+        elif line == 24:
+            v['turn'] = v['kp'] * v['error'] + v['ki'] * v['integral'] + \
+                v['kd'] * v['derivative']
+        elif line == 25:
+            v['left_power'] = int(v['speed'] + v['turn'])
+            v['right_power'] = int(v['speed'] - v['turn'])
+        elif line == 26:
+            v['heading'] = (v['heading'] + 3) % 360
+            v['distance'] += 12
+        else:
+            v['counter'] += 1
+        yield 'line_follower.py', line, keys, [v[k] for k in keys]
+
+
+def bench_step_trace(results):
+    # wire bytes per trap while stepping, full TRAP_NOTIF against delta
+    # snapshots with the string table (every trap acknowledged), each with
+    # fixed size and compact values
+    for name, delta, compact in (('full', False, False), ('delta', True, False),
+                                 ('full+compact', False, True),
+                                 ('delta+compact', True, True)):
+        dap = hubsim.load('dap_aipp_full')
+        dap.compact_values = compact
+        appdata = WireAppData()
+        dap.tunnel_writer.appdata = appdata
+        steps = 0
+        for filename, line, keys, values in step_trace():
+            msg = dap.encode_trap_delta(filename, line, keys, values) if delta \
+                else None
+            if msg is None:
+                msg = dap.encode_debug_message_raw(
+                    [dap._DEBUG_TRAP_NOTIF, filename, line, keys, values])
+            dap.send_tunnel_aipp(msg)
+            dap.trap_delta_commit(True)
+            steps += 1
+        results['debug.step_trace/%s' % name] = {
+            'chunks_per_step': round(appdata.chunks / steps, 2),
+            'wire_bytes_per_step': round(appdata.nbytes / steps, 1),
+        }
+        print('%-40s %8.1f B wire/step %6.2f chunks/step' % (
+            'debug.step_trace/' + name, appdata.nbytes / steps,
+            appdata.chunks / steps), file=sys.stderr)
+
+
+def trap_statement(lineno, count):
+    # the statement transformCodeForDebugTunnel (compile-helper.ts) puts in front
+    # of a line after the module level import of dap_aipp_full
+    names = ['var%d' % i for i in range(count)]
+    return '%sdap_aipp_full.dt_trap(%r, %d, [%s], [%s])' % (
+        '[%s] = ' % ','.join(names) if names else '', 'program.py', lineno,
+        ', '.join("'%s'" % name for name in names), ', '.join(names))
+
+
+def bench_trap(results, min_time):
+    # per line cost of the generated trap statement when the breakpoint bitmap
+    # disables it, against the same statement calling an empty function
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    dap.breakpoints['program.py'] = bytes([0x04])  # line 2 only
+
+    class Empty:
+        @staticmethod
+        def dt_trap(file, lineno, exposed_keys, exposed_values):
+            return exposed_values
+    for count in (0, 4):
+        code = compile(trap_statement(42, count), 'program.py', 'exec')
+        scope = {'var%d' % i: i for i in range(count)}
+        baseline = dict(scope, dap_aipp_full=Empty)
+        record(results, 'trap.call_baseline/%dvars' % count,
+               lambda: exec(code, baseline), None, min_time)
+        scope['dap_aipp_full'] = dap
+        record(results, 'trap.disabled/%dvars' % count,
+               lambda: exec(code, scope), None, min_time)
+
+    # enabled line whose condition (var3 > 100) does not fire
+    dap.breakpoints['program.py'] = bytes([0x00, 0x00, 0x00, 0x00, 0x00, 0x04])
+    dap.conditions['program.py'] = {42: [0, 0, 0, 'var3', 4, 100]}
+    record(results, 'trap.condition_false/4vars',
+           lambda: exec(code, scope), None, min_time)
+
+    # logpoint hit: snapshot queued, batches limited by the link (the virtual
+    # clock stands still, so the full queue drops its oldest entry)
+    dap.conditions.clear()
+    dap.logpoints['program.py'] = dap.breakpoints['program.py']
+    record(results, 'trap.logpoint/4vars',
+           lambda: exec(code, scope), None, min_time)
+
+
+def set_fields(monitor, rt, *args):
+    # a sample as the hubmonitor readers write it, into the fields of its source
+    monitor.fields(rt, args[0] if rt >= 0x0a else 0)[:] = args
+
+
+def bench_devnotif(results, min_time):
+    hubmonitor = hubsim.load('hubmonitor')
+    appdata = WireAppData()
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    b = monitor.frame
+    imu = (True, 0, 12, 3, -4, 10, -20, 9800, 1, -2, 3)
+    encoders = {
+        'enc_bat': lambda: monitor.enc_bat(b, 0, (80,)),
+        'enc_imu': lambda: monitor.enc_imu(b, 0, imu),
+        'enc_motor': lambda: monitor.enc_motor(b, 0, (0, 48, 120, 50, 30, 123456)),
+        'enc_force': lambda: monitor.enc_force(b, 0, (1, 5, True)),
+        'enc_color': lambda: monitor.enc_color(b, 0, (2, 9, 100, 200, 300)),
+        'enc_dist': lambda: monitor.enc_dist(b, 0, (3, 250)),
+        'sample_bat': monitor.sample_bat,
+        'sample_imu': monitor.sample_imu,
+    }
+    for name, fn in encoders.items():
+        record(results, 'devnotif.%s' % name, fn, None, min_time)
+
+    monitor.last.clear()
+    set_fields(monitor, 0x00, 80)
+    set_fields(monitor, 0x01, *imu)
+    for p in range(6):
+        set_fields(monitor, 0x0a, p, 48, 120, 50, 30, 123456)
+    record(results, 'devnotif.enc_devnotif/6motors', monitor.enc_devnotif, None,
+           min_time)
+    record(results, 'devnotif.send/6motors',
+           lambda: monitor.tunnel.send(monitor.frame_mv, monitor.enc_devnotif()),
+           appdata, min_time)
+    monitor.compact = True
+    record(results, 'devnotif.send/6motors+compact',
+           lambda: monitor.tunnel.send(monitor.frame_mv, monitor.enc_devnotif()),
+           appdata, min_time)
+
+
+def devnotif_trace(ticks=200, interval_ms=100):
+    """
+    A robot driving: battery, IMU at rest on the floor, two drive motors and
+    an arm motor turning, a color and a distance sensor.
+    Yields the encoder arguments of one notification per tick.
+    """
+    for tick in range(ticks):
+        t = tick * interval_ms / 100
+        yield [
+            ('enc_bat', (78,)),
+            ('enc_imu', (True, 0, int(t) // 10 % 360 - 180, 1, -2, 12, -30,
+                         9810, int(t) % 3 - 1, 0, 2)),
+            ('enc_motor', (0, 48, int(t * 13) % 360 - 180, 60, 45, int(t * 13))),
+            ('enc_motor', (1, 48, int(t * 12) % 360 - 180, 58, 43, int(t * 12))),
+            ('enc_motor', (2, 49, 90, 0, 0, 90 + int(t) % 2)),
+            ('enc_color', (3, 9, 120 + int(t) % 7, 95, 60)),
+            ('enc_dist', (4, 250 - int(t) % 100)),
+        ]
+
+
+# record type of each encoder, for the deadbands of delta notifications
+DEVNOTIF_TYPES = {'enc_bat': 0x00, 'enc_imu': 0x01, 'enc_motor': 0x0a,
+                  'enc_force': 0x0b, 'enc_color': 0x0c, 'enc_dist': 0x0d}
+
+
+def bench_devnotif_trace(results, seconds=20):
+    # bytes per device notification along a driving trace, fixed size against
+    # compact values, sent every 100 ms as the monitor loop does; delta
+    # notifications also every 40 ms
+    hubmonitor = hubsim.load('hubmonitor')
+    for name, compact, coalesce, delta, interval in (
+            ('fixed', False, False, False, 100),
+            ('compact', True, False, False, 100),
+            ('compact+coalesced', True, True, False, 100),
+            ('compact+coalesced+delta', True, True, True, 100),
+            ('compact+coalesced+delta@40ms', True, True, True, 40)):
+        appdata = WireAppData()
+        monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+        monitor.compact = compact
+        monitor.co.enabled = coalesce
+        monitor.delta = delta
+        monitor.interval = interval
+        nbytes = ticks = 0
+        add = monitor.co.add
+
+        def counted(msg, length=-1):
+            nonlocal nbytes
+            nbytes += len(msg) if length < 0 else length
+            add(msg, length)
+        monitor.co.add = counted
+        for tick in devnotif_trace(seconds * 1000 // interval, interval):
+            for fn, args in tick:
+                set_fields(monitor, DEVNOTIF_TYPES[fn], *args)
+            monitor.notify(monitor.clock.time())
+            monitor.co.poll()
+            hubsim.tools.wait(interval)
+            ticks += 1
+        monitor.co.flush()
+        results['devnotif.trace/%s' % name] = {
+            'chunks_per_message': round(appdata.chunks / ticks, 2),
+            'message_bytes': round(nbytes / ticks, 1),
+            'wire_bytes_per_message': round(appdata.nbytes / ticks, 1),
+            'chunks_per_sec': round(appdata.chunks / seconds, 1),
+        }
+        print('%-44s %6.1f B/message %6.1f B wire %5.2f chunks %5.1f/s' % (
+            'devnotif.trace/' + name, nbytes / ticks, appdata.nbytes / ticks,
+            appdata.chunks / ticks, appdata.chunks / seconds), file=sys.stderr)
+
+
+class TraceMotor:
+    # a PUPDevice motor turning 130 deg/s on the virtual clock
+    def info(self):
+        return {'id': 48, 'modes': [0, 1, 2, 3]}
+
+    def read(self, mode):
+        pos = hubsim.tools.clock.now * 13 // 100
+        return ((60, 45, pos % 360 - 180, pos)[mode],)
+
+
+class TraceColor:
+    # a PUPDevice color sensor passing a line every second
+    def info(self):
+        return {'id': 61, 'modes': [0, 1, 2, 3]}
+
+    def read(self, mode):
+        dark = hubsim.tools.clock.now % 1000 < 200
+        return (1,) if mode == 0 and dark else \
+            (30, 30, 30) if dark else (9,) if mode == 0 else (400, 380, 350)
+
+
+class TraceDistance:
+    # a PUPDevice ultrasonic sensor approaching a wall
+    def info(self):
+        return {'id': 62, 'modes': [0, 1, 2, 3, 4, 5, 6]}
+
+    def read(self, mode):
+        return (2000 - hubsim.tools.clock.now // 10 % 1960,)
+
+
+def bench_monitor_sample(results, min_time):
+    # one sample of every attached device, four motors, a color and a distance
+    # sensor, and of the IMU
+    from pybricks import iodevices
+    hubmonitor = hubsim.load('hubmonitor')
+    iodevices.devices.clear()
+    iodevices.devices.update(A=TraceMotor(), B=TraceMotor(), C=TraceMotor(),
+                             D=TraceMotor(), E=TraceColor(),
+                             F=TraceDistance())
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), WireAppData())
+    monitor.tick()
+    iodevices.devices.clear()
+    assert None not in monitor.kinds
+
+    def ports():
+        now = monitor.clock.time()
+        for s in range(2, 8):
+            monitor.sample(s, now)
+    record(results, 'monitor.sample/6devices', ports, None, min_time)
+    record(results, 'monitor.sample/imu',
+           lambda: monitor.sample(1, monitor.clock.time()), None, min_time)
+
+
+def bench_monitor_notify(results, min_time):
+    # a keyframe of the battery, the IMU and six motors from the frame to the
+    # wire: the legacy 0x3c notification alone, compact ones coalesced
+    hubmonitor = hubsim.load('hubmonitor')
+    for name, compact in (('fixed', False), ('compact+coalesced', True)):
+        appdata = WireAppData()
+        monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+        monitor.compact = monitor.co.enabled = compact
+        set_fields(monitor, 0x00, 80)
+        set_fields(monitor, 0x01, True, 0, 12, 3, -4, 10, -20, 9800, 1, -2, 3)
+        for p in range(6):
+            set_fields(monitor, 0x0a, p, 48, 120, 50, 30, 123456)
+
+        def keyframe():
+            monitor.send_at = 0
+            monitor.notify(0)
+            monitor.co.flush()
+        record(results, 'monitor.notify/keyframe+%s' % name, keyframe, appdata,
+               min_time)
+
+
+def bench_monitor_schedule(results, seconds=20):
+    # the monitor loop with delta notifications: every source sampled every
+    # 20 ms against the default periods per source (IMU 20 ms, motors 50 ms,
+    # color 100 ms, battery 5 s), a robot with two drive motors and a color
+    # sensor
+    from pybricks import iodevices
+    for name, uniform in (('uniform20ms', True), ('periods', False)):
+        hubmonitor = hubsim.load('hubmonitor')
+        iodevices.devices.clear()
+        iodevices.devices.update(A=TraceMotor(), B=TraceMotor(),
+                                 C=TraceColor())
+        appdata = WireAppData()
+        monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+        monitor.hs = -1
+        monitor.compact = monitor.delta = monitor.co.enabled = True
+        if uniform:
+            for rt in monitor.periods:
+                if rt != hubmonitor.RESCAN:
+                    monitor.periods[rt] = 20
+        while hubsim.tools.clock.now < seconds * 1000:
+            hubsim.tools.wait(max(1, min(hubmonitor.LOOP_MAX_MS, monitor.tick())))
+        reads = sum(monitor.samples)
+        iodevices.devices.clear()
+        key = 'monitor.schedule/%s' % name
+        results[key] = {
+            'chunks_per_sec': round(appdata.chunks / seconds, 1),
+            'samples_per_sec': round(reads / seconds, 1),
+        }
+        print('%-40s %6.1f samples/s %6.1f chunks/s' % (
+            key, reads / seconds, appdata.chunks / seconds), file=sys.stderr)
+
+
+def bench_plot(results, min_time, signals=10, rate=50, seconds=2):
+    # plotting signals at rate Hz: one UPDATE_ROW frame per row against
+    # rows batched in UPDATE_ROWS frames, and downsampled 1:10 on the hub
+    names = ['signal%d' % i for i in range(signals)]
+    for name in ('row', 'batched', 'batched+seq', 'mean10', 'minmax10'):
+        dap = hubsim.load('dap_aipp_full')
+        appdata = WireAppData()
+        dap.tunnel_writer.appdata = appdata
+        if name.endswith('+seq'):
+            dap.seq_link = dap.SeqLink(dap.tunnel_writer, dap.StopWatch())
+        dap.plot_define(names)
+        if name.endswith('10'):
+            mode = dap.PLOT_MEAN if name == 'mean10' else dap.PLOT_MIN_MAX
+            dap.plot_downsample(10, [mode] * signals)
+        appdata.chunks = appdata.nbytes = frames = 0
+        send = dap.send_tunnel_aipp
+
+        def counted(data):
+            nonlocal frames
+            frames += 1
+            send(data)
+        dap.send_tunnel_aipp = counted
+        for t in range(rate * seconds):
+            values = [(t % 7) * 0.01 * i for i in range(signals)]
+            if name == 'row':
+                counted(dap.encode_plot_message_raw(
+                    [dap._PLOT_UPDATE_ROW, values]))
+            else:
+                dap.plot_row(values)
+            hubsim.tools.wait(1000 // rate)
+        dap.plot_flush()
+        key = 'plot.%dsignals@%dHz/%s' % (signals, rate, name)
+        results[key] = {
+            'chunks_per_sec': round(appdata.chunks / seconds, 1),
+            'frames_per_sec': round(frames / seconds, 1),
+            'wire_bytes_per_sec': round(appdata.nbytes / seconds),
+        }
+        print('%-40s %8.0f B/s wire %6.1f chunks/s %6.1f frames/s' % (
+            key, appdata.nbytes / seconds, appdata.chunks / seconds,
+            frames / seconds), file=sys.stderr)
+
+    dap = hubsim.load('dap_aipp_full')
+    dap.tunnel_writer.appdata = appdata = WireAppData()
+    dap.plot_define(names)
+    values = [0.5 * i for i in range(signals)]
+    record(results, 'plot.plot_row/%dsignals' % signals,
+           lambda: dap.plot_row(values), appdata, min_time)
+
+    def set_row():
+        for n in names:
+            dap.plot_set(n, 1.5)
+        dap.plot_row()
+    record(results, 'plot.plot_set+row/%dsignals' % signals, set_row,
+           appdata, min_time)
+
+
+def bench_capture(results, min_time, signals=3, size=1000):
+    # capturing into the ring and sending it in bulk, per sample
+    names = ['signal%d' % i for i in range(signals)]
+    for typecode in ('f', 'h'):
+        dap = hubsim.load('dap_aipp_full')
+        dap.tunnel_writer.appdata = appdata = WireAppData()
+        dap.capture_start(names, size, typecode)
+        row = [1] * signals
+
+        def sample():
+            if not dap.capture(row):
+                dap.capture_used = 0  # a fresh ring for the next run
+        record(results, 'capture.capture/%d%s' % (signals, typecode), sample,
+               None, min_time)
+        dap.capture_read = dap.capture_used = 0
+        for _ in range(size):
+            dap.capture(row)
+        appdata.chunks = appdata.nbytes = 0
+        dap.capture_flush()
+        key = 'capture.flush/%d%s' % (signals, typecode)
+        results[key] = {
+            'chunks_per_sample': round(appdata.chunks / size, 3),
+            'wire_bytes_per_sample': round(appdata.nbytes / size, 2),
+        }
+        print('%-40s %8.2f B wire/sample %6.3f chunks/sample' % (
+            key, appdata.nbytes / size, appdata.chunks / size), file=sys.stderr)
+
+
+def bench_coalesce(results, ticks=200, interval=20):
+    # a device notification, a plot row and a logpoint per tick: each message
+    # in its own frame against messages coalesced for 50 ms
+    hubmonitor = hubsim.load('hubmonitor')
+    dap = hubsim.load('dap_aipp_full')
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), WireAppData())
+    monitor.compact = True
+    trace = []
+    for t, tick in enumerate(devnotif_trace(ticks)):
+        for fn, args in tick:
+            set_fields(monitor, DEVNOTIF_TYPES[fn], *args)
+        trace.append([
+            bytes(monitor.frame[:monitor.enc_devnotif()]),
+            dap.encode_plot_message_raw([dap._PLOT_UPDATE_ROW, [t, t * 0.5, 1.0]]),
+            dap.encode_debug_message_raw(
+                [dap._DEBUG_TRAP_NOTIF, 'main.py', 42, ['i'], [t]]),
+        ])
+    nbytes = sum(len(m) for tick in trace for m in tick)
+    for name, coalesce in (('separate', False), ('coalesced', True)):
+        appdata = WireAppData()
+        aipp = sys.modules['aipp']
+        coalescer = aipp.Coalescer(aipp.TunnelWriter(appdata).send,
+                                   hubsim.tools.StopWatch(), 50)
+        coalescer.enabled = coalesce
+        for tick in trace:
+            for msg in tick:
+                coalescer.add(msg)
+            coalescer.poll()
+            hubsim.tools.wait(interval)
+        coalescer.flush()
+        key = 'coalesce.mixed@%dms/%s' % (interval, name)
+        results[key] = {
+            'chunks_per_tick': round(appdata.chunks / ticks, 2),
+            'payload_bytes_per_write': round(nbytes / appdata.chunks, 1),
+        }
+        print('%-40s %8.1f B payload/write %6.2f chunks/tick' % (
+            key, nbytes / appdata.chunks, appdata.chunks / ticks), file=sys.stderr)
+
+
+def run(min_time):
+    results = {}
+    bench_tunnel(results, min_time)
+    bench_frame_check(results)
+    bench_debug(results, min_time)
+    bench_step_trace(results)
+    bench_trap(results, min_time)
+    bench_devnotif(results, min_time)
+    bench_devnotif_trace(results)
+    bench_monitor_sample(results, min_time)
+    bench_monitor_notify(results, min_time)
+    bench_monitor_schedule(results)
+    bench_plot(results, min_time)
+    bench_capture(results, min_time)
+    bench_coalesce(results)
+    return results
+
+
+def compare(old, new):
+    # prints changes beyond noise; wire/alloc numbers are exact
+    for name in sorted(set(old) | set(new)):
+        a, b = old.get(name), new.get(name)
+        if a is None or b is None:
+            print('%-40s %s' % (name, 'added' if a is None else 'removed'))
+            continue
+        notes = []
+        for key in sorted(set(a) | set(b)):
+            va, vb = a.get(key), b.get(key)
+            if va == vb:
+                continue
+            if key == 'ops_per_sec' and va and vb:
+                ratio = vb / va
+                if 0.9 < ratio < 1.1:
+                    continue
+                notes.append('%s x%.2f' % (key, ratio))
+            else:
+                notes.append('%s %s -> %s' % (key, va, vb))
+        if notes:
+            print('%-40s %s' % (name, ', '.join(notes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--out', help='write JSON results to this file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--quick', action='store_true',
+                        help='shorter timing runs')
+    args = parser.parse_args(argv)
+
+    results = {
+        'python': sys.version.split()[0],
+        'results': run(0.02 if args.quick else 0.2),
+    }
+    text = json.dumps(results, indent=1, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+    elif not args.compare:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        compare(baseline['results'], results['results'])
+
+
+if __name__ == '__main__':
+    main()
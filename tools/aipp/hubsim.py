@@ -0,0 +1,136 @@
+"""
+CPython harness for the AIPP hub scripts in asset/python-libs.
+
+Puts the pybricks/ustruct/micropython stand-ins from ./stubs on sys.path
+and imports the hub scripts fresh, so each test or benchmark starts from
+a clean module state.
+"""
+import contextlib
+import importlib
+import os
+import re
+import struct
+import sys
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LIBS = os.path.join(HERE, '..', '..', 'asset', 'python-libs')
+
+for _path in (os.path.join(HERE, 'stubs'), os.path.normpath(LIBS)):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
+
+from pybricks import hubs, tools  # noqa: E402,F401
+
+
+def load(name, reset_clock=True):
+    """Import a hub script (and the shared aipp module) from scratch."""
+    for mod in (name, 'aipp'):
+        sys.modules.pop(mod, None)
+    if reset_clock:
+        tools.clock.reset()
+    return importlib.import_module(name)
+
+
+def prune_unused_definitions(content, names):
+    """
+    Keep the top-level definitions of a module that are in names or used by
+    a kept one, like the extension (compile.ts pruneUnusedDefinitions).
+    """
+    statements = []  # [text, defined name or None]
+    in_string = False
+    for line in content.split('\n'):
+        if statements and (in_string or not re.match(r'[^\s#]', line) or
+                           statements[-1][0].endswith('\\')):
+            statements[-1][0] += '\n' + line
+        else:
+            match = re.match(r'(?:(?:def|class)\s+(\w+)|(\w+)\s*=)', line)
+            statements.append([line, match and (match[1] or match[2])])
+        if line.count('"""') % 2:
+            in_string = not in_string
+
+    defined = {name for _, name in statements if name}
+    kept = set()
+    pending = [name for name in names if name in defined]
+    while pending:
+        name = pending.pop()
+        if name in kept:
+            continue
+        kept.add(name)
+        for text, defines in statements:
+            if defines == name:
+                pending += [w for w in re.findall(r'\w+', text)
+                            if w in defined and w not in kept]
+    return '\n'.join(text for text, name in statements
+                     if not name or name in kept)
+
+
+def inline(filename, module='aipp'):
+    """
+    Build the single script the extension pastes to the REPL
+    (inlinePythonAssetModules): the import line of module replaced by the
+    definitions it imports.
+    """
+    with open(os.path.join(LIBS, filename)) as f:
+        content = f.read()
+    with open(os.path.join(LIBS, module + '.py')) as f:
+        module_content = f.read()
+    match = re.search(r'^from %s import (.*)$' % module, content, re.M)
+    names = [name.strip() for name in match[1].split(',')]
+    return content.replace(match[0],
+                           prune_unused_definitions(module_content, names))
+
+
+def load_inlined(filename, reset_clock=True):
+    """Run an inlined script as a module, without the aipp module."""
+    script = inline(filename)
+    sys.modules.pop('aipp', None)
+    if reset_clock:
+        tools.clock.reset()
+    module = types.ModuleType(filename.split('.')[0])
+    exec(compile(script, filename, 'exec'), module.__dict__)
+    return module
+
+
+@contextlib.contextmanager
+def patched(module, **attrs):
+    """Temporarily replace attributes of a stub module, e.g. AppData."""
+    saved = {key: getattr(module, key) for key in attrs}
+    for key, value in attrs.items():
+        setattr(module, key, value)
+    try:
+        yield module
+    finally:
+        for key, value in saved.items():
+            setattr(module, key, value)
+
+
+def host_chunks(message, package_id=0, alternate=False, crc=False):
+    """
+    Frame a host to hub message like the extension does
+    (AppDataInstrumentationPybricksProtocol.encode): a package id byte is
+    appended, the last chunk is zero padded to the full MTU and the checksum
+    sits on its last payload byte. alternate marks every other continuation
+    chunk 0xFD, as the extension does for sequenced frames. crc sends a CRC
+    frame: u16 length in front, the CRC-8 of all padded bytes last.
+    """
+    data = bytes(message) + bytes([package_id & 0xFF])
+    if crc:
+        data = struct.pack('<H', len(message)) + data
+    checksum = sum(data) & 0xFF
+    data += b'\x00'
+    chunks = []
+    for i in range(0, len(data), 17):
+        chunk = bytearray(data[i:i + 17])
+        last = i + 17 >= len(data)
+        if last:
+            chunk += bytes(17 - len(chunk))
+            chunk[-1] = importlib.import_module('aipp').crc8(
+                data[:i] + chunk[:-1]) if crc else checksum
+        if i == 0:
+            marker = 0xFC if crc else 0xFE
+        else:
+            marker = 0xFD if alternate and i // 17 % 2 else 0xFF
+        chunks.append(bytes([marker]) + bytes(chunk) +
+                      (b'\x00' if last else b'\xff'))
+    return chunks
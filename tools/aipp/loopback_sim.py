@@ -0,0 +1,622 @@
+"""
+Loopback simulator for the AIPP debug tunnel.
+
+Runs asset/python-libs/dap_aipp_full.py unchanged under CPython against a
+fake ThisHub/AppData pair, on a virtual millisecond clock. The fake AppData
+models 19 byte BLE writes with latency, per-chunk spacing, loss,
+duplication and corruption. As on the hub, host writes overwrite the
+AppData receive buffer, so a chunk the hub does not poll in time is lost.
+A scripted host peer speaks the debug protocol like the extension does (START_ACK,
+TRAP_ACK, SETVAR_REQ, CONTINUE_REQ, TERM_REQ).
+
+Reports the per-trap round trip (dt_trap entry to return) distribution and
+the resends caused by the tunnel_wait repeat loop and the poll intervals
+chosen by the hub, for tuning _DAP_TUNNEL_WAIT / _DAP_POLL_FAST /
+_DAP_REPEAT_COUNT.
+With --seq the host negotiates sequenced frames (aipp.SeqLink) and the
+retransmissions of both ends are reported instead.
+With --crc the host negotiates CRC framing (aipp.CAP_CRC); frames accepted
+although one of their chunks was corrupted are reported as false accepts.
+Also reports the time from the import of the module to the first user
+statement and until the background START handshake completed; --no-host
+simulates a program downloaded without the extension listening.
+With --stream the hub sends that many messages as fast as the tunnel writer
+lets it and the throughput and the messages lost are reported. --tx-buffer
+bounds the hub AppData send buffer to that many chunks, a chunk written to
+the full buffer is lost (overrun). The hub paces its chunks with a fixed
+--pace wait, or with --credits against the credits the host grants
+(aipp.CreditGate), --credit-window chunks in flight.
+
+Usage:
+  python tools/aipp/loopback_sim.py --traps 200 --loss 0.02
+  python tools/aipp/loopback_sim.py --tunnel-wait 20 --repeat-count 50 --json
+  python tools/aipp/loopback_sim.py --traps 200 --loss 0.02 --seq
+  python tools/aipp/loopback_sim.py --traps 200 --corrupt 0.05 --seq --crc
+  python tools/aipp/loopback_sim.py --traps 0 --stream 500 --tx-buffer 8 --credits
+"""
+import argparse
+import collections
+import json
+import random
+import struct
+import sys
+
+import hubsim
+from pybricks import hubs, tools
+from pybricks.parameters import Button
+
+DEBUG_ACKNOWLEDGE = 0x70
+DEBUG_NOTIFICATION = 0x71
+START_ACK, START_NOTIF = 0x00, 0x01
+TRAP_ACK, TRAP_NOTIF = 0x02, 0x03
+CONTINUE_REQ, CONTINUE_RESP = 0x04, 0x05
+SETVAR_REQ, SETVAR_RESP = 0x08, 0x09
+TERM_REQ = 0x0a
+CREDIT_GRANT = 0x13
+VAR_INT = 0x01
+START_ACK_CAPS = 0x80
+STREAM_MESSAGE = b'\x73\xee'  # a message type the hub does not use otherwise
+BREAKPOINTS_DONE = 0x14
+# BREAKPOINTS_REQ enabling the trap line of the simulated program, line 10
+BREAKPOINTS_MESSAGE = bytes([DEBUG_ACKNOWLEDGE, 0x0c, 0]) + b'program.py\x00' + \
+    struct.pack('<H', 2) + bytes([0x00, 0x04])
+
+
+class Channel:
+    # one direction of the BLE link: an ordered queue of 19 byte chunks
+
+    def __init__(self, rng, latency_ms, interval_ms, loss, dup, corrupt):
+        self.rng = rng
+        self.latency_ms = latency_ms
+        self.interval_ms = interval_ms
+        self.loss = loss
+        self.dup = dup
+        self.corrupt = corrupt
+        self.queue = collections.deque()
+        self.free_at = 0
+        self.sent = self.lost = self.duplicated = self.corrupted = 0
+        self.corrupted_chunks = set()
+
+    def send(self, chunk, now):
+        # chunks leave in order, spaced by the connection throughput
+        self.sent += 1
+        at = max(now + self.latency_ms, self.free_at + self.interval_ms)
+        self.free_at = at
+        if self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        if self.rng.random() < self.corrupt:
+            # flip bits in two payload bytes, markers and terminators stay intact
+            chunk = bytearray(chunk)
+            for i in self.rng.sample(range(1, len(chunk) - 1), 2):
+                chunk[i] ^= 1 << self.rng.randrange(8)
+            self.corrupted += 1
+            self.corrupted_chunks.add(bytes(chunk))
+        self.queue.append((at, bytes(chunk)))
+        if self.rng.random() < self.dup:
+            self.duplicated += 1
+            self.queue.append((at, bytes(chunk)))
+
+    def due(self, now):
+        while self.queue and self.queue[0][0] <= now:
+            yield self.queue.popleft()[1]
+
+
+class CheckedReassembler:
+    # counts frames accepted although one of their chunks was corrupted
+
+    def __init__(self, reassembler, channel):
+        self.reassembler = reassembler
+        self.channel = channel
+        self.damaged = False
+        self.false_accepts = 0
+
+    def feed(self, chunk):
+        if chunk[0] == 0xFE or chunk[0] == 0xFC:
+            self.damaged = False
+        if bytes(chunk) in self.channel.corrupted_chunks:
+            self.damaged = True
+        message = self.reassembler.feed(chunk)
+        if message is not None and self.damaged:
+            self.false_accepts += 1
+        return message
+
+    def __getattr__(self, name):
+        return getattr(self.reassembler, name)
+
+
+class HubAppData:
+    # hub side AppData: writes go up the link, host chunks overwrite rx.
+    # A tx_buffer of chunks waiting for the link drops writes once full.
+
+    def __init__(self, uplink, size=19, tx_buffer=0):
+        self.uplink = uplink
+        self.rx = bytes(size)
+        self.unread = False
+        self.overwritten = 0
+        self.tx_buffer = tx_buffer
+        self.leaving = collections.deque()  # times the buffered chunks leave
+        self.overruns = 0
+
+    def deliver(self, chunk):
+        if self.unread and chunk != self.rx:
+            self.overwritten += 1
+        self.rx = chunk
+        self.unread = True
+
+    def get_bytes(self):
+        self.unread = False
+        return self.rx
+
+    def write_bytes(self, data):
+        now = tools.clock.now
+        while self.leaving and self.leaving[0] <= now:
+            self.leaving.popleft()
+        if self.tx_buffer and len(self.leaving) >= self.tx_buffer:
+            self.overruns += 1
+            return
+        self.uplink.send(data, now)
+        self.leaving.append(self.uplink.free_at - self.uplink.latency_ms)
+
+
+class SimButtons:
+    # press() holds the Bluetooth button for one pressed() poll
+
+    def __init__(self):
+        self.held = False
+        self.presses = 0
+
+    def press(self):
+        self.held = True
+        self.presses += 1
+
+    def pressed(self):
+        if self.held:
+            self.held = False
+            return (Button.BLUETOOTH,)
+        return ()
+
+
+class SimHub(hubs.ThisHub):
+    def __init__(self):
+        super().__init__()
+        self.system.start_type = 0  # set to 3 (downloaded from PC) to debug
+        self.buttons = SimButtons()
+
+
+class HostPeer:
+    """
+    Scripted extension side of the debug protocol.
+    Mirrors DebugTunnel.sendToHub: every message waits host_delay_ms before
+    its chunks are written, and messages are written one after the other.
+    """
+
+    def __init__(self, aipp, uplink, downlink, deliver, args):
+        self.aipp = aipp
+        self.link = None  # host side aipp.SeqLink once negotiated
+        self.crc = False  # CRC framing once negotiated
+        self.reassembler = CheckedReassembler(aipp.Reassembler(capacity=4096),
+                                              uplink)
+        self.downlink = downlink
+        self.deliver = deliver
+        self.args = args
+        self.package_id = 0
+        self.tx_free_at = 0
+        self.link_free_at = 0
+        self.timers = []
+        self.trapped = False
+        self.last_trap = None
+        self.traps = 0
+        self.received = collections.Counter()
+        self.credits = False  # grants credits once CAP_CREDITS was agreed
+        self.chunks = 0  # chunks received since, u16
+        self.granted = 0  # chunk count of the last grant
+        self.grants = 0
+        self.streamed = 0  # stream messages received
+        self.streamed_at = 0  # time the last one was received
+
+    def send(self, message, now):
+        if self.link:
+            # the host delay comes before the frame enters the link, so the
+            # link times the round trip from the actual write
+            at = max(now, self.link_free_at) + self.args.host_delay
+            self.link_free_at = at
+            self.timers.append((at, lambda t, m=message: self.link and
+                                self.link.send(m)))  # back through write()
+        else:
+            self.write(message, now)
+
+    def write(self, message, now, delay=True):
+        # link frames (acks, retransmits) skip the host delay like DebugTunnel
+        self.package_id = (self.package_id + 1) & 0xFF
+        at = max(now, self.tx_free_at) + (self.args.host_delay if delay else 0)
+        for chunk in hubsim.host_chunks(message, self.package_id,
+                                        self.link is not None, self.crc):
+            self.downlink.send(chunk, at)
+            at = self.downlink.free_at
+        self.tx_free_at = at
+
+    def on_chunk(self, chunk, now):
+        if self.args.no_host:
+            return
+        if self.credits:
+            # a grant per half window received, at most per 4 chunks, the
+            # window of the hub until the first grant; link frames skip the delay
+            self.chunks = (self.chunks + 1) & 0xFFFF
+            batch = max(1, min(4, self.args.credit_window // 2))
+            if (self.chunks - self.granted) & 0xFFFF >= batch:
+                self.granted = self.chunks
+                self.grants += 1
+                self.write(bytes([DEBUG_ACKNOWLEDGE, CREDIT_GRANT]) + struct.pack(
+                    '<HB', self.chunks, self.args.credit_window), now, False)
+        message = self.reassembler.feed(chunk)
+        if message is not None:
+            self.on_message(bytes(message), now)
+
+    def on_message(self, msg, now):
+        if self.link:
+            msg = self.link.receive(msg)
+            if msg is None:
+                return
+            msg = bytes(msg)
+        if msg[:2] == STREAM_MESSAGE:
+            self.streamed += 1
+            self.streamed_at = now
+            return
+        if len(msg) < 2 or msg[0] != DEBUG_NOTIFICATION:
+            return
+        subcode = msg[1]
+        self.received[subcode] += 1
+        if subcode == START_NOTIF:
+            caps = struct.unpack_from('<H', msg, 2)[0] if len(msg) >= 4 else 0
+            self.link = None
+            self.crc = False
+            agreed = caps & ((self.aipp.CAP_SEQ if self.args.seq else 0) |
+                             (self.aipp.CAP_CRC if self.args.crc else 0) |
+                             (self.aipp.CAP_CREDITS if self.args.credits else 0))
+            if agreed:
+                self.write(bytes([DEBUG_ACKNOWLEDGE, START_ACK,
+                                  1 | START_ACK_CAPS]) +
+                           struct.pack('<H', agreed), now)
+                if agreed & self.aipp.CAP_SEQ:
+                    self.link = self.aipp.SeqLink(HostWriter(self), HostClock())
+                    # sendToHub of the acknowledge returns before the next one
+                    self.link_free_at = max(self.link_free_at, self.tx_free_at)
+                self.crc = agreed & self.aipp.CAP_CRC != 0
+                self.credits = agreed & self.aipp.CAP_CREDITS != 0
+                self.chunks = self.granted = 0
+            else:
+                self.send(bytes([DEBUG_ACKNOWLEDGE, START_ACK, 1]), now)
+            # the bitmaps follow, the first trap waits for BREAKPOINTS_DONE
+            self.send(BREAKPOINTS_MESSAGE, now)
+            self.send(bytes([DEBUG_ACKNOWLEDGE, BREAKPOINTS_DONE]), now)
+        elif subcode == TRAP_NOTIF:
+            self.send(bytes([DEBUG_ACKNOWLEDGE, TRAP_ACK, 1]), now)
+            # a resent trap (same bytes) is acknowledged again only
+            if not self.trapped or msg != self.last_trap:
+                self.last_trap = msg
+                self.trapped = True
+                self.traps += 1
+                self.timers.append((now + self.args.think, self.resume))
+
+    def resume(self, now):
+        if not self.trapped:
+            return
+        if self.args.term_at and self.traps >= self.args.term_at:
+            self.trapped = False
+            self.send(bytes([DEBUG_ACKNOWLEDGE, TERM_REQ]), now)
+            return
+        if self.args.setvar:
+            self.send(bytes([DEBUG_ACKNOWLEDGE, SETVAR_REQ]) + b'i\x00' +
+                      bytes([VAR_INT]) + struct.pack('<i', -self.traps), now)
+        self.trapped = False
+        self.send(bytes([DEBUG_ACKNOWLEDGE, CONTINUE_REQ, 1]), now)
+
+    def pump(self, now):
+        due = [t for t in self.timers if t[0] <= now]
+        for timer in due:
+            self.timers.remove(timer)
+            timer[1](now)
+        if self.link:
+            self.link.poll()
+
+
+class HostWriter:
+    # TunnelWriter stand-in routing the host SeqLink frames to HostPeer.write
+    def __init__(self, peer):
+        self.peer = peer
+
+    def send(self, frame):
+        self.peer.write(bytes(frame), tools.clock.now, False)
+
+
+class HostClock:
+    def time(self):
+        return tools.clock.now
+
+
+class Simulation:
+    def __init__(self, args):
+        rng = random.Random(args.seed)
+        link = (args.latency, args.interval, args.loss, args.dup, args.corrupt)
+        self.uplink = Channel(rng, *link)
+        self.downlink = Channel(rng, *link)
+        self.appdata = HubAppData(self.uplink, tx_buffer=args.tx_buffer)
+        self.args = args
+        self.sends = 0
+        self.resends = 0
+        self.trap_started = None
+        self.dap = None
+        self.started = 0
+        self.handshake_ms = None
+
+    def pump(self, now):
+        if self.handshake_ms is None and self.dap and self.dap.handshaken:
+            self.handshake_ms = now - self.started
+        # a trap stuck on a lost message is released like a user would:
+        # pressing the Bluetooth button (manual continue)
+        if self.trap_started is not None and \
+                now - self.trap_started >= self.args.stall_ms:
+            self.trap_started = now
+            self.hub.buttons.press()
+        for chunk in self.uplink.due(now):
+            self.host.on_chunk(chunk, now)
+        for chunk in self.downlink.due(now):
+            self.appdata.deliver(chunk)
+        self.host.pump(now)
+
+    def load(self):
+        tools.clock.reset()
+        with hubsim.patched(hubs, ThisHub=SimHub), \
+                hubsim.patched(tools, AppData=lambda fmt='': self.appdata):
+            dap = hubsim.load('dap_aipp_full', reset_clock=False)
+        self.host = HostPeer(sys.modules['aipp'], self.uplink, self.downlink,
+                             self.appdata.deliver, self.args)
+        tools.clock.hooks.append(self.pump)
+
+        # CPython keeps const() names as globals, so they can be tuned here
+        for name, value in (('_DAP_TUNNEL_WAIT', self.args.tunnel_wait),
+                            ('_DAP_POLL_FAST', self.args.poll_fast),
+                            ('_DAP_REPEAT_COUNT', self.args.repeat_count),
+                            ('_DAP_PACE_MS', self.args.pace)):
+            if value is not None:
+                setattr(dap, name, value)
+        dap.poll.fast, dap.poll.ceiling = dap._DAP_POLL_FAST, dap._DAP_TUNNEL_WAIT
+        self.instrument(dap)
+        return dap
+
+    def instrument(self, dap):
+        # count resends of tunnel_wait without changing the module code
+        send, wait_ = dap.send_tunnel_aipp, dap.tunnel_wait
+
+        def counting_send(data):
+            self.sends += 1
+            send(data)
+
+        def counting_wait(expected, message_to_send=None, timeout=-1):
+            before = self.sends
+            result = wait_(expected, message_to_send, timeout)
+            if message_to_send is not None:
+                self.resends += max(0, self.sends - before - 1)
+            return result
+        dap.send_tunnel_aipp = counting_send
+        dap.tunnel_wait = counting_wait
+        dap.reassembler = CheckedReassembler(dap.reassembler, self.downlink)
+
+    def run(self):
+        args = self.args
+        clock = tools.clock
+        dap = self.load()
+
+        self.hub = dap.hub
+        self.hub.system.start_type = 3
+        self.dap = dap
+        # the import of the instrumented module runs debug_tunnel_init()
+        self.started = clock.now
+        dap.debug_tunnel_init()
+        first_statement_ms = clock.now - self.started
+        tools.wait(args.startup)
+
+        trap_ms = []
+        values = [0]
+        for i in range(args.traps):
+            start = self.trap_started = clock.now
+            values = dap.dt_trap('program.py', 10, ['i'], [i])
+            self.trap_started = None
+            trap_ms.append(clock.now - start)
+            tools.wait(args.work)
+        stream = self.stream(dap) if args.stream else None
+
+        hub_link, host_link = dap.seq_link, self.host.link
+        return {
+            'seq': hub_link is not None,
+            'crc': dap.tunnel_writer.crc,
+            'hub_retransmits': hub_link.retransmits if hub_link else 0,
+            'host_retransmits': host_link.retransmits if host_link else 0,
+            'hub_rto': hub_link.rto if hub_link else None,
+            'poll_intervals': dict(sorted(dap.poll.counts.items())),
+            'handshaken': dap.handshaken,
+            'handshake_ms': self.handshake_ms,
+            'first_statement_ms': first_statement_ms,
+            'traps': len(trap_ms),
+            'host_traps': self.host.traps,
+            'trap_ms': summarize(trap_ms),
+            'resends': self.resends,
+            'stalls': self.hub.buttons.presses,
+            'hub_messages': self.sends,
+            'host_received': {hex(k): v for k, v in
+                              sorted(self.host.received.items())},
+            'last_value': values[0],
+            'stream': stream,
+            'link': {
+                'up_chunks': self.uplink.sent,
+                'up_lost': self.uplink.lost,
+                'up_duplicated': self.uplink.duplicated,
+                'down_chunks': self.downlink.sent,
+                'down_lost': self.downlink.lost,
+                'down_duplicated': self.downlink.duplicated,
+                'down_overwritten': self.appdata.overwritten,
+                'up_overruns': self.appdata.overruns,
+                'host_frame_errors': self.host.reassembler.errors,
+                'up_corrupted': self.uplink.corrupted,
+                'down_corrupted': self.downlink.corrupted,
+                'hub_frame_errors': dap.reassembler.errors,
+                'hub_false_accepts': dap.reassembler.false_accepts,
+                'host_false_accepts': self.host.reassembler.false_accepts,
+            },
+            'virtual_ms': clock.now,
+        }
+
+
+    def stream(self, dap):
+        # once handshaken, messages back to back as the user program would
+        # send telemetry; the host gets a second to receive the last ones
+        args = self.args
+        clock = tools.clock
+        while not dap.handshaken and dap.handshake_watch is not None:
+            dap.debug_tunnel_step()
+            tools.wait(dap.poll.next())
+        filler = bytes(max(0, args.stream_bytes - 4))
+        chunks = self.uplink.sent
+        start = clock.now
+        for i in range(args.stream):
+            dap.send_tunnel_aipp(STREAM_MESSAGE + struct.pack('<H', i) + filler)
+            tools.wait(args.stream_gap)
+        send_ms = clock.now - start
+        tools.wait(1000)
+        received = self.host.streamed
+        credits = dap.tunnel_writer.credits
+        return {
+            'credits': credits is not None,
+            'messages': args.stream,
+            'received': received,
+            'lost': args.stream - received,
+            'chunks': self.uplink.sent - chunks,
+            'send_ms': send_ms,
+            'messages_per_sec': round(received * 1000 / max(
+                1, self.host.streamed_at - start), 1),
+            'credit_waits': credits.waits if credits else 0,
+            'credit_stalls': credits.stalls if credits else 0,
+            'grants': self.host.grants,
+        }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1,
+                       int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def summarize(values):
+    if not values:
+        return {}
+    return {
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+        'mean': round(sum(values) / len(values), 1),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--traps', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=int, default=15,
+                        help='one way chunk latency (ms)')
+    parser.add_argument('--interval', type=int, default=2,
+                        help='minimum spacing of chunks per direction (ms)')
+    parser.add_argument('--loss', type=float, default=0.0,
+                        help='chunk loss probability')
+    parser.add_argument('--dup', type=float, default=0.0,
+                        help='chunk duplication probability')
+    parser.add_argument('--corrupt', type=float, default=0.0,
+                        help='chunk corruption probability (two bit flips)')
+    parser.add_argument('--host-delay', type=int, default=100,
+                        help='host delay before each message (ms)')
+    parser.add_argument('--think', type=int, default=0,
+                        help='host time before continuing a trap (ms)')
+    parser.add_argument('--work', type=int, default=10,
+                        help='user program time between traps (ms)')
+    parser.add_argument('--setvar', action='store_true',
+                        help='host sets a variable at every trap')
+    parser.add_argument('--term-at', type=int, default=0,
+                        help='host terminates at this trap')
+    parser.add_argument('--stall-ms', type=int, default=20000,
+                        help='press the Bluetooth button after a trap '
+                        'waited this long (ms)')
+    parser.add_argument('--startup', type=int, default=0,
+                        help='user program time before the first trap (ms)')
+    parser.add_argument('--no-host', action='store_true',
+                        help='nobody answers the hub')
+    parser.add_argument('--seq', action='store_true',
+                        help='host negotiates sequenced frames')
+    parser.add_argument('--crc', action='store_true',
+                        help='host negotiates CRC framing')
+    parser.add_argument('--stream', type=int, default=0,
+                        help='messages the hub streams after the traps')
+    parser.add_argument('--stream-bytes', type=int, default=40,
+                        help='size of each streamed message')
+    parser.add_argument('--stream-gap', type=int, default=0,
+                        help='user program time between streamed messages (ms)')
+    parser.add_argument('--tx-buffer', type=int, default=0,
+                        help='hub AppData send buffer in chunks, 0: unbounded')
+    parser.add_argument('--pace', type=int,
+                        help='hub wait after each chunk without credits (ms), '
+                        'default _DAP_PACE_MS')
+    parser.add_argument('--credits', action='store_true',
+                        help='host negotiates credit flow control')
+    parser.add_argument('--credit-window', type=int, default=8,
+                        help='chunks in flight the host grants')
+    parser.add_argument('--tunnel-wait', type=int)
+    parser.add_argument('--poll-fast', type=int)
+    parser.add_argument('--repeat-count', type=int)
+    parser.add_argument('--json', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = Simulation(args).run()
+    if args.json:
+        print(json.dumps(report, indent=1, sort_keys=True))
+        return
+    trap = report['trap_ms']
+    print('startup     first user statement after %d ms' %
+          report['first_statement_ms'])
+    if report['handshaken']:
+        print('handshake   ok after %d ms' % report['handshake_ms'])
+    else:
+        print('handshake   FAILED')
+    print('traps       %d (host saw %d)' % (report['traps'],
+                                            report['host_traps']))
+    if trap:
+        print('trap rtt    p50 %(p50)d  p90 %(p90)d  p99 %(p99)d  '
+              'max %(max)d  mean %(mean)s ms' % trap)
+    print('resends     %d of %d hub messages' % (report['resends'],
+                                                 report['hub_messages']))
+    if report['seq']:
+        print('seq         retransmits hub %d host %d, hub rto %d ms' % (
+            report['hub_retransmits'], report['host_retransmits'],
+            report['hub_rto']))
+    print('framing     %s, false accepts hub %d host %d' % (
+        'crc' if report['crc'] else 'sum', report['link']['hub_false_accepts'],
+        report['link']['host_false_accepts']))
+    print('stalls      %d released by manual continue' % report['stalls'])
+    stream = report['stream']
+    if stream:
+        print('stream      %(received)d of %(messages)d messages, %(lost)d lost, '
+              '%(messages_per_sec)s/s, sent in %(send_ms)d ms' % stream)
+        if stream['credits']:
+            print('credits     %(grants)d grants, %(credit_waits)d waits, '
+                  '%(credit_stalls)d stalls' % stream)
+    print('polls       %s' % ' '.join('%dms:%d' % kv for kv in
+                                      report['poll_intervals'].items()))
+    print('link        %s' % ', '.join('%s=%s' % kv for kv in
+                                       sorted(report['link'].items())))
+
+
+if __name__ == '__main__':
+    main()
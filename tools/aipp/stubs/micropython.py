@@ -0,0 +1,5 @@
+# CPython stand-in for the MicroPython micropython module.
+
+
+def const(value):
+    return value
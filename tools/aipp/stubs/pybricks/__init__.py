@@ -0,0 +1 @@
+# CPython stand-ins for the Pybricks modules used by the AIPP hub scripts.
@@ -0,0 +1,51 @@
+# CPython stand-in for pybricks.hubs.
+from pybricks.parameters import Side
+
+
+class _System:
+    def __init__(self):
+        self.start_type = 0
+
+    def info(self):
+        return {'program_start_type': self.start_type}
+
+
+class _Buttons:
+    def pressed(self):
+        return ()
+
+
+class _Display:
+    def number(self, value):
+        pass
+
+
+class _Battery:
+    def voltage(self):
+        return 7800
+
+
+class _IMU:
+    def up(self):
+        return Side.TOP
+
+    def heading(self):
+        return 12.5
+
+    def tilt(self):
+        return (3, -4)
+
+    def acceleration(self):
+        return (10.0, -20.0, 9800.0)
+
+    def angular_velocity(self):
+        return (0.5, -1.5, 2.0)
+
+
+class ThisHub:
+    def __init__(self):
+        self.system = _System()
+        self.buttons = _Buttons()
+        self.display = _Display()
+        self.battery = _Battery()
+        self.imu = _IMU()
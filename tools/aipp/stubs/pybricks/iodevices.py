@@ -0,0 +1,15 @@
+# CPython stand-in for pybricks.iodevices; devices are registered per port.
+devices = {}
+
+
+class PUPDevice:
+    def __init__(self, port):
+        if port not in devices:
+            raise OSError('no device on port')
+        self._dev = devices[port]
+
+    def info(self):
+        return self._dev.info()
+
+    def read(self, mode):
+        return self._dev.read(mode)
@@ -0,0 +1,24 @@
+# CPython stand-in for pybricks.parameters.
+
+
+class Button:
+    BLUETOOTH = 'BLUETOOTH'
+    CENTER = 'CENTER'
+
+
+class Side:
+    TOP = 'TOP'
+    BOTTOM = 'BOTTOM'
+    LEFT = 'LEFT'
+    RIGHT = 'RIGHT'
+    FRONT = 'FRONT'
+    BACK = 'BACK'
+
+
+class Port:
+    A = 'A'
+    B = 'B'
+    C = 'C'
+    D = 'D'
+    E = 'E'
+    F = 'F'
@@ -0,0 +1,56 @@
+# CPython stand-in for pybricks.tools, driven by a virtual millisecond clock.
+import struct
+
+
+class Clock:
+    # Virtual time in ms. wait() advances it and runs the registered hooks,
+    # so simulated peers can react while the hub script blocks.
+
+    def __init__(self):
+        self.now = 0
+        self.hooks = []
+
+    def advance(self, ms):
+        end = self.now + max(0, int(ms))
+        while True:
+            for hook in self.hooks:
+                hook(self.now)
+            if self.now >= end:
+                break
+            self.now += 1
+
+    def reset(self):
+        self.now = 0
+        self.hooks = []
+
+
+clock = Clock()
+
+
+def wait(ms):
+    clock.advance(ms)
+
+
+class StopWatch:
+    def __init__(self):
+        self._start = clock.now
+
+    def time(self):
+        return clock.now - self._start
+
+    def reset(self):
+        self._start = clock.now
+
+
+class AppData:
+    # Records hub writes; the receive buffer is overwritten by the host.
+
+    def __init__(self, fmt=''):
+        self.rx = bytes(struct.calcsize(fmt))
+        self.tx = []
+
+    def get_bytes(self):
+        return self.rx
+
+    def write_bytes(self, data):
+        self.tx.append(bytes(data))
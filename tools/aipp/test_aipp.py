@@ -0,0 +1,1265 @@
+import struct
+import tracemalloc
+
+import hubsim
+from pybricks import iodevices
+
+aipp = hubsim.load('aipp')
+
+
+def legacy_send(data, mtu=17):
+    # framing as implemented by the former send_tunnel_aipp/aipp_send copies
+    data += bytes([sum(data) & 0xFF])
+    chunks = []
+    for i in range(0, len(data), mtu):
+        chunks.append((b'\xfe' if i == 0 else b'\xff') + data[i:i + mtu] +
+                      (b'\x00' if (i + mtu) >= len(data) else b'\xff'))
+    return chunks
+
+
+def test_writer_matches_legacy_framing():
+    for size in (0, 1, 16, 17, 18, 33, 34, 35, 300):
+        data = bytes((i * 7 + 3) & 0xFF for i in range(size))
+        appdata = hubsim.tools.AppData()
+        aipp.TunnelWriter(appdata).send(data)
+        assert appdata.tx == legacy_send(data), size
+
+
+def test_writer_length_limits_buffer():
+    buf = bytearray(b'\x01\x02\x03' + bytes(40))
+    appdata = hubsim.tools.AppData()
+    aipp.TunnelWriter(appdata).send(buf, 3)
+    assert appdata.tx == [b'\xfe\x01\x02\x03\x06\x00']
+
+
+def test_reassembler_decodes_host_frames():
+    reassembler = aipp.Reassembler()
+    message = bytes(range(1, 40))
+    chunks = hubsim.host_chunks(message, package_id=7)
+    results = [reassembler.feed(chunk) for chunk in chunks]
+    assert results[:-1] == [None] * (len(chunks) - 1)
+    # message, package id and zero padding before the aligned checksum
+    assert bytes(results[-1]).rstrip(b'\x00') == message + b'\x07'
+    assert reassembler.errors == 0
+
+
+def test_reassembler_rejects_bad_frames():
+    reassembler = aipp.Reassembler()
+    first, second, third = hubsim.host_chunks(bytes(range(1, 40)))
+    # continuation without a start is dropped immediately
+    assert reassembler.feed(second) is None and not reassembler.active
+    # a new start marker restarts a partial frame
+    reassembler.feed(first)
+    reassembler.feed(first)
+    assert reassembler.feed(second) is None
+    assert reassembler.feed(third) is not None
+    # a corrupted byte fails the checksum instead of raising
+    corrupted = bytearray(second)
+    corrupted[3] ^= 0x10
+    for chunk in (first, corrupted, third):
+        result = reassembler.feed(chunk)
+    assert result is None
+    assert reassembler.errors == 2
+    # overflow of the fixed capacity is rejected
+    small = aipp.Reassembler(capacity=20)
+    assert [small.feed(c) for c in (first, second)] == [None, None]
+    assert not small.active
+
+
+def test_crc_frames_round_trip_and_catch_reordering():
+    assert aipp.crc8(b'123456789') == 0xF4  # CRC-8/SMBUS check value
+    reassembler = aipp.Reassembler(capacity=512)
+    for size in (0, 1, 13, 14, 15, 16, 17, 300):
+        data = bytes((i * 7 + 3) & 0xFF for i in range(size))
+        appdata = hubsim.tools.AppData()
+        writer = aipp.TunnelWriter(appdata)
+        writer.crc = True
+        writer.send(data)
+        assert appdata.tx[0][:3] == b'\xfc' + struct.pack('<H', size)
+        assert [reassembler.feed(c) for c in appdata.tx][-1] == data, size
+    # host frames: message, package id and padding, the length tells them apart
+    chunks = hubsim.host_chunks(b'\x70\x02\x01', package_id=7, crc=True)
+    assert bytes(reassembler.feed(chunks[0])) == b'\x70\x02\x01'
+    # legacy frames are still accepted
+    assert reassembler.feed(hubsim.host_chunks(b'\x70\x02\x01')[0]) is not None
+    assert reassembler.errors == 0
+
+    # swapped bytes and compensating errors pass the sum, not the CRC
+    for crc in (False, True):
+        first = hubsim.host_chunks(b'\x70\x02\x01\x05', crc=crc)[0]
+        i = 4 if crc else 2  # the bytes 02 01 of the message
+        swapped = bytearray(first)
+        swapped[i], swapped[i + 1] = first[i + 1], first[i]
+        compensated = bytearray(first)
+        compensated[i] += 1
+        compensated[i + 1] -= 1
+        accepted = [reassembler.feed(c) is not None for c in (swapped, compensated)]
+        assert accepted == [not crc, not crc], crc
+
+
+class CountingAppData:
+    # stand-in that keeps no reference to the written chunks
+    def __init__(self):
+        self.writes = 0
+        self.nbytes = 0
+
+    def write_bytes(self, data):
+        self.writes += 1
+        self.nbytes += len(data)
+
+
+def test_writer_does_not_allocate():
+    appdata = CountingAppData()
+    writer = aipp.TunnelWriter(appdata)
+    small = bytes(range(10))
+    large = bytes(i & 0xFF for i in range(4096))
+    crc_writer = aipp.TunnelWriter(appdata)
+    crc_writer.crc = True
+    writer.send(small)  # warm up
+    crc_writer.send(small)
+    appdata.writes = 0
+
+    tracemalloc.start()
+    try:
+        flt = [tracemalloc.Filter(True, aipp.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(flt)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        for _ in range(50):
+            writer.send(small)
+        writer.send(large)
+        for _ in range(50):
+            crc_writer.send(small)
+        crc_writer.send(large)
+        peak = tracemalloc.get_traced_memory()[1] - base
+        after = tracemalloc.take_snapshot().filter_traces(flt)
+    finally:
+        tracemalloc.stop()
+
+    # no allocation survives a send, and nothing scales with the message
+    # size or the chunk count (a 4 kB message is 241 chunks)
+    stats = after.compare_to(before, 'lineno')
+    assert sum(s.count_diff for s in stats) == 0
+    assert peak < 256
+    assert appdata.writes == 100 + (4096 + 1 + 16) // 17 + (4096 + 3 + 16) // 17
+
+
+def test_decoders_are_offset_based():
+    dap = hubsim.load('dap_aipp_full')
+    setvar = (bytes([0x70, 0x08]) + 'größe'.encode() + b'\x00' +
+              bytes([0x03]) + 'ünï'.encode() + b'\x00')
+    term = bytes([0x70, 0x0a])
+    buf = memoryview(b'\xaa' + setvar + term + b'\x00')
+    msgtype, message, offset = dap.decode_message_raw(buf, 1)
+    assert msgtype == 0x70
+    assert message == (0x08, 'größe', 0x03, 'ünï')
+    assert offset == 1 + len(setvar)
+    msgtype, message, offset = dap.decode_message_raw(buf, offset)
+    assert message == (0x0a,)
+    assert dap.decode_message_raw(b'\x70\x08x\x00\x01\x2a\x00\x00\x00')[1] == \
+        (0x08, 'x', 0x01, 42)
+
+
+class FrameLog:
+    # TunnelWriter stand-in keeping copies of the sequenced frames
+    def __init__(self):
+        self.frames = []
+
+    def send(self, frame):
+        self.frames.append(bytes(frame))
+
+
+def seq_pair():
+    clock = hubsim.tools.StopWatch()
+    a, b = FrameLog(), FrameLog()
+    return aipp.SeqLink(a, clock), a, aipp.SeqLink(b, clock), b
+
+
+def test_seqlink_delivers_equal_messages_and_drops_repeats():
+    hub, hub_out, host, host_out = seq_pair()
+    host.send(b'\x70\x04\x01')
+    host.send(b'\x70\x04\x01')
+    first, second = host_out.frames
+    assert bytes(hub.receive(first)) == b'\x70\x04\x01'
+    assert hub.receive(first) is None  # repeated transmission
+    assert bytes(hub.receive(second)) == b'\x70\x04\x01'  # equal, but new
+    assert hub.duplicates == 1
+    # unsequenced messages pass through for the legacy handshake
+    assert bytes(hub.receive(memoryview(b'\x70\x00\x01'))) == b'\x70\x00\x01'
+    # the pending ack releases both frames at the sender
+    hub.poll()
+    assert hub_out.frames[-1][:3] == bytes([0x76, 0x00, 0x02])
+    assert host.receive(hub_out.frames[-1]) is None
+    assert host.frames == []
+
+
+def test_seqlink_retransmits_oldest_frame():
+    hub, hub_out, host, host_out = seq_pair()
+    host.send(b'one')
+    host.send(b'two')
+    lost, early = host_out.frames
+    # the early frame is dropped and answered with a NAK ...
+    assert hub.receive(early) is None
+    hub.poll()
+    nak = hub_out.frames[-1]
+    assert nak[5] & 0x80 and nak[2] == 0
+    # ... which resends the missing frame only, without waiting for the RTO
+    host.receive(nak)
+    assert host.fast_retransmits == 1
+    assert host_out.frames[-1][1] == lost[1] and len(host_out.frames) == 3
+    assert bytes(hub.receive(host_out.frames[-1])) == b'one'
+
+    # timeouts retransmit the oldest frame and back off
+    rto = host.rto
+    hubsim.tools.wait(rto)
+    host.poll()
+    assert host_out.frames[-1][1] == lost[1] and host.rto == 2 * rto
+
+
+def test_seqlink_skips_frames_evicted_by_sender():
+    hub, hub_out, host, host_out = seq_pair()
+    for i in range(6):  # window of 4, two frames are evicted unsent
+        host.send(bytes([0x70, i]))
+    assert host.dropped == 2
+    # the last frame names seq 2 as its oldest, the hub gives up on 0 and 1
+    assert hub.receive(host_out.frames[-1]) is None
+    assert hub.skipped == 2 and hub.expected == 2
+    hubsim.tools.wait(host.rto)
+    host.poll()
+    assert bytes(hub.receive(host_out.frames[-1])) == b'\x70\x02'
+
+
+def test_start_handshake_negotiates_seq():
+    dap = hubsim.load('dap_aipp_full')
+    notif = dap.encode_debug_message_raw([dap._DEBUG_START_NOTIF])
+    assert notif == b'\x71\x01\xdf\x04'
+    # legacy hosts answer with a plain success byte, then the package id
+    assert dap.decode_message_raw(b'\x70\x00\x01\x05\x00')[1] == (0x00, True, 0)
+    assert dap.decode_message_raw(b'\x70\x00\x81\x01\x00\x05')[1] == \
+        (0x00, True, dap.CAP_SEQ)
+
+
+def test_poll_scheduler_backs_off_and_counts():
+    poll = aipp.PollScheduler(fast=5, ceiling=50)
+    assert [poll.next() for _ in range(6)] == [5, 10, 20, 40, 50, 50]
+    assert poll.next(hold=True) == 5  # incomplete frame keeps polling fast
+    poll.activity()
+    assert poll.next() == 5
+    poll.ceiling = 20
+    assert [poll.next() for _ in range(3)] == [10, 20, 20]
+    assert poll.counts == {5: 3, 10: 2, 20: 3, 40: 1, 50: 2}
+
+
+def test_start_handshake_does_not_block():
+    dap = hubsim.load('dap_aipp_full')
+    clock = hubsim.tools.clock
+    dap.hub.system.start_type = 3
+    assert dap.debug_tunnel_init() is False
+    assert clock.now == 0  # the user program starts at once
+    assert dap.appdata.tx[-1] == b'\xfe\x71\x01\xdf\x04\x55\x00'
+    # without a host a trap waits once for at most the grace period ...
+    assert dap.dt_trap('p.py', 1, ['a'], [1]) == [1]
+    assert 0 < clock.now <= dap._DAP_HANDSHAKE_GRACE
+    # ... and later traps return immediately
+    now = clock.now
+    assert dap.dt_trap('p.py', 2, ['a'], [2]) == [2]
+    assert clock.now == now
+    # the acknowledge completes the handshake in the background
+    dap.appdata.rx = hubsim.host_chunks(b'\x70\x00\x01')[0]
+    assert dap.debug_tunnel_step() is True and dap.handshaken
+
+
+def breakpoints_message(filename, lines, flags=0):
+    bitmap = bytearray((max(lines) >> 3) + 1 if lines else 0)
+    for line in lines:
+        bitmap[line >> 3] |= 1 << (line & 7)
+    return (bytes([0x70, 0x0c, flags]) + filename.encode() + b'\x00' +
+            len(bitmap).to_bytes(2, 'little') + bitmap)
+
+
+def test_breakpoint_bitmap_disables_traps():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    message = breakpoints_message('p.py', [3, 17])
+    assert dap.decode_message_raw(message)[1] == \
+        (0x0c, 0, 'p.py', bytes([0x08, 0x00, 0x02]))
+    # the update is applied by a disabled trap polling the tunnel
+    dap.breakpoints['p.py'] = b''
+    for chunk in hubsim.host_chunks(message):
+        dap.appdata.rx = chunk
+        dap.debug_tunnel_service()
+    assert dap.breakpoints['p.py'] == bytes([0x08, 0x00, 0x02])
+
+    # disabled lines and lines past the bitmap return without a round trip
+    dap.appdata.tx.clear()
+    for line in (1, 4, 16, 18, 200):
+        assert dap.dt_trap('p.py', line, ['a'], [line]) == [line]
+    assert dap.appdata.tx == []
+    # an enabled line notifies the host, an unanswered trap continues
+    assert dap.dt_trap('p.py', 17, ['a'], [5]) == [5]
+    assert dap.appdata.tx[0][:3] == b'\xfe\x71\x03'
+    # files without a bitmap never stop, the step flag stops at the next trap
+    dap.appdata.tx.clear()
+    dap.dt_trap('other.py', 3, [], [])
+    assert dap.appdata.tx == []
+    dap.set_breakpoints(dap.decode_message_raw(
+        breakpoints_message('p.py', [], flags=1))[1])
+    assert dap.stepping and dap.breakpoints['p.py'] == b''
+    dap.dt_trap('other.py', 3, [], [])
+    assert dap.appdata.tx[0][:3] == b'\xfe\x71\x03'
+    dap.stepping = False
+    dap.appdata.tx.clear()
+    dap.dt_trap('p.py', 3, [], [])
+    assert dap.appdata.tx == []
+
+
+def test_first_line_trap_waits_for_the_breakpoints():
+    # the host sends the bitmaps after START_ACK, then BREAKPOINTS_DONE: the
+    # first trap waits for them, so a breakpoint on the first line stops while
+    # the other lines and files without a bitmap run on
+    dap = hubsim.load('dap_aipp_full')
+    dap.hub.system.start_type = 3
+    dap.debug_tunnel_init()
+    chunks = hubsim.host_chunks(b'\x70\x00\x01', 1) + \
+        hubsim.host_chunks(breakpoints_message('p.py', [1]), 2) + \
+        hubsim.host_chunks(b'\x70\x14', 3)
+
+    def get_bytes():
+        if len(chunks) > 1:
+            return chunks.pop(0)
+        return chunks[0]
+    dap.appdata.get_bytes = get_bytes
+    dap.appdata.tx.clear()
+    assert dap.dt_trap('p.py', 1, ['a'], [1]) == [1]
+    assert dap.handshaken and dap.breakpoints_done
+    assert dap.breakpoints['p.py'] == b'\x02'
+    assert b'\xfe\x71\x03' in [c[:3] for c in dap.appdata.tx]
+
+    dap.appdata.tx.clear()
+    now = hubsim.tools.clock.now
+    for line in range(2, 40):
+        assert dap.dt_trap('p.py', line, ['a'], [line]) == [line]
+        assert dap.dt_trap('q.py', line, ['a'], [line]) == [line]
+    assert dap.appdata.tx == [] and hubsim.tools.clock.now == now
+
+
+def condition_message(filename, line, hit_op=0, hit_value=0, varname='',
+                      cmp_op=0, value=b'\x00'):
+    return (bytes([0x70, 0x0d]) + filename.encode() + b'\x00' +
+            struct.pack('<HBH', line, hit_op, hit_value) + varname.encode() +
+            b'\x00' + bytes([cmp_op]) + value)
+
+
+def test_conditions_are_evaluated_on_hub():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [5]))[1])
+    # speed > 300, then every 2nd hit of it
+    message = condition_message('p.py', 5, 3, 2, 'speed', 4,
+                                b'\x01' + struct.pack('<i', 300))
+    assert dap.decode_message_raw(message)[1] == \
+        (0x0d, 'p.py', 5, 3, 2, 'speed', 4, 300)
+    dap.set_condition(dap.decode_message_raw(message)[1])
+
+    notified = []
+    for speed in (100, 400, 200, 500, 600, 700):
+        dap.appdata.tx.clear()
+        dap.dt_trap('p.py', 5, ['x', 'speed'], [1, speed])
+        if dap.appdata.tx:
+            notified.append(speed)
+    assert notified == [500, 700]
+    assert dap.conditions['p.py'][5][2] == 4
+
+    # a variable that is not exposed fires, a new bitmap drops the conditions
+    dap.set_condition(dap.decode_message_raw(
+        condition_message('p.py', 5, 2, 1, 'other', 0, b'\x00'))[1])
+    assert dap.condition_fires(dap.conditions['p.py'][5], ['x'], [1])
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [5]))[1])
+    assert 'p.py' not in dap.conditions
+
+
+def test_logpoints_queue_and_batch_snapshots():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [4]))[1])
+    logs = bytearray(breakpoints_message('p.py', [4]))
+    logs[1] = 0x0e
+    dap.set_breakpoints(dap.decode_message_raw(logs)[1])
+    dap.appdata.tx.clear()
+
+    # no waiting for the host: the first hit is sent at once, later hits are
+    # batched per interval, the oldest dropped from a full queue
+    for i in range(40):
+        assert dap.dt_trap('p.py', 4, ['i'], [i]) == [i]
+    assert hubsim.tools.clock.now == 0
+    assert len(dap.log_queue) == dap._DAP_LOG_QUEUE and dap.log_dropped == 23
+    hubsim.tools.wait(dap._DAP_LOG_INTERVAL)
+    dap.log_flush()
+
+    reassembler = aipp.Reassembler(capacity=512)
+    batches = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert len(batches) == 2
+    last = batches[-1]
+    assert last[:2] == b'\x71\x0f'
+    dropped, count = struct.unpack_from('<HB', last, 2)
+    assert dropped == 23 and count >= 5
+    offset, values = 5, []
+    for _ in range(count):
+        n = struct.unpack_from('<H', last, offset)[0]
+        snapshot = last[offset + 2:offset + 2 + n]
+        assert snapshot[:2] == b'\x71\x03'
+        values.append(struct.unpack_from('<i', snapshot, n - 4)[0])
+        offset += 2 + n
+    assert values == list(range(24, 24 + count))
+
+
+def test_logpoints_keep_flowing_over_sequenced_frames():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    clock = hubsim.tools.clock
+    dap.seq_link = dap.SeqLink(dap.tunnel_writer, hubsim.tools.StopWatch())
+    logs = bytearray(breakpoints_message('p.py', [4]))
+    logs[1] = 0x0e
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [4]))[1])
+    dap.set_breakpoints(dap.decode_message_raw(logs)[1])
+    dap.appdata.tx.clear()
+
+    # a loop hitting only a logpoint, the host acknowledging what it receives
+    host_out = FrameLog()
+    host = aipp.SeqLink(host_out, hubsim.tools.StopWatch())
+    reassembler = aipp.Reassembler(capacity=512)
+    batches, package_id = 0, 0
+    for i in range(200):
+        assert dap.dt_trap('p.py', 4, ['i'], [i]) == [i]
+        for chunk in dap.appdata.tx:
+            frame = reassembler.feed(chunk)
+            message = host.receive(bytes(frame)) if frame else None
+            if message is not None and bytes(message[:2]) == b'\x71\x0f':
+                batches += 1
+        dap.appdata.tx.clear()
+        host.poll()
+        if host_out.frames:
+            package_id += 1
+            dap.appdata.rx = hubsim.host_chunks(
+                host_out.frames.pop(), package_id, alternate=True)[0]
+            host_out.frames.clear()
+        hubsim.tools.wait(10)
+    assert clock.now == 2000
+    # every few hits a batch, never more than two frames unacknowledged
+    assert batches > 50 and len(dap.seq_link.frames) <= dap._DAP_LOG_FRAMES
+    assert dap.log_dropped == 0
+
+
+def decode_trap_delta(msg, strings, values):
+    # host side expansion of a TRAP_DELTA_NOTIF, as the extension does it
+    dap_types = {1: '<i', 2: '<f'}
+    assert msg[:2] == b'\x71\x10'
+    offset = 3
+    for _ in range(msg[2]):
+        end = msg.index(0, offset + 1)
+        strings[msg[offset]] = msg[offset + 1:end].decode()
+        offset = end + 1
+    filename = strings[msg[offset]]
+    line, count = struct.unpack_from('<HB', msg, offset + 1)
+    offset += 4
+    variables = {}
+    for _ in range(count):
+        i, vartype = msg[offset], msg[offset + 1]
+        offset += 2
+        if not vartype & 0x80:
+            if vartype in dap_types:
+                values[i] = struct.unpack_from(dap_types[vartype], msg, offset)[0]
+                offset += 4
+            elif vartype == 3:
+                end = msg.index(0, offset)
+                values[i] = msg[offset:end].decode()
+                offset = end + 1
+            elif vartype == 4:
+                values[i] = msg[offset] != 0
+                offset += 1
+            else:
+                values[i] = None
+        variables[strings[i]] = values[i]
+    return filename, line, variables
+
+
+def test_trap_delta_sends_strings_once_and_changed_values():
+    dap = hubsim.load('dap_aipp_full')
+    keys = ['speed', 'name', 'on']
+    strings, values = {}, {}
+    first = dap.encode_trap_delta('p.py', 7, keys, [300, 'a', True])
+    assert decode_trap_delta(first, strings, values) == \
+        ('p.py', 7, {'speed': 300, 'name': 'a', 'on': True})
+    dap.trap_delta_commit(True)
+
+    second = dap.encode_trap_delta('p.py', 8, keys, [301, 'a', 1])
+    # no definitions, one byte per name, unchanged 'a', bool -> int is a change
+    assert second[2] == 0 and len(second) <= len(first) // 2
+    assert decode_trap_delta(second, strings, values) == \
+        ('p.py', 8, {'speed': 301, 'name': 'a', 'on': 1})
+    # an unacknowledged trap starts over with definitions and all values
+    dap.trap_delta_commit(False)
+    third = dap.encode_trap_delta('p.py', 8, keys, [301, 'a', 1])
+    assert third[2] == 4 and b'speed' in third and b'\x01\x2d\x01' in third
+    assert decode_trap_delta(third, {}, {})[2] == {'speed': 301, 'name': 'a', 'on': 1}
+
+
+def scripted_host(appdata, replies):
+    # answers each complete hub message with the next host messages in replies
+    pending = []
+    write = appdata.write_bytes
+
+    def write_bytes(data):
+        write(data)
+        if data[-1] == 0x00 and replies:
+            for message in replies.pop(0):
+                pending.extend(hubsim.host_chunks(message))
+
+    def get_bytes():
+        if pending:
+            appdata.rx = pending.pop(0)
+        return appdata.rx
+
+    appdata.write_bytes = write_bytes
+    appdata.get_bytes = get_bytes
+
+
+def getvar_message(name, limit=512, start=0, count=0, path=()):
+    return (b'\x70\x06' + name.encode() + b'\x00' +
+            struct.pack('<HHBB', limit, start, count, len(path)) +
+            struct.pack('<%dH' % len(path), *path))
+
+
+def test_lazy_values_are_fetched_on_demand():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = dap.lazy_values = True
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [3]))[1])
+    text = 'x' * 40
+    trap = dap.encode_debug_message_raw(
+        [dap._DEBUG_TRAP_NOTIF, 'p.py', 3, ['s', 'n', 't'], ['short', 1, text], True])
+    # small values inline, the long string as its size only
+    assert trap.endswith(b's\x00\x03short\x00n\x00\x01\x01\x00\x00\x00t\x00\x43\x28\x00')
+    delta = dap.encode_trap_delta('p.py', 3, ['t'], [text])
+    assert delta.endswith(b'\x01\x43\x28\x00') and text.encode() not in delta
+    # logpoint snapshots keep all values inline
+    assert text.encode() in dap.encode_debug_message_raw(
+        [dap._DEBUG_TRAP_NOTIF, 'p.py', 3, ['t'], [text]])
+
+    getvar = getvar_message('t', 10)
+    assert dap.decode_message_raw(getvar)[1] == (0x06, 't', 10, 0, 0, [])
+    scripted_host(dap.appdata, [
+        [b'\x70\x02\x01', getvar, getvar_message('zz', 16)],
+        [],
+        [b'\x70\x04\x00'],
+    ])
+    assert dap.dt_trap('p.py', 3, ['n', 't'], [1, text]) == [1, text]
+    reassembler = aipp.Reassembler(capacity=512)
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    # truncated to the requested size, an unknown name is flagged
+    assert messages[1] == b'\x71\x07t\x00\x01\x03' + b'x' * 10 + b'\x00'
+    assert messages[2] == b'\x71\x07zz\x00\x02\x00'
+    assert messages[3] == b'\x71\x05'
+
+
+def decode_element(msg, offset):
+    # host side decoding of a trap value, containers as (length, start, items)
+    vartype = msg[offset]
+    offset += 1
+    if vartype & 0x40:
+        return ('deferred', struct.unpack_from('<H', msg, offset)[0]), offset + 2
+    if vartype in (5, 6, 7):
+        length, start, count = struct.unpack_from('<HHB', msg, offset)
+        offset += 5
+        items = []
+        for _ in range(count * 2 if vartype == 7 else count):
+            item, offset = decode_element(msg, offset)
+            items.append(item)
+        if vartype == 7:
+            items = list(zip(items[::2], items[1::2]))
+        return (length, start, items), offset
+    if vartype in (1, 2):
+        return struct.unpack_from('<i' if vartype == 1 else '<f', msg, offset)[0], offset + 4
+    if vartype == 3:
+        end = msg.index(0, offset)
+        return msg[offset:end].decode(), end + 1
+    if vartype == 4:
+        return msg[offset] != 0, offset + 1
+    return None, offset
+
+
+def test_containers_are_paged():
+    dap = hubsim.load('dap_aipp_full')
+    dap.initialized = dap.handshaken = dap.breakpoints_done = True
+    dap.lazy_values = dap.containers = True
+    dap.set_breakpoints(dap.decode_message_raw(breakpoints_message('p.py', [9]))[1])
+    samples = list(range(2000))
+    state = {'mode': 'run', 'gains': (1, 2, [3, [4]]), 'log': 'y' * 30}
+    trap = dap.encode_debug_message_raw(
+        [dap._DEBUG_TRAP_NOTIF, 'p.py', 9, ['samples', 'state'], [samples, state], True])
+    offset = trap.index(b'samples\x00') + 8
+    value, offset = decode_element(trap, offset)
+    # the first page only
+    assert value == (2000, 0, list(range(8)))
+    offset += len(b'state\x00')
+    value, offset = decode_element(trap, offset)
+    assert offset == len(trap)
+    # nested pages up to the depth limit, long strings deferred
+    assert value == (3, 0, [('mode', 'run'), ('gains', (3, 0, [1, 2, (2, 0, [])])),
+                            ('log', ('deferred', 30))])
+    # the element budget bounds a trap value of any shape
+    wide = [[i] * 8 for i in range(20)]
+    assert len(dap.encode_value(wide)[1]) < 5 + 8 * (6 + 5 * 8)
+    budget = [dap._DAP_VALUE_ELEMENTS]
+    dap.encode_page(bytearray(), wide, 0, 8, 1, False, budget)
+    assert budget == [0]
+    # unsupported elements are named, the old encoding skips containers
+    vartype, data = dap.encode_value([b'x'])
+    assert decode_element(bytes([vartype]) + data, 0)[0] == (1, 0, ["<class 'bytes'>"])
+    dap.containers = False
+    assert dap.encode_value(samples) == (None, None)
+    dap.containers = True
+
+    # slices and nested elements on request
+    scripted_host(dap.appdata, [
+        [b'\x70\x02\x01', getvar_message('samples', start=100, count=50),
+         getvar_message('samples', start=1990, count=50),
+         getvar_message('state', 64, path=[2]),
+         getvar_message('state', start=0, count=2, path=[1, 2]),
+         getvar_message('state', path=[7])],
+        [], [], [], [],
+        [b'\x70\x04\x00'],
+    ])
+    dap.dt_trap('p.py', 9, ['samples', 'state'], [samples, state])
+    reassembler = aipp.Reassembler(capacity=512)
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    head = b'\x71\x07samples\x00\x00'
+    assert messages[1].startswith(head)
+    assert decode_element(messages[1], len(head))[0] == (2000, 100, list(range(100, 150)))
+    assert decode_element(messages[2], len(head))[0] == (2000, 1990, list(range(1990, 2000)))
+    head = b'\x71\x07state\x00\x00'
+    assert decode_element(messages[3], len(head))[0] == 'y' * 30
+    assert decode_element(messages[4], len(head))[0] == (2, 0, [3, (1, 0, [4])])
+    assert messages[5] == b'\x71\x07state\x00\x02\x00'
+
+
+def test_compact_values_round_trip():
+    for n in (0, 1, -1, 63, -64, 64, -65, 123456, -2 ** 31, 2 ** 40):
+        buf = bytearray()
+        aipp.put_varint(buf, n)
+        assert aipp.get_varint(buf, 0) == (n, len(buf))
+    buf = bytearray()
+    aipp.put_varint(buf, -64)
+    assert buf == b'\x7f'  # one byte for -64..63
+    # m * 4 + d with the fewest decimals, None where a float is needed
+    assert aipp.scaled(4.0) == 16
+    assert aipp.scaled(1.2) == 12 * 4 + 1
+    assert aipp.scaled(-0.25) == -25 * 4 + 2
+    for f in (3.14159, 1e30, float('nan'), float('inf'), 0.1 + 0.2):
+        assert aipp.scaled(f) is None
+
+    dap = hubsim.load('dap_aipp_full')
+    assert dap.encode_value(300) == (dap._VAR_INT, struct.pack('<i', 300))
+    dap.compact_values = True
+    assert dap.encode_value(300) == (dap._VAR_VARINT, b'\xd8\x04')
+    assert dap.encode_value(True) == (dap._VAR_BOOL, b'\x01')
+    assert dap.encode_value(1.2) == (dap._VAR_DECIMAL, b'\x62')
+    assert dap.encode_value(3.14159) == (dap._VAR_FLOAT, struct.pack('<f', 3.14159))
+
+
+def set_fields(monitor, rt, *args):
+    # a sample as the hubmonitor readers write it, into the fields of its source
+    monitor.fields(rt, args[0] if rt >= 0x0a else 0)[:] = args
+
+
+def encoded(enc, *args):
+    # the record a hubmonitor encoder packs for the encoder arguments args
+    buf = bytearray(64)
+    return bytes(buf[:enc(buf, 0, args)])
+
+
+def test_hubmonitor_negotiates_compact_notifications():
+    hubmonitor = hubsim.load('hubmonitor')
+    appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    for p in range(6):
+        set_fields(monitor, 0x0a, p, 48, 120, 50, 30, 1234)
+    assert monitor.enc_devnotif() == 3 + 6 * 12
+    assert monitor.frame[:3] == b'\x3c' + struct.pack('<H', 6 * 12)
+
+    # START offers monitor and compact values, resent until answered
+    for monitor.i in range(1, 62):
+        monitor.handshake()
+    assert appdata.tx == [b'\xfe\x71\x01\xf0\x07\x69\x00'] * 3
+    appdata.rx = hubsim.host_chunks(b'\x70\x00\x81\x10\x00')[0]
+    monitor.handshake()
+    assert monitor.compact and monitor.hs == -1
+
+    assert encoded(monitor.enc_motor, 0, 48, 120, 50, 30, 1234) == \
+        b'\x0a\x00\x30\xf0\x01\x64\x1e\xa4\x13'
+    assert monitor.enc_devnotif() == 1 + 6 * 9 and monitor.frame[0] == 0x74
+    assert encoded(monitor.enc_force, 1, 5, True) == b'\x0b\x01\x05\x01'
+
+    # a host without compact values keeps the legacy format, no answer gives up
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    appdata.rx = hubsim.host_chunks(b'\x70\x00\x81\x00\x00')[0]
+    monitor.i = 1
+    monitor.handshake()
+    assert not monitor.compact and monitor.hs == -1
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), hubsim.tools.AppData())
+    for monitor.i in range(1, 200):
+        monitor.handshake()
+    assert len(monitor.appdata.tx) == hubmonitor.HANDSHAKE_TRIES and monitor.hs == -1
+
+
+def test_hubmonitor_sends_notifications_from_one_frame():
+    hubmonitor = hubsim.load('hubmonitor')
+    appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    monitor.hs = -1
+    reassembler = aipp.Reassembler(capacity=512)
+
+    # the longest notification fits: 32-bit values, a color and a distance
+    # record on every port
+    big = 2 ** 31 - 1
+    monitor.compact = True
+    set_fields(monitor, 0x00, 100)
+    set_fields(monitor, 0x01, True, 5, *[-big] * 9)
+    for p in range(6):
+        set_fields(monitor, 0x0c, p, 9, big, big, big)
+        set_fields(monitor, 0x0d, p, -big)
+    assert monitor.enc_devnotif() <= hubmonitor.NOTIF_MAX
+
+    # the length of a legacy notification is patched for each one sent
+    monitor.compact = False
+    monitor.last.clear()
+    set_fields(monitor, 0x00, 80)
+    set_fields(monitor, 0x0d, 1, 250)
+    monitor.notify(0)
+    monitor.last.clear()
+    set_fields(monitor, 0x00, 79)
+    monitor.notify(100)
+    assert monitor_messages(appdata, reassembler) == [
+        b'\x3c\x06\x00\x00\x50\x0d\x01\xfa\x00', b'\x3c\x02\x00\x00\x4f']
+
+    # coalesced notifications are copied from the frame, sent without slicing
+    monitor.co.enabled = True
+    monitor.notify(200)
+    monitor.co.flush()
+    monitor.notify(300)
+    set_fields(monitor, 0x00, 78)
+    monitor.notify(400)
+    monitor.co.flush()
+    assert monitor_messages(appdata, reassembler) == [
+        b'\x3c\x02\x00\x00\x4f',
+        b'\x77\x05\x3c\x02\x00\x00\x4f\x05\x3c\x02\x00\x00\x4e']
+
+
+class StubMotor:
+    def __init__(self):
+        self.values = [50, 30, 120, 1234]  # power, speed, abs position, position
+
+    def info(self):
+        return {'id': 48, 'modes': [0, 1, 2, 3]}
+
+    def read(self, mode):
+        return (self.values[mode],)
+
+
+def run_monitor(hubmonitor, monitor, until):
+    # the loop_check loop up to the clock time until (ms)
+    while hubsim.tools.clock.now < until:
+        hubsim.tools.wait(max(1, min(hubmonitor.LOOP_MAX_MS, monitor.tick())))
+
+
+def monitor_messages(appdata, reassembler):
+    messages = [bytes(m) for m in map(reassembler.feed, appdata.tx) if m]
+    appdata.tx.clear()
+    return messages
+
+
+def test_hubmonitor_sends_changed_sources_between_keyframes():
+    hubmonitor = hubsim.load('hubmonitor')
+    motor = StubMotor()
+    iodevices.devices.clear()
+    iodevices.devices['A'] = motor
+    appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    monitor.hs = -1
+    monitor.compact = monitor.delta = True
+    reassembler = aipp.Reassembler(capacity=512)
+
+    def sent():
+        return monitor_messages(appdata, reassembler)
+
+    # the first cycle is a keyframe with battery, IMU and the motor
+    monitor.tick()
+    keyframe = sent()
+    assert len(keyframe) == 1 and keyframe[0][:3] == b'\x74\x00\x4e'
+    # nothing moved: nothing sent, a change within the deadband neither
+    run_monitor(hubmonitor, monitor, 50)
+    motor.values[3] += 1
+    run_monitor(hubmonitor, monitor, 100)
+    assert sent() == []
+
+    # the motor alone, against the values last sent
+    motor.values[3] += 1
+    run_monitor(hubmonitor, monitor, 150)
+    assert sent() == [b'\x75\x01' + encoded(monitor.enc_motor, 0, 48, 120, 50, 30, 1236)]
+
+    # all sources again at the next keyframe, a detached device is left out
+    run_monitor(hubmonitor, monitor, hubmonitor.KEYFRAME_MS)
+    assert sent() == []
+    run_monitor(hubmonitor, monitor, hubmonitor.KEYFRAME_MS + 1)
+    assert sent()[0][0] == 0x74
+
+    def detached(mode):
+        raise OSError('no device on port')
+    motor.read = detached
+    run_monitor(hubmonitor, monitor, hubmonitor.KEYFRAME_MS + 100)
+    resync = sent()
+    assert [m[0] for m in resync] == [0x74] and len(resync[0]) < len(keyframe[0])
+    assert monitor.kinds[2] is None and not any(k > 0xff for k in monitor.last)
+
+
+def test_hubmonitor_samples_each_source_on_its_period():
+    hubmonitor = hubsim.load('hubmonitor')
+    motor = StubMotor()
+    iodevices.devices.clear()
+    iodevices.devices['A'] = motor
+    appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+    hub = hubsim.hubs.ThisHub()
+    counts = {'bat': 0, 'imu': 0, 'motor': 0}
+
+    def counted(name, fn):
+        def call(*args):
+            counts[name] += 1
+            return fn(*args)
+        return call
+    hub.battery.voltage = counted('bat', hub.battery.voltage)
+    hub.imu.heading = counted('imu', hub.imu.heading)
+    motor.read = counted('motor', motor.read)
+    monitor = hubmonitor.DeviceMonitor(hub, appdata)
+    monitor.hs = -1
+    reassembler = aipp.Reassembler(capacity=512)
+
+    # battery 5 s, IMU 20 ms, motor 50 ms (4 reads), the empty ports rescanned
+    # at 0 and 500 ms, then 1 s later; full notifications every 100 ms
+    run_monitor(hubmonitor, monitor, 1000)
+    assert counts == {'bat': 1, 'imu': 50, 'motor': 4 * 20}
+    assert monitor.backoff == [0] + [1000] * 5
+    assert monitor.due[3] == 1500
+    messages = monitor_messages(appdata, reassembler)
+    assert len(messages) == 10 and all(m[0] == 0x3c for m in messages)
+
+    # the host pauses the IMU and samples the battery every 100 ms
+    request = b'\x70\x11\x02' + struct.pack('<BHBH', 0x01, 0, 0x00, 100)
+    appdata.rx = hubsim.host_chunks(request)[0]
+    monitor.schedule = True
+    monitor.rates_from = 1000
+    counts.update(bat=0, imu=0)
+    run_monitor(hubmonitor, monitor, 1001 + hubmonitor.RATES_MS)
+    assert counts['bat'] == 51 and counts['imu'] == 0  # 1000 .. 6000 ms
+
+    # the rate report: record type, port, target and actual period
+    reports = [m for m in monitor_messages(appdata, reassembler)
+               if m[:2] == b'\x71\x12']
+    assert len(reports) == 1 and reports[0][2] == 3
+    rates = [struct.unpack_from('<BBHH', reports[0], 3 + 6 * k)
+             for k in range(3)]
+    assert rates == [(0x00, 0xff, 100, 100), (0x01, 0xff, 0, 0),
+                     (0x0a, 0, 50, 50)]
+
+
+def test_hubmonitor_builds_read_plans_once():
+    hubmonitor = hubsim.load('hubmonitor')
+    infos = []
+
+    class Motor3Modes(StubMotor):
+        # a motor without the position mode, counting info() calls
+        def info(self):
+            infos.append(self)
+            return {'id': 48, 'modes': [0, 1, 2]}
+
+    class Color(StubMotor):
+        def info(self):
+            infos.append(self)
+            return {'id': 61}
+
+        def read(self, mode):
+            return (9,) if mode == 0 else (100, 200, 300)
+    iodevices.devices.clear()
+    iodevices.devices.update(A=Motor3Modes(), C=Color())
+    appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    monitor.hs = -1
+    run_monitor(hubmonitor, monitor, 1000)
+    iodevices.devices.clear()
+
+    # info() only when attached, the position read from the absolute one
+    assert len(infos) == 2
+    assert monitor.plans[0][:2] == (0x0a, monitor.read_motor)
+    assert monitor.last[0x0a00] == [0, 48, 120, 50, 30, 120]
+    assert monitor.last[0x0c02] == [2, 9, 100, 200, 300]
+
+
+class MovingMotor(StubMotor):
+    # a motor turning 130 deg/s on the virtual clock
+    def read(self, mode):
+        pos = hubsim.tools.clock.now * 13 // 100
+        return ((60, 45, pos % 360 - 180, pos)[mode],)
+
+
+def test_hubmonitor_tick_does_not_allocate():
+    hubmonitor = hubsim.load('hubmonitor')
+    iodevices.devices.clear()
+    for p in 'ABCDEF':
+        iodevices.devices[p] = MovingMotor()
+    appdata = CountingAppData()
+    appdata.get_bytes = lambda: bytes(19)
+    monitor = hubmonitor.DeviceMonitor(hubsim.hubs.ThisHub(), appdata)
+    monitor.hs = -1
+    monitor.compact = monitor.delta = monitor.schedule = monitor.co.enabled = True
+    run_monitor(hubmonitor, monitor, 5500)  # warm up: attach, send, report
+    writes = appdata.writes
+
+    tracemalloc.start()
+    try:
+        flt = [tracemalloc.Filter(True, hubmonitor.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(flt)
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        run_monitor(hubmonitor, monitor, 16000)  # two rate reports
+        peak = tracemalloc.get_traced_memory()[1] - base
+        after = tracemalloc.take_snapshot().filter_traces(flt)
+    finally:
+        tracemalloc.stop()
+    iodevices.devices.clear()
+
+    # samples fill the fields of their source in place, the notifications
+    # and rate reports are packed into their preallocated buffers; CPython
+    # boxes the ints above 256 (32 B), MicroPython's small ints are not
+    def blocks(snapshot):
+        return sorted(str(t.traceback) for t in snapshot.traces if t.size > 32)
+    assert blocks(after) == blocks(before)
+    assert peak < 2048  # the stand-in hub and devices included
+    assert appdata.writes > writes + 100
+
+
+# characters, the limit of the Hub Monitor command (src/extension/commands.ts)
+HUB_MONITOR_MAX_SIZE = 25 * 1024
+
+
+def test_hubmonitor_repl_script_inlines_used_definitions_only():
+    script = hubsim.inline('hubmonitor.min.py')
+    assert len(script) < HUB_MONITOR_MAX_SIZE
+    assert 'class SeqLink' not in script and 'class PollScheduler' not in script
+    assert 'class CreditGate' in script and 'from aipp' not in script
+
+    # the inlined script monitors like the full one
+    sent = []
+    for load in (lambda: hubsim.load('hubmonitor'),
+                 lambda: hubsim.load_inlined('hubmonitor.min.py')):
+        hubmonitor = load()
+        iodevices.devices.clear()
+        iodevices.devices.update(A=MovingMotor(), C=StubMotor())
+        appdata = hubsim.tools.AppData('<BBBBBBBBBBBBBBBBBBB')
+        monitor = getattr(hubmonitor, 'DeviceMonitor', None) or hubmonitor.DM
+        monitor = monitor(hubsim.hubs.ThisHub(), appdata)
+        monitor.hs = -1
+        monitor.compact = monitor.delta = monitor.schedule = True
+        monitor.co.enabled = True
+        monitor.tunnel.pace_ms = 5  # the min script paces old hosts by 10 ms
+        while hubsim.tools.clock.now < 6000:
+            hubsim.tools.wait(max(1, min(50, monitor.tick())))
+        sent.append(list(appdata.tx))
+    iodevices.devices.clear()
+    assert len(sent[0]) > 100 and sent[1] == sent[0]
+
+
+def decode_plot_rows(msg):
+    # host side decoding of an UPDATE_ROWS message
+    assert msg[:2] == b'\x73\x04'
+    rows, count, span = struct.unpack_from('<BBH', msg, 2)
+    assert len(msg) == 6 + rows * count * 4
+    values = struct.unpack_from('<%df' % (rows * count), msg, 6)
+    return span, [list(values[r * count:(r + 1) * count]) for r in range(rows)]
+
+
+def test_plot_rows_are_batched():
+    dap = hubsim.load('dap_aipp_full')
+    reassembler = aipp.Reassembler(capacity=512)
+    dap.plot_define(['a', 'b', 'c'])
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert messages == [b'\x73\x01\x03a\x00b\x00c\x00']
+    dap.appdata.tx.clear()
+
+    # rows wait for the batch to fill, cells are looked up by name
+    dap.plot_row([1, 2, 3])
+    dap.plot_set('c', 6)
+    dap.plot_set('a', 4)
+    hubsim.tools.wait(20)
+    dap.plot_row()
+    assert dap.plot_rows == 2 and not dap.appdata.tx
+    for i in range(dap.plot_capacity - 2):
+        dap.plot_row([i, i, i, 99])  # extra values are cut
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert len(messages) == 1
+    span, rows = decode_plot_rows(messages[0])
+    assert span == 20 and len(rows) == dap.plot_capacity
+    assert rows[0] == [1, 2, 3] and rows[1][0] == 4 and rows[1][2] == 6
+    assert rows[1][1] != rows[1][1]  # NaN, not set
+    assert rows[-1] == [dap.plot_capacity - 3] * 3
+
+    # a late row leaves once the oldest one waited _PLOT_LATENCY ms,
+    # a new column flushes the rows batched with fewer columns
+    dap.appdata.tx.clear()
+    dap.plot_row([1, 1, 1])
+    hubsim.tools.wait(dap._PLOT_LATENCY)
+    dap.plot_row([2, 2, 2])
+    dap.plot_row([3, 3, 3])
+    dap.plot_set('d', 7)
+    dap.plot_row()
+    dap.plot_flush()
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert len(messages) == 4
+    assert decode_plot_rows(messages[0]) == (dap._PLOT_LATENCY,
+                                             [[1, 1, 1], [2, 2, 2]])
+    assert decode_plot_rows(messages[1]) == (0, [[3, 3, 3]])
+    assert messages[2][:5] == b'\x73\x02\x01d\x00'
+    assert decode_plot_rows(messages[3])[1][0][3] == 7
+
+
+def test_capture_rings_rows_and_flushes_in_bulk():
+    dap = hubsim.load('dap_aipp_full')
+    dap.capture_start(['gyro', 'speed'], size=64, typecode='h')
+    dap.appdata.tx.clear()
+
+    # 1 kHz into the ring, nothing is sent, a full ring drops rows
+    row = [0, 0]
+    tracemalloc.start()
+    try:
+        flt = [tracemalloc.Filter(True, dap.__file__)]
+        before = tracemalloc.take_snapshot().filter_traces(flt)
+        for t in range(80):
+            row[0], row[1] = t, -t
+            dap.capture(row)
+            hubsim.tools.wait(1)
+        after = tracemalloc.take_snapshot().filter_traces(flt)
+    finally:
+        tracemalloc.stop()
+    assert sum(s.count_diff for s in after.compare_to(before, 'lineno')) == 0
+    assert not dap.appdata.tx
+    assert dap.capture_stats() == (1000, 64, 16)
+
+    # a flush limited in time leaves rows, the ring wraps
+    assert dap.capture_frame_rows == 50
+    assert dap.capture_flush(0) == 14
+    for t in range(80, 130):
+        assert dap.capture([t, -t])
+    rate, samples, overruns = dap.capture_stop()
+    assert (samples, overruns) == (114, 16)
+
+    reassembler = aipp.Reassembler(capacity=512)
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    values = []
+    for msg in messages[:-1]:
+        # rows before columns, as in UPDATE_ROWS
+        assert msg[:3] == b'\x73\x05h' and msg[4] == 2
+        rows, span = msg[3], struct.unpack_from('<H', msg, 5)[0]
+        assert len(msg) == 7 + rows * 4
+        values += struct.unpack_from('<%dh' % (rows * 2), msg, 7)[::2]
+    assert [len(m) for m in messages[:-1]] == [207, 63, 207]
+    assert values == list(range(64)) + list(range(80, 130))
+    assert messages[-1] == struct.pack('<BBIII', 0x73, 0x06, 114, 16, 80)
+    assert dap.capture_ring is None
+
+
+def test_capture_frames_match_the_host_decode_test():
+    # the frames decoded in src/pybricks/appdata-instrumentation-protocol.test.ts
+    dap = hubsim.load('dap_aipp_full')
+    reassembler = aipp.Reassembler(capacity=512)
+    frames = []
+    captures = ((['a', 'b'], 'h', [[0, 0], [1, -1], [2, -2]], 2),
+                (['a'], 'f', [[1.5], [-2.25]], 5))
+    for names, typecode, rows, step in captures:
+        dap.capture_start(names, size=8, typecode=typecode)
+        dap.appdata.tx.clear()
+        for row in rows:
+            dap.capture(row)
+            hubsim.tools.wait(step)
+        dap.capture_flush()
+        frames += [bytes(m).hex()
+                   for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert frames == ['73056803020400000000000100ffff0200feff',
+                      '730566020105000000c03f000010c0']
+
+
+def test_plot_downsampling_set_by_host():
+    dap = hubsim.load('dap_aipp_full')
+    reassembler = aipp.Reassembler(capacity=512)
+    dap.plot_define(['a', 'b', 'c'])
+    # buckets of 4 rows: a every 4th, b the mean, c the min and the max
+    dap.appdata.rx = hubsim.host_chunks(b'\x72\x07\x04\x03\x00\x01\x02')[0]
+    dap.plot_flush()
+    assert dap.plot_bucket == 4 and dap.plot_modes == [0, 1, 2]
+    dap.appdata.tx.clear()
+
+    for t, c in enumerate([5, 1, 9, 3, 2, 8, 0, 4, 7]):
+        dap.plot_row([t, t, c])
+    assert dap.plot_rows == 4 and dap.plot_taken == 1
+    dap.plot_flush()  # sends the bucket begun too
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    rows = decode_plot_rows(messages[0])[1]
+    assert rows[0] == [0, 1.5, 1] and rows[1][2] == 9
+    assert rows[2] == [4, 5.5, 8] and rows[3][2] == 0
+    assert rows[1][0] != rows[1][0] and rows[3][1] != rows[3][1]
+    assert rows[4] == [8, 8, 7]
+
+    # the hub program sets policies by name, 0xff keeps a column's policy
+    dap.plot_downsample(2, {'a': dap.PLOT_MEAN})
+    dap.plot_downsample(2, b'\xff\x02')
+    assert dap.plot_modes == [dap.PLOT_MEAN, dap.PLOT_MIN_MAX, dap.PLOT_MIN_MAX]
+    dap.plot_define(['x'])
+    assert dap.plot_bucket == 1 and dap.plot_modes == [dap.PLOT_EVERY]
+
+
+def split_coalesced(msg):
+    # host side splitting of a COALESCED message
+    assert msg[0] == 0x77
+    messages, offset = [], 1
+    while offset < len(msg):
+        n = msg[offset]
+        messages.append(bytes(msg[offset + 1:offset + 1 + n]))
+        offset += 1 + n
+    assert offset == len(msg)
+    return messages
+
+
+def test_coalescer_packs_messages_into_one_frame():
+    watch = hubsim.tools.StopWatch()
+    sent = []
+    coalescer = aipp.Coalescer(lambda data: sent.append(bytes(data)), watch, 50)
+    coalescer.add(b'\x73\x01a\x00')  # not enabled: sent at once
+    assert sent == [b'\x73\x01a\x00']
+    coalescer.enabled = True
+    sent.clear()
+
+    # a lone message is sent as is, queued ones wait for the deadline
+    coalescer.add(b'\x74\x00\x4e')
+    coalescer.flush()
+    coalescer.add(b'\x74\x00\x4f')
+    coalescer.add(b'\x71\x0f' + bytes(20))
+    coalescer.poll()
+    assert sent == [b'\x74\x00\x4e']
+    hubsim.tools.wait(50)
+    coalescer.poll()
+    assert split_coalesced(sent[1]) == [b'\x74\x00\x4f', b'\x71\x0f' + bytes(20)]
+
+    # a message not fitting sends the queue first, a long one goes alone
+    sent.clear()
+    for i in range(5):
+        coalescer.add(bytes([0x73, i]) + bytes(60))
+    coalescer.add(bytes(300))
+    assert [len(m) for m in sent] == [1 + 3 * 63, 1 + 2 * 63, 300]
+    assert split_coalesced(sent[1])[1][:2] == b'\x73\x04'
+
+
+def test_log_and_plot_messages_share_frames():
+    dap = hubsim.load('dap_aipp_full')
+    dap.coalescer.enabled = True
+    dap.plot_define(['a'])
+    dap.appdata.tx.clear()
+
+    # a logpoint batch waits for the plot rows, a trap flushes both
+    dap.log_queue.append(b'\x71\x03p.py\x00\x04\x00\x00')
+    dap.log_flush()
+    for i in range(dap.plot_capacity):
+        dap.plot_row([i])
+    assert not dap.appdata.tx
+    dap.send_tunnel_aipp(b'\x71\x03p.py\x00\x05\x00\x00')
+    reassembler = aipp.Reassembler(capacity=512)
+    messages = [bytes(m) for m in map(reassembler.feed, dap.appdata.tx) if m]
+    assert len(messages) == 1
+    inner = split_coalesced(messages[0])
+    assert [m[:2] for m in inner] == [b'\x71\x0f', b'\x73\x04', b'\x71\x03']
+
+
+def test_credits_pace_tunnel_chunks():
+    clock = hubsim.tools.clock
+    appdata = hubsim.tools.AppData()
+    writer = aipp.TunnelWriter(appdata, pace_ms=5)
+    writer.send(bytes(40))  # without credits: a fixed wait after each chunk
+    assert len(appdata.tx) == 3 and clock.now == 15
+
+    # the initial credits go out at once, a grant read is applied while
+    # waiting, no grant within stall_ms writes the chunks off
+    reassembler = aipp.Reassembler()
+    incoming = []  # host chunks, one per read
+
+    def read():
+        return reassembler.feed(incoming.pop(0)) if incoming else None
+    gate = writer.credits = aipp.CreditGate(read, hubsim.tools.StopWatch())
+    appdata.tx.clear()
+    writer.send(bytes(60))
+    assert len(appdata.tx) == 4 and clock.now == 15 and gate.waits == 0
+    incoming.append(legacy_send(b'\x70\x13' + struct.pack('<HB', 4, 8))[0])
+    writer.send(bytes(130))
+    assert len(appdata.tx) == 12 and clock.now == 16  # one poll
+    assert (gate.sent, gate.received, gate.window, gate.waits) == (12, 4, 8, 1)
+    writer.send(b'x')
+    assert gate.stalls == 1 and clock.now == 16 + gate.stall_ms
+    assert (gate.sent, gate.lost, gate.in_flight()) == (13, 8, 1)
+
+    # the written off chunks stay off, unless a grant counts them after all
+    gate.grant(4, 8)
+    assert gate.in_flight() == 1
+    gate.grant(10, 8)
+    assert gate.in_flight() == 0 and gate.lost == 3
+
+    # the debuggee agrees on credits in the handshake and applies grants,
+    # an older host gets a fixed wait after each chunk
+    dap = hubsim.load('dap_aipp_full')
+    dap.hub.system.start_type = 3
+    dap.debug_tunnel_init()
+    dap.appdata.rx = hubsim.host_chunks(b'\x70\x00\x81\x00\x04')[0]
+    assert dap.debug_tunnel_step() is True
+    assert dap.tunnel_writer.credits and dap.tunnel_writer.pace_ms == 0
+    dap.appdata.rx = hubsim.host_chunks(b'\x70\x13\x02\x00\x10')[0]
+    assert dap.receive_tunnel() == (None, None)
+    assert dap.tunnel_writer.credits.window == 16
+    dap = hubsim.load('dap_aipp_full')
+    dap.hub.system.start_type = 3
+    dap.debug_tunnel_init()
+    dap.appdata.rx = hubsim.host_chunks(b'\x70\x00\x01')[0]
+    assert dap.debug_tunnel_step() is True
+    assert dap.tunnel_writer.credits is None
+    assert dap.tunnel_writer.pace_ms == dap._DAP_PACE_MS
+
+
+def test_credit_wait_keeps_host_messages():
+    dap = hubsim.load('dap_aipp_full')
+    dap.hub.system.start_type = 3
+    dap.debug_tunnel_init()
+    dap.appdata.rx = hubsim.host_chunks(b'\x70\x00\x81\x00\x04')[0]
+    assert dap.debug_tunnel_step() is True
+    dap.appdata.tx.clear()
+
+    # out of credits, the send polls the host: a breakpoints update of two
+    # chunks arrives before the grant, and is handled once the send is done
+    update = breakpoints_message('p.py', [4, 40])
+    chunks = hubsim.host_chunks(update, 1) + \
+        hubsim.host_chunks(b'\x70\x13\x04\x00\x08', 2)
+    assert len(chunks) == 3
+    get_bytes = dap.appdata.get_bytes
+
+    def arriving():
+        if chunks:
+            dap.appdata.rx = chunks.pop(0)
+        return get_bytes()
+    dap.appdata.get_bytes = arriving
+    dap.send_tunnel_aipp(bytes(100))
+    credits = dap.tunnel_writer.credits
+    assert len(dap.appdata.tx) == 6 and credits.waits == 1 and not credits.stalls
+    assert 'p.py' not in dap.breakpoints and len(credits.held) == 1
+    assert dap.receive_tunnel() == (None, None)
+    assert dap.breakpoints['p.py'][0] == 0x10 and not credits.held